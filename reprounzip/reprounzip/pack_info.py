@@ -132,7 +132,7 @@ def print_info(args):
                 print("        wd: %s" % r['workingdir'])
                 if 'signal' in r:
                     print("        signal: %d" % r['signal'])
-                else:
+                elif 'exitcode' in r:
                     print("        exitcode: %d" % r['exitcode'])
 
     # Unpacker compatibility
@@ -19,12 +19,13 @@ from __future__ import unicode_literals
 import argparse
 import heapq
 import logging
-from rpaths import PosixPath, Path
+from rpaths import Path
 import sqlite3
 import sys
 import tarfile
 
-from reprounzip.common import FILE_READ, FILE_WRITE, FILE_WDIR, load_config
+from reprounzip.common import FILE_READ, FILE_WRITE, FILE_WDIR, TracePaths, \
+    load_config
 from reprounzip.orderedset import OrderedSet
 from reprounzip.unpackers.common import COMPAT_OK, COMPAT_NO
 from reprounzip.utils import PY3, unicode_, iteritems, escape, \
@@ -107,13 +108,14 @@ def generate(target, directory, all_forks=False):
     all_programs = []
 
     # ... and opened files...
+    paths = TracePaths(conn)
     file_cursor = conn.cursor()
     file_rows = file_cursor.execute(
             '''
-            SELECT name, timestamp, mode, process
-            FROM opened_files
+            SELECT %s, timestamp, mode, process
+            FROM %s
             ORDER BY id
-            ''')
+            ''' % (paths.column, paths.opened_files))
     binaries = set()
     files = OrderedSet()
     edges = OrderedSet()
@@ -122,10 +124,10 @@ def generate(target, directory, all_forks=False):
     exec_cursor = conn.cursor()
     exec_rows = exec_cursor.execute(
             '''
-            SELECT name, timestamp, process, argv
-            FROM executed_files
+            SELECT %s, timestamp, process, argv
+            FROM %s
             ORDER BY id
-            ''')
+            ''' % (paths.column, paths.executed_files))
 
     # Loop on all event lists
     logging.info("Getting all events from database...")
@@ -152,7 +154,7 @@ def generate(target, directory, all_forks=False):
 
         elif event_type == 'open':
             r_name, r_timestamp, r_mode, r_process = data
-            r_name = PosixPath(r_name)
+            r_name = paths.path(r_name)
             if r_mode != FILE_WDIR:
                 process = processes[r_process]
                 files.add(r_name)
@@ -160,7 +162,7 @@ def generate(target, directory, all_forks=False):
 
         elif event_type == 'exec':
             r_name, r_timestamp, r_process, r_argv = data
-            r_name = PosixPath(r_name)
+            r_name = paths.path(r_name)
             process = processes[r_process]
             binaries.add(r_name)
             # Here we split this process in two "programs", unless the previous
@@ -61,11 +61,25 @@ def escape(s):
 
 
 class CommonEqualityMixin(object):
-    """Common mixin providing comparison by comparing ``__dict__`` attributes.
+    """Common mixin providing comparison by comparing attributes.
+
+    Both ``__dict__`` and the ``__slots__`` of the class and its bases are
+    compared, so this works for slotted subclasses too.
     """
+    __slots__ = ()
+
+    def _equality_values(self):
+        values = [getattr(self, '__dict__', None)]
+        for klass in type(self).__mro__:
+            slots = getattr(klass, '__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            values.extend(getattr(self, name, None) for name in slots)
+        return values
+
     def __eq__(self, other):
         return (isinstance(other, self.__class__) and
-                self.__dict__ == other.__dict__)
+                self._equality_values() == other._equality_values())
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -99,36 +113,85 @@ def hsize(nbytes):
         return "{0:.2f} PB".format(nbytes / PB)
 
 
-def find_all_links_recursive(filename, files):
-    path = Path('/')
-    for c in filename.components[1:]:
-        # At this point, path is a canonical path, and all links in it have
-        # been resolved
+class LinkResolver(object):
+    """Dereferences symlinks from absolute paths, remembering every prefix.
 
-        # We add the next path component
-        path = path / c
+    The paths in a trace share most of their directories, so the canonical
+    path and the symbolic links traversed to get there are cached for every
+    prefix that gets resolved; each directory is then only looked at once.
+    `hits` and `misses` count the prefixes found in and added to the cache.
+
+    The cache reflects the filesystem at the time it is filled; use a new
+    resolver if it might have changed.
+    """
+    def __init__(self):
+        root = Path('/')
+        self._cache = {root: (root, ())}
+        self._resolving = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, filename):
+        try:
+            result = self._cache[filename]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+        self.misses += 1
+
+        # The parent is resolved first, so that path is canonical up to its
+        # last component
+        parent, links = self._lookup(filename.parent)
+        path = parent / filename.name
 
         # That component is possibly a link
         if path.is_link():
             # Adds the link itself
-            files.add(path)
+            links = links + (path,)
 
             target = path.read_link(absolute=True)
-            # Here, target might contain a number of symlinks
-            if target not in files:
-                # Recurse on this new path
-                find_all_links_recursive(target, files)
-            # Restores the invariant; realpath might resolve several links here
-            path = path.resolve()
-    return path
-
-
-def find_all_links(filename, include_target=False):
+            if path in self._resolving:
+                # Link loop, let realpath sort it out
+                path = path.resolve()
+            else:
+                # Here, target might contain a number of symlinks
+                self._resolving.add(path)
+                try:
+                    canonical, target_links = self._lookup(target)
+                finally:
+                    self._resolving.discard(path)
+                path = canonical
+                links = links + target_links
+        result = self._cache[filename] = path, links
+        return result
+
+    def resolve(self, filename):
+        """Gets the canonical path, with all symbolic links resolved.
+        """
+        return self._lookup(Path(filename))[0]
+
+    def links(self, filename):
+        """Gets the symbolic links traversed to reach a path, in order.
+        """
+        seen = set()
+        links = []
+        for link in self._lookup(Path(filename))[1]:
+            if link not in seen:
+                seen.add(link)
+                links.append(link)
+        return links
+
+
+def find_all_links(filename, include_target=False, resolver=None):
     """Dereferences symlinks from a path.
 
     If include_target is True, this also returns the real path of the final
     target.
 
+    Pass a `LinkResolver` to reuse what was found from previous calls.
+
     Example:
         /
             a -> b
@@ -139,15 +202,15 @@ def find_all_links(filename, include_target=False):
                     e -> /f
             f
     >>> find_all_links('/a/g/e', True)
-    ['/a', '/b/c', '/b/g', '/b/d/e', '/f']
+    ['/a', '/b/g', '/b/c', '/b/d/e', '/f']
     """
-    files = set()
     filename = Path(filename)
     assert filename.absolute()
-    path = find_all_links_recursive(filename, files)
-    files = list(files)
+    if resolver is None:
+        resolver = LinkResolver()
+    files = resolver.links(filename)
     if include_target:
-        files.append(path)
+        files.append(resolver.resolve(filename))
     return files
 
 
@@ -1,5 +1,7 @@
 #include <errno.h>
+#include <pthread.h>
 #include <signal.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -9,6 +11,7 @@
 
 #include "database.h"
 #include "log.h"
+#include "utils.h"
 
 #define count(x) (sizeof((x))/sizeof(*(x)))
 #define check(r) if((r) != SQLITE_OK) { goto sqlerror; }
@@ -31,19 +34,1321 @@ static sqlite3_uint64 gettime(void)
     return timestamp;
 }
 
+unsigned int db_commit_events = DB_DEFAULT_COMMIT_EVENTS;
+unsigned int db_commit_interval = DB_DEFAULT_COMMIT_INTERVAL;
+const char *db_journal_mode = NULL;
+const char *db_synchronous = DB_DEFAULT_SYNCHRONOUS;
+size_t db_queue_max_bytes = DB_DEFAULT_QUEUE_MAX_BYTES;
+int db_use_event_log = 0;
+int db_dedup_files = 0;
+
+struct DbStats db_stats;
+
 static sqlite3 *db;
-static sqlite3_stmt *stmt_last_rowid;
+static sqlite3_stmt *stmt_insert_run;
 static sqlite3_stmt *stmt_insert_process;
 static sqlite3_stmt *stmt_set_exitcode;
+static sqlite3_stmt *stmt_set_usage;
 static sqlite3_stmt *stmt_insert_file;
 static sqlite3_stmt *stmt_insert_exec;
+static sqlite3_stmt *stmt_set_occurrences;
+static sqlite3_stmt *stmt_find_path;
+static sqlite3_stmt *stmt_insert_path;
+static sqlite3_stmt *stmt_set_canonical;
+static sqlite3_stmt *stmt_delete_links;
+static sqlite3_stmt *stmt_insert_link;
+static sqlite3_stmt *stmt_find_arguments;
+static sqlite3_stmt *stmt_insert_arguments;
+static sqlite3_stmt *stmt_find_environment;
+static sqlite3_stmt *stmt_insert_environment;
+
+/* The db_add_*() functions don't write to the database: they queue events,
+ * which are inserted by a writer thread that owns the SQLite connection.
+ * That way, the tracing thread (and the traced processes) don't wait on
+ * SQLite. If the queue grows over db_queue_max_bytes, db_add_*() block until
+ * the writer catches up. */
+
+#define DB_EVENT_PROCESS    1
+#define DB_EVENT_EXIT       2
+#define DB_EVENT_FILE       3
+#define DB_EVENT_EXEC       4
+#define DB_EVENT_FILE_COUNT 5
+#define DB_EVENT_PATH       6
+#define DB_EVENT_USAGE      7
+
+struct DbEvent {
+    struct DbEvent *next;
+    size_t size;
+    int type;
+    sqlite3_uint64 timestamp;
+    unsigned int process;
+    unsigned int parent;        /* parent process, or number of occurrences
+                                 * for DB_EVENT_FILE_COUNT */
+    int value;                  /* exit code, or file mode */
+    int is_dir;
+    unsigned int file_id;       /* row in file_accesses, for DB_EVENT_FILE
+                                 * and DB_EVENT_FILE_COUNT */
+    /* Paths are interned (see utils.h), the argument and environment lists
+     * are stored after the structure */
+    unsigned int name_path;
+    const char *name;           /* file name, or executed binary */
+    const char *argv;           /* NUL-separated list */
+    size_t argv_len;
+    const char *envp;           /* NUL-separated list */
+    size_t envp_len;
+    unsigned int workingdir_path;
+    const char *workingdir;     /* also canonical path for DB_EVENT_PATH */
+};
+
+/* Links of DB_EVENT_PATH, stored after the structure (number in value); the
+ * struct ProcessUsage of DB_EVENT_USAGE is stored after it as well */
+struct PathRef {
+    unsigned int id;
+    const char *name;
+};
+
+static pthread_t writer_thread;
+static pthread_mutex_t queue_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t queue_not_empty;
+static pthread_cond_t queue_not_full;
+/* The writer is woken up when DB_WRITER_BATCH events are queued, or every
+ * DB_WRITER_WAIT milliseconds */
+#define DB_WRITER_BATCH 256
+#define DB_WRITER_WAIT  50
+
+static struct DbEvent *queue_head = NULL, *queue_tail = NULL;
+static size_t queue_bytes = 0;
+static unsigned int queue_count = 0;
+static int writer_stop = 0;
+static int writer_failed = 0;
+
+/* Process and file access identifiers are assigned here instead of by
+ * SQLite, since the rows are inserted later */
+static unsigned int next_process_id;
+static unsigned int next_file_id;
+
+/* Insertions are grouped in explicit transactions, instead of having SQLite
+ * commit (and sync to disk) each one of them */
+static int in_transaction = 0;
+static unsigned int uncommitted_events;
+static sqlite3_uint64 transaction_start;
+
+static int db_commit(void)
+{
+    if(in_transaction)
+    {
+        in_transaction = 0;
+        check(sqlite3_exec(db, "COMMIT;", NULL, NULL, NULL));
+    }
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Commit shouldn't fail */
+    log_critical(0, "sqlite3 error committing: %s", sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+/**
+ * Starts a transaction if we are not already in one.
+ *
+ * Called before every insertion.
+ */
+static int db_begin_event(sqlite3_uint64 timestamp)
+{
+    if(!in_transaction)
+    {
+        check(sqlite3_exec(db, "BEGIN IMMEDIATE;", NULL, NULL, NULL));
+        in_transaction = 1;
+        uncommitted_events = 0;
+        transaction_start = timestamp;
+    }
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Begin shouldn't fail */
+    log_critical(0, "sqlite3 error starting transaction: %s",
+                 sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+/**
+ * Commits the current transaction if it is big or old enough.
+ *
+ * Called after every insertion.
+ */
+static int db_end_event(sqlite3_uint64 timestamp)
+{
+    ++uncommitted_events;
+    if( (db_commit_events > 0 && uncommitted_events >= db_commit_events)
+     || (db_commit_interval > 0
+       && timestamp - transaction_start >=
+              (sqlite3_uint64)db_commit_interval * 1000000) )
+        return db_commit();
+    return 0;
+}
+
+static int valid_pragma_value(const char *value, const char *const *allowed)
+{
+    for(; *allowed != NULL; ++allowed)
+    {
+        if(strcmp(value, *allowed) == 0)
+            return 1;
+    }
+    return 0;
+}
+
+static int db_set_pragmas(void)
+{
+    static const char *const journal_modes[] = {
+        "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF", NULL};
+    static const char *const synchronous_modes[] = {
+        "OFF", "NORMAL", "FULL", "EXTRA", NULL};
+    char sql[64];
+
+    if(db_journal_mode != NULL)
+    {
+        if(!valid_pragma_value(db_journal_mode, journal_modes))
+        {
+            log_critical(0, "invalid journal mode %s", db_journal_mode);
+            return -1;
+        }
+        snprintf(sql, sizeof(sql), "PRAGMA journal_mode=%s;",
+                 db_journal_mode);
+        check(sqlite3_exec(db, sql, NULL, NULL, NULL));
+    }
+    if(db_synchronous != NULL)
+    {
+        if(!valid_pragma_value(db_synchronous, synchronous_modes))
+        {
+            log_critical(0, "invalid synchronous mode %s", db_synchronous);
+            return -1;
+        }
+        snprintf(sql, sizeof(sql), "PRAGMA synchronous=%s;",
+                 db_synchronous);
+        check(sqlite3_exec(db, sql, NULL, NULL, NULL));
+    }
+    return 0;
+
+sqlerror:
+    log_critical(0, "sqlite3 error setting pragmas: %s", sqlite3_errmsg(db));
+    return -1;
+}
+
+#define DB_NO_PARENT ((unsigned int)-2)
+
+/* Version of the database schema, in PRAGMA user_version
+ * 1: reprozip up to 0.6, no user_version (opened_files and executed_files
+ *    tables)
+ * 2: paths, arguments and environments tables; runs table and run_id columns
+ * 3: resource usage columns in processes
+ */
+#define DB_SCHEMA_VERSION 3
+
+/* ********************
+ * Writer thread, inserting the events in the database
+ */
+
+/* Current run, incremented by each process without a parent; only used by
+ * the writer thread */
+static sqlite3_int64 current_run = 0;
+
+static int db_write_process(const struct DbEvent *event)
+{
+    check(sqlite3_bind_int(stmt_insert_process, 1, event->process));
+    if(event->parent == DB_NO_PARENT)
+    {
+        check(sqlite3_bind_int64(stmt_insert_run, 1, event->timestamp));
+        if(sqlite3_step(stmt_insert_run) != SQLITE_DONE)
+            goto sqlerror;
+        sqlite3_reset(stmt_insert_run);
+        current_run = sqlite3_last_insert_rowid(db);
+        check(sqlite3_bind_null(stmt_insert_process, 2));
+    }
+    else
+    {
+        check(sqlite3_bind_int(stmt_insert_process, 2, event->parent));
+    }
+    /* This assumes that we won't go over 2^32 seconds (~135 years) */
+    check(sqlite3_bind_int64(stmt_insert_process, 3, event->timestamp));
+    check(sqlite3_bind_int64(stmt_insert_process, 4, current_run));
+
+    if(sqlite3_step(stmt_insert_process) != SQLITE_DONE)
+        goto sqlerror;
+    sqlite3_reset(stmt_insert_process);
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error inserting process: %s", sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+static int db_write_exit(const struct DbEvent *event)
+{
+    check(sqlite3_bind_int(stmt_set_exitcode, 1, event->value));
+    check(sqlite3_bind_int(stmt_set_exitcode, 2, event->process));
+
+    if(sqlite3_step(stmt_set_exitcode) != SQLITE_DONE)
+        goto sqlerror;
+    sqlite3_reset(stmt_set_exitcode);
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error setting exitcode: %s", sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+static int db_write_usage(const struct DbEvent *event)
+{
+    const struct ProcessUsage *usage =
+            (const struct ProcessUsage*)(event + 1);
+    check(sqlite3_bind_int64(stmt_set_usage, 1, usage->user_time));
+    check(sqlite3_bind_int64(stmt_set_usage, 2, usage->system_time));
+    check(sqlite3_bind_int64(stmt_set_usage, 3, usage->max_rss));
+    check(sqlite3_bind_int64(stmt_set_usage, 4, usage->io_read));
+    check(sqlite3_bind_int64(stmt_set_usage, 5, usage->io_written));
+    check(sqlite3_bind_int(stmt_set_usage, 6, event->process));
+
+    if(sqlite3_step(stmt_set_usage) != SQLITE_DONE)
+        goto sqlerror;
+    sqlite3_reset(stmt_set_usage);
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error setting resource usage: %s",
+                 sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+/* Rows of the paths table for the interned path ids, 0 if it hasn't been
+ * inserted yet; only used by the writer thread */
+static sqlite3_int64 *path_rows = NULL;
+static size_t path_rows_size = 0;
+/* Whether the tables had rows from previous runs */
+static int tables_existed;
+
+/* path_resolve_generation when paths were resolved and sent to the database
+ * (DB_EVENT_PATH), 0 if they weren't; a path is sent again if its resolution
+ * was invalidated since. Only used by the tracing thread */
+static unsigned int *path_announced = NULL;
+static size_t path_announced_size = 0;
+
+static int db_path_row(unsigned int path, const char *name,
+                       sqlite3_int64 *row)
+{
+    if(path >= path_rows_size)
+    {
+        size_t new_size = path_rows_size?path_rows_size:1024;
+        while(new_size <= path)
+            new_size <<= 1;
+        path_rows = realloc(path_rows, new_size * sizeof(*path_rows));
+        memset(path_rows + path_rows_size, 0,
+               (new_size - path_rows_size) * sizeof(*path_rows));
+        path_rows_size = new_size;
+    }
+    if(path_rows[path] == 0 && tables_existed)
+    {
+        /* The path might be there from a previous run */
+        int ret;
+        check(sqlite3_bind_text(stmt_find_path, 1, name, -1, SQLITE_STATIC));
+        ret = sqlite3_step(stmt_find_path);
+        if(ret == SQLITE_ROW)
+            path_rows[path] = sqlite3_column_int64(stmt_find_path, 0);
+        sqlite3_reset(stmt_find_path);
+        if(ret != SQLITE_ROW && ret != SQLITE_DONE)
+            goto sqlerror;
+    }
+    if(path_rows[path] == 0)
+    {
+        check(sqlite3_bind_text(stmt_insert_path, 1, name,
+                                -1, SQLITE_STATIC));
+        if(sqlite3_step(stmt_insert_path) != SQLITE_DONE)
+            goto sqlerror;
+        sqlite3_reset(stmt_insert_path);
+        path_rows[path] = sqlite3_last_insert_rowid(db);
+    }
+    *row = path_rows[path];
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error inserting path: %s", sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+/* ********************
+ * Argument lists and environments are stored once in the arguments and
+ * environments tables, keyed by their hash, since the same ones usually get
+ * used over and over (especially environments, that can be large).
+ */
+
+struct BlobEntry {
+    struct BlobEntry *next;
+    sqlite3_uint64 hash;
+    sqlite3_int64 row;
+    size_t len;
+    /* Data is stored after the structure */
+};
+
+struct BlobTable {
+    const char *name;
+    sqlite3_stmt **stmt_find;
+    sqlite3_stmt **stmt_insert;
+    struct BlobEntry **buckets;
+    size_t size;
+    size_t count;
+};
+
+static struct BlobTable arguments_table = {
+    "arguments", &stmt_find_arguments, &stmt_insert_arguments, NULL, 0, 0};
+static struct BlobTable environments_table = {
+    "environments", &stmt_find_environment, &stmt_insert_environment,
+    NULL, 0, 0};
+
+/* FNV-1a */
+static sqlite3_uint64 blob_hash(const char *data, size_t len)
+{
+    sqlite3_uint64 hash = (sqlite3_uint64)0xcbf29ce484222325;
+    const unsigned char *p = (const unsigned char*)data;
+    const unsigned char *end = p + len;
+    for(; p < end; ++p)
+    {
+        hash ^= *p;
+        hash *= (sqlite3_uint64)0x100000001b3;
+    }
+    return hash;
+}
+
+/* SQL function reprozip_hash(), used when upgrading older databases */
+static void sql_blob_hash(sqlite3_context *context, int argc,
+                          sqlite3_value **argv)
+{
+    const char *data = sqlite3_value_blob(argv[0]);
+    size_t len = sqlite3_value_bytes(argv[0]);
+    sqlite3_result_int64(context, (sqlite3_int64)blob_hash(data, len));
+}
+
+static void blob_table_grow(struct BlobTable *table)
+{
+    size_t new_size = table->size?table->size * 2:256;
+    struct BlobEntry **new_buckets = calloc(new_size, sizeof(*new_buckets));
+    size_t i;
+    for(i = 0; i < table->size; ++i)
+    {
+        struct BlobEntry *entry = table->buckets[i];
+        while(entry != NULL)
+        {
+            struct BlobEntry *next = entry->next;
+            size_t b = entry->hash & (new_size - 1);
+            entry->next = new_buckets[b];
+            new_buckets[b] = entry;
+            entry = next;
+        }
+    }
+    free(table->buckets);
+    table->buckets = new_buckets;
+    table->size = new_size;
+}
+
+static void blob_table_clear(struct BlobTable *table)
+{
+    size_t i;
+    for(i = 0; i < table->size; ++i)
+    {
+        struct BlobEntry *entry = table->buckets[i];
+        while(entry != NULL)
+        {
+            struct BlobEntry *next = entry->next;
+            free(entry);
+            entry = next;
+        }
+    }
+    free(table->buckets);
+    table->buckets = NULL;
+    table->size = table->count = 0;
+}
+
+static int db_blob_row(struct BlobTable *table, const char *data, size_t len,
+                       sqlite3_int64 *row)
+{
+    sqlite3_uint64 hash = blob_hash(data, len);
+    struct BlobEntry *entry;
+    sqlite3_stmt *stmt;
+
+    if(table->count >= table->size)
+        blob_table_grow(table);
+    for(entry = table->buckets[hash & (table->size - 1)]; entry != NULL;
+        entry = entry->next)
+    {
+        if(entry->hash == hash && entry->len == len
+         && memcmp(entry + 1, data, len) == 0)
+        {
+            *row = entry->row;
+            return 0;
+        }
+    }
+
+    *row = 0;
+    if(tables_existed)
+    {
+        /* It might be there from a previous run */
+        int ret;
+        stmt = *table->stmt_find;
+        check(sqlite3_bind_int64(stmt, 1, (sqlite3_int64)hash));
+        check(sqlite3_bind_text(stmt, 2, data, len, SQLITE_STATIC));
+        ret = sqlite3_step(stmt);
+        if(ret == SQLITE_ROW)
+            *row = sqlite3_column_int64(stmt, 0);
+        sqlite3_reset(stmt);
+        if(ret != SQLITE_ROW && ret != SQLITE_DONE)
+            goto sqlerror;
+    }
+    if(*row == 0)
+    {
+        stmt = *table->stmt_insert;
+        check(sqlite3_bind_int64(stmt, 1, (sqlite3_int64)hash));
+        check(sqlite3_bind_text(stmt, 2, data, len, SQLITE_STATIC));
+        if(sqlite3_step(stmt) != SQLITE_DONE)
+            goto sqlerror;
+        sqlite3_reset(stmt);
+        *row = sqlite3_last_insert_rowid(db);
+    }
+
+    entry = malloc(sizeof(*entry) + len);
+    entry->hash = hash;
+    entry->row = *row;
+    entry->len = len;
+    memcpy(entry + 1, data, len);
+    entry->next = table->buckets[hash & (table->size - 1)];
+    table->buckets[hash & (table->size - 1)] = entry;
+    ++table->count;
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error inserting into %s: %s", table->name,
+                 sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+static int db_write_path(const struct DbEvent *event)
+{
+    const struct PathRef *links = (const struct PathRef*)(event + 1);
+    sqlite3_int64 path, canonical, link;
+    int i;
+    if(db_path_row(event->name_path, event->name, &path) != 0
+     || db_path_row(event->workingdir_path, event->workingdir,
+                    &canonical) != 0)
+        return -1;
+    check(sqlite3_bind_int64(stmt_set_canonical, 1, canonical));
+    check(sqlite3_bind_int64(stmt_set_canonical, 2, path));
+    if(sqlite3_step(stmt_set_canonical) != SQLITE_DONE)
+        goto sqlerror;
+    sqlite3_reset(stmt_set_canonical);
+
+    if(tables_existed)
+    {
+        /* Replaces the links found by a previous run */
+        check(sqlite3_bind_int64(stmt_delete_links, 1, path));
+        if(sqlite3_step(stmt_delete_links) != SQLITE_DONE)
+            goto sqlerror;
+        sqlite3_reset(stmt_delete_links);
+    }
+    for(i = 0; i < event->value; ++i)
+    {
+        if(db_path_row(links[i].id, links[i].name, &link) != 0)
+            return -1;
+        check(sqlite3_bind_int64(stmt_insert_link, 1, path));
+        check(sqlite3_bind_int64(stmt_insert_link, 2, link));
+        if(sqlite3_step(stmt_insert_link) != SQLITE_DONE)
+            goto sqlerror;
+        sqlite3_reset(stmt_insert_link);
+    }
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error inserting path links: %s",
+                 sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+static int db_write_file_open(const struct DbEvent *event)
+{
+    sqlite3_int64 path;
+    if(db_path_row(event->name_path, event->name, &path) != 0)
+        return -1;
+    check(sqlite3_bind_int64(stmt_insert_file, 1, path));
+    /* This assumes that we won't go over 2^32 seconds (~135 years) */
+    check(sqlite3_bind_int64(stmt_insert_file, 2, event->timestamp));
+    check(sqlite3_bind_int(stmt_insert_file, 3, event->value));
+    check(sqlite3_bind_int(stmt_insert_file, 4, event->is_dir));
+    check(sqlite3_bind_int(stmt_insert_file, 5, event->process));
+    check(sqlite3_bind_int64(stmt_insert_file, 6, current_run));
+    check(sqlite3_bind_int64(stmt_insert_file, 7, event->file_id));
+
+    if(sqlite3_step(stmt_insert_file) != SQLITE_DONE)
+        goto sqlerror;
+    sqlite3_reset(stmt_insert_file);
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error inserting file: %s", sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+static int db_write_file_count(const struct DbEvent *event)
+{
+    check(sqlite3_bind_int64(stmt_set_occurrences, 1, event->parent));
+    check(sqlite3_bind_int64(stmt_set_occurrences, 2, event->file_id));
+
+    if(sqlite3_step(stmt_set_occurrences) != SQLITE_DONE)
+        goto sqlerror;
+    sqlite3_reset(stmt_set_occurrences);
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error setting occurrences: %s",
+                 sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+static int db_write_exec(const struct DbEvent *event)
+{
+    sqlite3_int64 path, workingdir, argv, envp;
+    if(db_path_row(event->name_path, event->name, &path) != 0
+     || db_path_row(event->workingdir_path, event->workingdir,
+                    &workingdir) != 0
+     || db_blob_row(&arguments_table, event->argv, event->argv_len,
+                    &argv) != 0
+     || db_blob_row(&environments_table, event->envp, event->envp_len,
+                    &envp) != 0)
+        return -1;
+    check(sqlite3_bind_int64(stmt_insert_exec, 1, path));
+    /* This assumes that we won't go over 2^32 seconds (~135 years) */
+    check(sqlite3_bind_int64(stmt_insert_exec, 2, event->timestamp));
+    check(sqlite3_bind_int(stmt_insert_exec, 3, event->process));
+    check(sqlite3_bind_int64(stmt_insert_exec, 4, argv));
+    check(sqlite3_bind_int64(stmt_insert_exec, 5, envp));
+    check(sqlite3_bind_int64(stmt_insert_exec, 6, workingdir));
+    check(sqlite3_bind_int64(stmt_insert_exec, 7, current_run));
+
+    if(sqlite3_step(stmt_insert_exec) != SQLITE_DONE)
+        goto sqlerror;
+    sqlite3_reset(stmt_insert_exec);
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Insertions shouldn't fail */
+    log_critical(0, "sqlite3 error inserting exec: %s", sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+static void db_count_latency(sqlite3_uint64 start)
+{
+    sqlite3_uint64 us = (gettime() - start) / 1000;
+    size_t bucket = 0;
+    while(us > 0 && bucket < DB_LATENCY_BUCKETS - 1)
+    {
+        us >>= 1;
+        ++bucket;
+    }
+    ++db_stats.insert_latency[bucket];
+    ++db_stats.events;
+}
+
+static int db_write_event(const struct DbEvent *event)
+{
+    int ret = -1;
+    sqlite3_uint64 start = gettime();
+    if(db_begin_event(event->timestamp) != 0)
+        return -1;
+    switch(event->type)
+    {
+    case DB_EVENT_PROCESS:
+        ret = db_write_process(event);
+        break;
+    case DB_EVENT_EXIT:
+        ret = db_write_exit(event);
+        break;
+    case DB_EVENT_FILE:
+        ret = db_write_file_open(event);
+        break;
+    case DB_EVENT_EXEC:
+        ret = db_write_exec(event);
+        break;
+    case DB_EVENT_FILE_COUNT:
+        ret = db_write_file_count(event);
+        break;
+    case DB_EVENT_PATH:
+        ret = db_write_path(event);
+        break;
+    case DB_EVENT_USAGE:
+        ret = db_write_usage(event);
+        break;
+    }
+    if(ret != 0)
+        return -1;
+    ret = db_end_event(event->timestamp);
+    db_count_latency(start);
+    return ret;
+}
+
+static void *db_writer(void *arg)
+{
+    (void)arg;
+    pthread_mutex_lock(&queue_mutex);
+    for(;;)
+    {
+        struct DbEvent *events;
+        size_t batch_bytes = 0;
+        int failed = 0;
+
+        /* Waits for a batch of events to accumulate, instead of waking up for
+         * each one of them */
+        if(queue_count < DB_WRITER_BATCH && !writer_stop)
+        {
+            sqlite3_uint64 deadline = gettime() + DB_WRITER_WAIT * 1000000;
+            struct timespec ts;
+            ts.tv_sec = deadline / 1000000000;
+            ts.tv_nsec = deadline % 1000000000;
+            pthread_cond_timedwait(&queue_not_empty, &queue_mutex, &ts);
+        }
+
+        if(queue_head == NULL)
+        {
+            if(writer_stop)
+                break;
+            /* Commits if nothing happened for the interval */
+            if(in_transaction && db_commit_interval > 0
+             && gettime() - transaction_start >=
+                    (sqlite3_uint64)db_commit_interval * 1000000)
+            {
+                pthread_mutex_unlock(&queue_mutex);
+                failed = db_commit() != 0;
+                pthread_mutex_lock(&queue_mutex);
+            }
+        }
+        else
+        {
+            /* Takes all the queued events */
+            events = queue_head;
+            queue_head = queue_tail = NULL;
+            queue_count = 0;
+            pthread_mutex_unlock(&queue_mutex);
+
+            while(events != NULL)
+            {
+                struct DbEvent *next = events->next;
+                if(!failed && db_write_event(events) != 0)
+                    failed = 1;
+                batch_bytes += events->size;
+                free(events);
+                events = next;
+            }
+
+            pthread_mutex_lock(&queue_mutex);
+            queue_bytes -= batch_bytes;
+            pthread_cond_broadcast(&queue_not_full);
+        }
+        if(failed)
+        {
+            writer_failed = 1;
+            pthread_cond_broadcast(&queue_not_full);
+            break;
+        }
+    }
+    pthread_mutex_unlock(&queue_mutex);
+    return NULL;
+}
+
+static int db_start_writer(void)
+{
+    int ret;
+    {
+        /* Timeouts use the same clock as event timestamps */
+        pthread_condattr_t attr;
+        pthread_condattr_init(&attr);
+        pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+        pthread_cond_init(&queue_not_empty, &attr);
+        pthread_condattr_destroy(&attr);
+        pthread_cond_init(&queue_not_full, NULL);
+    }
+    {
+        /* Signals (SIGINT, SIGCHLD) are delivered to the tracing thread */
+        sigset_t all, old;
+        sigfillset(&all);
+        pthread_sigmask(SIG_SETMASK, &all, &old);
+        ret = pthread_create(&writer_thread, NULL, db_writer, NULL);
+        pthread_sigmask(SIG_SETMASK, &old, NULL);
+    }
+    if(ret != 0)
+    {
+        /* LCOV_EXCL_START : Creating a thread shouldn't fail */
+        log_critical(0, "couldn't start database thread: %s",
+                     strerror(ret));
+        return -1;
+        /* LCOV_EXCL_END */
+    }
+    return 0;
+}
+
+
+/* ********************
+ * Event log, an alternative output that db_load_event_log() later inserts in
+ * the database
+ */
+
+/* The file starts with this magic, followed by records that each have this
+ * fixed-size header, followed by the event's strings (the same layout as in
+ * struct DbEvent). Integers are in native byte order. */
+#define EVENT_LOG_MAGIC "RPZEVLOG"
+#define EVENT_LOG_MAGIC_LEN 8
+#define EVENT_LOG_BUFFER (1024 * 1024)
+
+struct EventLogRecord {
+    uint32_t length;            /* including this header */
+    uint32_t type;
+    uint64_t timestamp;
+    uint32_t process;
+    uint32_t parent;
+    int32_t value;
+    uint32_t is_dir;
+    uint32_t argv_len;
+    uint32_t envp_len;
+    uint32_t file_id;
+};
+
+static FILE *event_log = NULL;
+static char *event_log_buffer = NULL;
+
+static int event_log_open(const char *filename)
+{
+    event_log = fopen(filename, "wb");
+    if(event_log == NULL)
+    {
+        log_critical(0, "couldn't open event log %s: %s", filename,
+                     strerror(errno));
+        return -1;
+    }
+    /* Large buffered writes */
+    event_log_buffer = malloc(EVENT_LOG_BUFFER);
+    setvbuf(event_log, event_log_buffer, _IOFBF, EVENT_LOG_BUFFER);
+    if(fwrite(EVENT_LOG_MAGIC, EVENT_LOG_MAGIC_LEN, 1, event_log) != 1)
+    {
+        /* LCOV_EXCL_START : Writes shouldn't fail */
+        log_critical(0, "couldn't write to event log: %s", strerror(errno));
+        return -1;
+        /* LCOV_EXCL_END */
+    }
+    next_process_id = 1;
+    next_file_id = 1;
+    return 0;
+}
+
+static int event_log_close(void)
+{
+    int ret = fclose(event_log);
+    event_log = NULL;
+    free(event_log_buffer);
+    event_log_buffer = NULL;
+    if(ret != 0)
+    {
+        /* LCOV_EXCL_START : Writes shouldn't fail */
+        log_critical(0, "couldn't write to event log: %s", strerror(errno));
+        return -1;
+        /* LCOV_EXCL_END */
+    }
+    return 0;
+}
+
+static int event_log_write(const struct DbEvent *event)
+{
+    struct EventLogRecord record;
+    size_t strings_size = event->size - sizeof(struct DbEvent);
+    size_t name_size = 0, workingdir_size = 0;
+    /* Paths are interned, not stored after the event; the record has them
+     * inline: name, argument and environment lists, working directory (or
+     * name, canonical path, links for DB_EVENT_PATH) */
+    if(event->type == DB_EVENT_PATH)
+    {
+        const struct PathRef *links = (const struct PathRef*)(event + 1);
+        int i;
+        strings_size = 0;
+        for(i = 0; i < event->value; ++i)
+            strings_size += strlen(links[i].name) + 1;
+    }
+    if(event->type == DB_EVENT_FILE || event->type == DB_EVENT_EXEC
+     || event->type == DB_EVENT_PATH)
+        name_size = strlen(event->name) + 1;
+    if(event->type == DB_EVENT_EXEC || event->type == DB_EVENT_PATH)
+        workingdir_size = strlen(event->workingdir) + 1;
+    record.length = sizeof(record) + name_size + strings_size
+                  + workingdir_size;
+    record.type = event->type;
+    record.timestamp = event->timestamp;
+    record.process = event->process;
+    record.parent = event->parent;
+    record.value = event->value;
+    record.is_dir = event->is_dir;
+    record.argv_len = event->argv_len;
+    record.envp_len = event->envp_len;
+    record.file_id = event->file_id;
+    if(event->type == DB_EVENT_PATH)
+    {
+        const struct PathRef *links = (const struct PathRef*)(event + 1);
+        int i;
+        if(fwrite(&record, sizeof(record), 1, event_log) != 1
+         || fwrite(event->name, name_size, 1, event_log) != 1
+         || fwrite(event->workingdir, workingdir_size, 1, event_log) != 1)
+            goto ioerror;
+        for(i = 0; i < event->value; ++i)
+            if(fwrite(links[i].name, strlen(links[i].name) + 1, 1,
+                      event_log) != 1)
+                goto ioerror;
+    }
+    else if(fwrite(&record, sizeof(record), 1, event_log) != 1
+     || (name_size > 0
+       && fwrite(event->name, name_size, 1, event_log) != 1)
+     || (strings_size > 0
+       && fwrite(event + 1, strings_size, 1, event_log) != 1)
+     || (workingdir_size > 0
+       && fwrite(event->workingdir, workingdir_size, 1, event_log) != 1))
+    {
+    ioerror:
+        /* LCOV_EXCL_START : Writes shouldn't fail */
+        log_critical(0, "couldn't write to event log: %s", strerror(errno));
+        return -1;
+        /* LCOV_EXCL_END */
+    }
+    return 0;
+}
+
+
+/* ********************
+ * Deduplication of file accesses: with db_dedup_files, only the first access
+ * of a process to a path with a given mode is recorded; later ones only
+ * increment a counter, which db_close() writes to the occurrences column.
+ */
+
+struct SeenFile {
+    struct SeenFile *next;
+    unsigned int process;
+    unsigned int path;
+    unsigned int mode;
+    unsigned int file_id;       /* the row recording the first access */
+    unsigned long count;
+};
+
+#define SEEN_FILES_INITIAL_SIZE 1024
+
+static struct SeenFile **seen_files = NULL;
+static size_t seen_files_size = 0;
+static size_t seen_files_count = 0;
+
+static size_t seen_file_hash(unsigned int process, unsigned int path,
+                             unsigned int mode)
+{
+    return ((path * 31 + process) * 31 + mode) & (seen_files_size - 1);
+}
+
+static void seen_files_grow(void)
+{
+    struct SeenFile **old_table = seen_files;
+    size_t old_size = seen_files_size;
+    size_t i;
+    size_t new_size = old_size?old_size * 2:SEEN_FILES_INITIAL_SIZE;
+    struct SeenFile **new_table = calloc(new_size, sizeof(*new_table));
+    if(new_table == NULL)
+        return; /* LCOV_EXCL_LINE : keep using the current table */
+    seen_files = new_table;
+    seen_files_size = new_size;
+    for(i = 0; i < old_size; ++i)
+    {
+        struct SeenFile *entry = old_table[i];
+        while(entry != NULL)
+        {
+            struct SeenFile *next = entry->next;
+            size_t h = seen_file_hash(entry->process, entry->path,
+                                      entry->mode);
+            entry->next = new_table[h];
+            new_table[h] = entry;
+            entry = next;
+        }
+    }
+    free(old_table);
+}
+
+/**
+ * Counts an access, returns 1 if it was seen before and shouldn't be
+ * recorded. Otherwise, it will be recorded as file_id.
+ */
+static int db_file_seen(unsigned int process, unsigned int path,
+                        unsigned int mode, unsigned int file_id)
+{
+    struct SeenFile *entry;
+    if(seen_files_count >= seen_files_size)
+        seen_files_grow();
+    if(seen_files_size == 0)
+        return 0; /* LCOV_EXCL_LINE */
+    for(entry = seen_files[seen_file_hash(process, path, mode)];
+        entry != NULL;
+        entry = entry->next)
+    {
+        if(entry->process == process && entry->path == path
+         && entry->mode == mode)
+        {
+            ++entry->count;
+            return 1;
+        }
+    }
+    entry = malloc(sizeof(*entry));
+    if(entry != NULL)
+    {
+        size_t h = seen_file_hash(process, path, mode);
+        entry->process = process;
+        entry->path = path;
+        entry->mode = mode;
+        entry->file_id = file_id;
+        entry->count = 1;
+        entry->next = seen_files[h];
+        seen_files[h] = entry;
+        ++seen_files_count;
+    }
+    return 0;
+}
+
+static int db_queue_event(struct DbEvent *event);
+static struct DbEvent *db_new_event(int type, unsigned int process,
+                                    size_t data_size);
+
+/**
+ * Records the number of occurrences of the deduplicated accesses, and
+ * forgets them.
+ */
+static int db_flush_seen_files(void)
+{
+    size_t i;
+    int ret = 0;
+    for(i = 0; i < seen_files_size; ++i)
+    {
+        struct SeenFile *entry = seen_files[i];
+        while(entry != NULL)
+        {
+            struct SeenFile *next = entry->next;
+            if(ret == 0 && entry->count > 1)
+            {
+                struct DbEvent *event = db_new_event(DB_EVENT_FILE_COUNT,
+                                                     entry->process, 0);
+                event->file_id = entry->file_id;
+                event->parent = entry->count > 0xFFFFFFFFul?
+                        0xFFFFFFFFu:(unsigned int)entry->count;
+                if(db_queue_event(event) != 0)
+                    ret = -1;
+            }
+            free(entry);
+            entry = next;
+        }
+    }
+    free(seen_files);
+    seen_files = NULL;
+    seen_files_size = 0;
+    seen_files_count = 0;
+    return ret;
+}
+
+
+/* Paths are stored once in the paths table, and referenced by id from
+ * file_accesses and executions. The opened_files and executed_files views
+ * present these tables the way they were stored before 0.7. */
+
+static const char *const schema_tables[] = {
+    "CREATE TABLE runs("
+    "    id INTEGER NOT NULL PRIMARY KEY,"
+    "    timestamp INTEGER NOT NULL"
+    "    );",
+    "CREATE TABLE processes("
+    "    id INTEGER NOT NULL PRIMARY KEY,"
+    "    run_id INTEGER NOT NULL,"
+    "    parent INTEGER,"
+    "    timestamp INTEGER NOT NULL,"
+    "    exitcode INTEGER,"
+    "    user_time INTEGER,"
+    "    system_time INTEGER,"
+    "    max_rss INTEGER,"
+    "    io_read INTEGER,"
+    "    io_written INTEGER"
+    "    );",
+    "CREATE INDEX proc_parent_idx ON processes(parent);",
+    "CREATE INDEX proc_run_idx ON processes(run_id);",
+    "CREATE TABLE paths("
+    "    id INTEGER NOT NULL PRIMARY KEY,"
+    "    path TEXT NOT NULL,"
+    "    canonical INTEGER"
+    "    );",
+    "CREATE UNIQUE INDEX paths_path_idx ON paths(path);",
+    "CREATE TABLE path_links("
+    "    path INTEGER NOT NULL,"
+    "    link INTEGER NOT NULL"
+    "    );",
+    "CREATE UNIQUE INDEX path_links_idx ON path_links(path, link);",
+    "CREATE TABLE file_accesses("
+    "    id INTEGER NOT NULL PRIMARY KEY,"
+    "    run_id INTEGER NOT NULL,"
+    "    path INTEGER NOT NULL,"
+    "    timestamp INTEGER NOT NULL,"
+    "    mode INTEGER NOT NULL,"
+    "    is_directory BOOLEAN NOT NULL,"
+    "    process INTEGER NOT NULL,"
+    "    occurrences INTEGER NOT NULL DEFAULT 1"
+    "    );",
+    "CREATE INDEX file_access_proc_idx ON file_accesses(process, id);",
+    "CREATE INDEX file_access_time_idx ON file_accesses(timestamp);",
+    "CREATE TABLE arguments("
+    "    id INTEGER NOT NULL PRIMARY KEY,"
+    "    hash INTEGER NOT NULL,"
+    "    argv TEXT NOT NULL"
+    "    );",
+    "CREATE INDEX arguments_hash_idx ON arguments(hash);",
+    "CREATE TABLE environments("
+    "    id INTEGER NOT NULL PRIMARY KEY,"
+    "    hash INTEGER NOT NULL,"
+    "    envp TEXT NOT NULL"
+    "    );",
+    "CREATE INDEX environments_hash_idx ON environments(hash);",
+    "CREATE TABLE executions("
+    "    id INTEGER NOT NULL PRIMARY KEY,"
+    "    run_id INTEGER NOT NULL,"
+    "    path INTEGER NOT NULL,"
+    "    timestamp INTEGER NOT NULL,"
+    "    process INTEGER NOT NULL,"
+    "    argv INTEGER NOT NULL,"
+    "    envp INTEGER NOT NULL,"
+    "    workingdir INTEGER NOT NULL"
+    "    );",
+    "CREATE INDEX execution_proc_idx ON executions(process, id);",
+    "CREATE INDEX execution_time_idx ON executions(timestamp);",
+};
+
+static const char *const schema_views[] = {
+    "CREATE VIEW opened_files AS"
+    "    SELECT f.id AS id, p.path AS name, f.timestamp AS timestamp,"
+    "        f.mode AS mode, f.is_directory AS is_directory,"
+    "        f.process AS process, f.occurrences AS occurrences,"
+    "        f.run_id AS run_id"
+    "    FROM file_accesses f"
+    "    JOIN paths p ON p.id=f.path;",
+    "CREATE VIEW executed_files AS"
+    "    SELECT e.id AS id, p.path AS name, e.timestamp AS timestamp,"
+    "        e.process AS process, a.argv AS argv, v.envp AS envp,"
+    "        w.path AS workingdir, e.run_id AS run_id"
+    "    FROM executions e"
+    "    JOIN paths p ON p.id=e.path"
+    "    JOIN arguments a ON a.id=e.argv"
+    "    JOIN environments v ON v.id=e.envp"
+    "    JOIN paths w ON w.id=e.workingdir;",
+};
+
+static int db_set_schema_version(void)
+{
+    char sql[64];
+    sprintf(sql, "PRAGMA user_version=%d;", DB_SCHEMA_VERSION);
+    check(sqlite3_exec(db, sql, NULL, NULL, NULL));
+    return 0;
+
+sqlerror:
+    /* LCOV_EXCL_START : Shouldn't fail */
+    log_critical(0, "sqlite3 error setting schema version: %s",
+                 sqlite3_errmsg(db));
+    return -1;
+    /* LCOV_EXCL_END */
+}
+
+/**
+ * Moves the rows from the tables of schema version 1 (reprozip 0.6 and
+ * earlier) to the current schema.
+ *
+ * Processes are assigned to runs by following the numbering: each run starts
+ * with a process without parent, and has the following ids.
+ */
+static int db_migrate_v1(void)
+{
+    static const char *const sql[] = {
+        "INSERT INTO runs(id, timestamp)"
+        "    SELECT (SELECT COUNT(*) FROM old_processes r"
+        "            WHERE r.parent ISNULL AND r.id <= p.id),"
+        "        p.timestamp"
+        "    FROM old_processes p"
+        "    WHERE p.parent ISNULL;",
+        "INSERT INTO processes(id, run_id, parent, timestamp, exitcode)"
+        "    SELECT p.id,"
+        "        (SELECT COUNT(*) FROM old_processes r"
+        "         WHERE r.parent ISNULL AND r.id <= p.id),"
+        "        p.parent, p.timestamp, p.exitcode"
+        "    FROM old_processes p;",
+        "INSERT OR IGNORE INTO paths(path)"
+        "    SELECT name FROM opened_files"
+        "    UNION SELECT name FROM executed_files"
+        "    UNION SELECT workingdir FROM executed_files;",
+        "INSERT INTO file_accesses(id, run_id, path, timestamp, mode,"
+        "        is_directory, process, occurrences)"
+        "    SELECT f.id, pr.run_id, p.id, f.timestamp, f.mode,"
+        "        f.is_directory, f.process, f.occurrences"
+        "    FROM opened_files f"
+        "    JOIN processes pr ON pr.id=f.process"
+        "    JOIN paths p ON p.path=f.name;",
+        "INSERT INTO arguments(hash, argv)"
+        "    SELECT reprozip_hash(argv), argv FROM executed_files"
+        "    GROUP BY argv;",
+        "INSERT INTO environments(hash, envp)"
+        "    SELECT reprozip_hash(envp), envp FROM executed_files"
+        "    GROUP BY envp;",
+        "INSERT INTO executions(id, run_id, path, timestamp, process, argv,"
+        "        envp, workingdir)"
+        "    SELECT e.id, pr.run_id, p.id, e.timestamp, e.process, a.id,"
+        "        v.id, w.id"
+        "    FROM executed_files e"
+        "    JOIN processes pr ON pr.id=e.process"
+        "    JOIN paths p ON p.path=e.name"
+        "    JOIN arguments a"
+        "        ON a.hash=reprozip_hash(e.argv) AND a.argv=e.argv"
+        "    JOIN environments v"
+        "        ON v.hash=reprozip_hash(e.envp) AND v.envp=e.envp"
+        "    JOIN paths w ON w.path=e.workingdir;",
+        "DROP TABLE old_processes;",
+        "DROP TABLE opened_files;",
+        "DROP TABLE executed_files;",
+    };
+    size_t i;
+    int ret;
+    int has_occurrences = 0;
+
+    {
+        /* Databases from older versions don't count occurrences */
+        const char *sql = "PRAGMA table_info(opened_files);";
+        sqlite3_stmt *stmt_get_columns;
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_get_columns, NULL));
+        while((ret = sqlite3_step(stmt_get_columns)) == SQLITE_ROW)
+        {
+            const char *colname = (const char*)sqlite3_column_text(
+                    stmt_get_columns, 1);
+            if(strcmp("occurrences", colname) == 0)
+                has_occurrences = 1;
+        }
+        sqlite3_finalize(stmt_get_columns);
+        if(ret != SQLITE_DONE)
+            goto sqlerror;
+    }
+
+    log_info(0, "upgrading database to schema version %d",
+             DB_SCHEMA_VERSION);
+    check(sqlite3_exec(db, "BEGIN IMMEDIATE;", NULL, NULL, NULL));
+    if(!has_occurrences)
+        check(sqlite3_exec(db,
+                           "ALTER TABLE opened_files ADD COLUMN "
+                           "occurrences INTEGER NOT NULL DEFAULT 1;",
+                           NULL, NULL, NULL));
+    /* The processes table gets replaced, and the new one uses the same
+     * index name */
+    check(sqlite3_exec(db, "DROP INDEX IF EXISTS proc_parent_idx;",
+                       NULL, NULL, NULL));
+    check(sqlite3_exec(db, "ALTER TABLE processes RENAME TO old_processes;",
+                       NULL, NULL, NULL));
+    for(i = 0; i < count(schema_tables); ++i)
+        check(sqlite3_exec(db, schema_tables[i], NULL, NULL, NULL));
+    for(i = 0; i < count(sql); ++i)
+        check(sqlite3_exec(db, sql[i], NULL, NULL, NULL));
+    for(i = 0; i < count(schema_views); ++i)
+        check(sqlite3_exec(db, schema_views[i], NULL, NULL, NULL));
+    if(db_set_schema_version() != 0)
+        goto sqlerror;
+    check(sqlite3_exec(db, "COMMIT;", NULL, NULL, NULL));
+    return 0;
+
+sqlerror:
+    log_critical(0, "sqlite3 error upgrading database: %s",
+                 sqlite3_errmsg(db));
+    sqlite3_exec(db, "ROLLBACK;", NULL, NULL, NULL);
+    return -1;
+}
+
+/**
+ * Adds the resource usage columns of schema version 3 to the processes table.
+ */
+static int db_migrate_v2(void)
+{
+    static const char *const sql[] = {
+        "ALTER TABLE processes ADD COLUMN user_time INTEGER;",
+        "ALTER TABLE processes ADD COLUMN system_time INTEGER;",
+        "ALTER TABLE processes ADD COLUMN max_rss INTEGER;",
+        "ALTER TABLE processes ADD COLUMN io_read INTEGER;",
+        "ALTER TABLE processes ADD COLUMN io_written INTEGER;",
+    };
+    size_t i;
+
+    log_info(0, "upgrading database to schema version %d",
+             DB_SCHEMA_VERSION);
+    check(sqlite3_exec(db, "BEGIN IMMEDIATE;", NULL, NULL, NULL));
+    for(i = 0; i < count(sql); ++i)
+        check(sqlite3_exec(db, sql[i], NULL, NULL, NULL));
+    if(db_set_schema_version() != 0)
+        goto sqlerror;
+    check(sqlite3_exec(db, "COMMIT;", NULL, NULL, NULL));
+    return 0;
+
+sqlerror:
+    log_critical(0, "sqlite3 error upgrading database: %s",
+                 sqlite3_errmsg(db));
+    sqlite3_exec(db, "ROLLBACK;", NULL, NULL, NULL);
+    return -1;
+}
 
 int db_init(const char *filename)
 {
     int tables_exist;
+    int version;
+
+    memset(&db_stats, 0, sizeof(db_stats));
+
+    if(db_use_event_log)
+        return event_log_open(filename);
 
     check(sqlite3_open(filename, &db));
 
+    if(db_set_pragmas() != 0)
+        return -1;
+
+    check(sqlite3_create_function(db, "reprozip_hash", 1, SQLITE_UTF8, NULL,
+                                  sql_blob_hash, NULL, NULL));
+
+    {
+        const char *sql = "PRAGMA user_version;";
+        sqlite3_stmt *stmt_get_version;
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_get_version, NULL));
+        if(sqlite3_step(stmt_get_version) != SQLITE_ROW)
+        {
+            sqlite3_finalize(stmt_get_version);
+            goto sqlerror;
+        }
+        version = sqlite3_column_int(stmt_get_version, 0);
+        sqlite3_finalize(stmt_get_version);
+    }
+
     {
         int ret;
         const char *sql = ""
@@ -62,69 +1367,108 @@ int db_init(const char *filename)
                 found |= 0x02;
             else if(strcmp("executed_files", colname) == 0)
                 found |= 0x04;
+            else if(strcmp("paths", colname) == 0)
+                found |= 0x08;
+            else if(strcmp("file_accesses", colname) == 0)
+                found |= 0x10;
+            else if(strcmp("executions", colname) == 0)
+                found |= 0x20;
+            else if(strcmp("arguments", colname) == 0)
+                found |= 0x40;
+            else if(strcmp("environments", colname) == 0)
+                found |= 0x80;
+            else if(strcmp("runs", colname) == 0)
+                found |= 0x100;
+            else if(strcmp("path_links", colname) == 0)
+                found |= 0x200;
             else
                 goto wrongschema;
         }
-        if(found == 0x00)
+        sqlite3_finalize(stmt_get_tables);
+        if(ret != SQLITE_DONE)
+            goto sqlerror;
+        if(version > DB_SCHEMA_VERSION)
+        {
+            log_critical(0, "database was created by a newer version of "
+                         "reprozip (schema version %d)", version);
+            return -1;
+        }
+        else if(found == 0x00)
             tables_exist = 0;
-        else if(found == 0x07)
+        else if(version == DB_SCHEMA_VERSION && found == 0x3F9)
+            tables_exist = 1;
+        else if(version == 2 && found == 0x3F9)
+        {
+            if(db_migrate_v2() != 0)
+                return -1;
+            tables_exist = 1;
+        }
+        else if(version == 0 && found == 0x07)
+        {
+            /* Database from reprozip 0.6 or earlier */
+            if(db_migrate_v1() != 0)
+                return -1;
             tables_exist = 1;
+        }
         else
         {
         wrongschema:
             log_critical(0, "database schema is wrong");
             return -1;
         }
-        sqlite3_finalize(stmt_get_tables);
-        if(ret != SQLITE_DONE)
-            goto sqlerror;
     }
 
     if(!tables_exist)
     {
-        const char *sql[] = {
-            "CREATE TABLE processes("
-            "    id INTEGER NOT NULL PRIMARY KEY,"
-            "    parent INTEGER,"
-            "    timestamp INTEGER NOT NULL,"
-            "    exitcode INTEGER"
-            "    );",
-            "CREATE INDEX proc_parent_idx ON processes(parent);",
-            "CREATE TABLE opened_files("
-            "    id INTEGER NOT NULL PRIMARY KEY,"
-            "    name TEXT NOT NULL,"
-            "    timestamp INTEGER NOT NULL,"
-            "    mode INTEGER NOT NULL,"
-            "    is_directory BOOLEAN NOT NULL,"
-            "    process INTEGER NOT NULL"
-            "    );",
-            "CREATE INDEX open_proc_idx ON opened_files(process);",
-            "CREATE TABLE executed_files("
-            "    id INTEGER NOT NULL PRIMARY KEY,"
-            "    name TEXT NOT NULL,"
-            "    timestamp INTEGER NOT NULL,"
-            "    process INTEGER NOT NULL,"
-            "    argv TEXT NOT NULL,"
-            "    envp TEXT NOT NULL,"
-            "    workingdir TEXT NOT NULL"
-            "    );",
-            "CREATE INDEX exec_proc_idx ON executed_files(process);",
-        };
         size_t i;
-        for(i = 0; i < count(sql); ++i)
-            check(sqlite3_exec(db, sql[i], NULL, NULL, NULL));
+        for(i = 0; i < count(schema_tables); ++i)
+            check(sqlite3_exec(db, schema_tables[i], NULL, NULL, NULL));
+        for(i = 0; i < count(schema_views); ++i)
+            check(sqlite3_exec(db, schema_views[i], NULL, NULL, NULL));
+        if(db_set_schema_version() != 0)
+            return -1;
+        tables_existed = 0;
     }
+    else
+        tables_existed = 1;
 
     {
-        const char *sql = ""
-                "SELECT last_insert_rowid()";
-        check(sqlite3_prepare_v2(db, sql, -1, &stmt_last_rowid, NULL));
+        /* Continues numbering processes after the previous runs */
+        const char *sql = "SELECT MAX(id) FROM processes;";
+        sqlite3_stmt *stmt_max_id;
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_max_id, NULL));
+        if(sqlite3_step(stmt_max_id) != SQLITE_ROW)
+        {
+            sqlite3_finalize(stmt_max_id);
+            goto sqlerror;
+        }
+        next_process_id = sqlite3_column_int(stmt_max_id, 0) + 1;
+        sqlite3_finalize(stmt_max_id);
+    }
+
+    {
+        /* Same for file accesses, which deduplication refers to by id */
+        const char *sql = "SELECT MAX(id) FROM file_accesses;";
+        sqlite3_stmt *stmt_max_id;
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_max_id, NULL));
+        if(sqlite3_step(stmt_max_id) != SQLITE_ROW)
+        {
+            sqlite3_finalize(stmt_max_id);
+            goto sqlerror;
+        }
+        next_file_id = sqlite3_column_int(stmt_max_id, 0) + 1;
+        sqlite3_finalize(stmt_max_id);
+    }
+
+    {
+        const char *sql = "INSERT INTO runs(timestamp) VALUES(?)";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_run, NULL));
     }
 
     {
         const char *sql = ""
-                "INSERT INTO processes(parent, timestamp)"
-                "VALUES(?, ?)";
+                "INSERT INTO processes(id, parent, timestamp, run_id)"
+                "VALUES(?, ?, ?, ?)";
         check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_process, NULL));
     }
 
@@ -137,20 +1481,90 @@ int db_init(const char *filename)
 
     {
         const char *sql = ""
-                "INSERT INTO opened_files(name, timestamp, "
-                "        mode, is_directory, process)"
-                "VALUES(?, ?, ?, ?, ?)";
+                "UPDATE processes SET user_time=?, system_time=?, "
+                "        max_rss=?, io_read=?, io_written=?"
+                "WHERE id=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_set_usage, NULL));
+    }
+
+    {
+        const char *sql = ""
+                "INSERT INTO file_accesses(path, timestamp, "
+                "        mode, is_directory, process, run_id, id)"
+                "VALUES(?, ?, ?, ?, ?, ?, ?)";
         check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_file, NULL));
     }
 
     {
         const char *sql = ""
-                "INSERT INTO executed_files(name, timestamp, process, "
-                "        argv, envp, workingdir)"
-                "VALUES(?, ?, ?, ?, ?, ?)";
+                "INSERT INTO executions(path, timestamp, process, "
+                "        argv, envp, workingdir, run_id)"
+                "VALUES(?, ?, ?, ?, ?, ?, ?)";
         check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_exec, NULL));
     }
 
+    {
+        const char *sql = ""
+                "UPDATE file_accesses SET occurrences=? "
+                "WHERE id=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_set_occurrences, NULL));
+    }
+
+    {
+        const char *sql = "SELECT id FROM paths WHERE path=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_find_path, NULL));
+    }
+
+    {
+        const char *sql = "INSERT INTO paths(path) VALUES(?)";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_path, NULL));
+    }
+
+    {
+        const char *sql = "UPDATE paths SET canonical=? WHERE id=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_set_canonical, NULL));
+    }
+
+    {
+        const char *sql = "DELETE FROM path_links WHERE path=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_delete_links, NULL));
+    }
+
+    {
+        const char *sql = ""
+                "INSERT OR IGNORE INTO path_links(path, link) "
+                "VALUES(?, ?)";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_link, NULL));
+    }
+
+    {
+        const char *sql = ""
+                "SELECT id FROM arguments "
+                "WHERE hash=? AND argv=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_find_arguments, NULL));
+    }
+
+    {
+        const char *sql = "INSERT INTO arguments(hash, argv) VALUES(?, ?)";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_arguments, NULL));
+    }
+
+    {
+        const char *sql = ""
+                "SELECT id FROM environments "
+                "WHERE hash=? AND envp=?";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_find_environment, NULL));
+    }
+
+    {
+        const char *sql = "INSERT INTO environments(hash, envp) VALUES(?, ?)";
+        check(sqlite3_prepare_v2(db, sql, -1, &stmt_insert_environment,
+                                 NULL));
+    }
+
+    if(db_start_writer() != 0)
+        return -1;
+
     return 0;
 
 sqlerror:
@@ -160,164 +1574,445 @@ sqlerror:
 
 int db_close(void)
 {
-    check(sqlite3_finalize(stmt_last_rowid));
+    int failed;
+
+    if(db_flush_seen_files() != 0)
+        return -1;
+    free(path_announced);
+    path_announced = NULL;
+    path_announced_size = 0;
+
+    if(event_log != NULL)
+        return event_log_close();
+
+    /* Waits for the writer thread to empty the queue */
+    pthread_mutex_lock(&queue_mutex);
+    writer_stop = 1;
+    pthread_cond_signal(&queue_not_empty);
+    pthread_mutex_unlock(&queue_mutex);
+    pthread_join(writer_thread, NULL);
+    failed = writer_failed;
+    while(queue_head != NULL)
+    {
+        struct DbEvent *next = queue_head->next;
+        free(queue_head);
+        queue_head = next;
+    }
+    queue_tail = NULL;
+    queue_bytes = 0;
+    queue_count = 0;
+    writer_stop = 0;
+    writer_failed = 0;
+    pthread_cond_destroy(&queue_not_empty);
+    pthread_cond_destroy(&queue_not_full);
+
+    if(db_commit() != 0)
+        return -1;
+    check(sqlite3_finalize(stmt_insert_run));
     check(sqlite3_finalize(stmt_insert_process));
     check(sqlite3_finalize(stmt_set_exitcode));
+    check(sqlite3_finalize(stmt_set_usage));
     check(sqlite3_finalize(stmt_insert_file));
     check(sqlite3_finalize(stmt_insert_exec));
+    check(sqlite3_finalize(stmt_set_occurrences));
+    check(sqlite3_finalize(stmt_find_path));
+    check(sqlite3_finalize(stmt_insert_path));
+    check(sqlite3_finalize(stmt_set_canonical));
+    check(sqlite3_finalize(stmt_delete_links));
+    check(sqlite3_finalize(stmt_insert_link));
+    check(sqlite3_finalize(stmt_find_arguments));
+    check(sqlite3_finalize(stmt_insert_arguments));
+    check(sqlite3_finalize(stmt_find_environment));
+    check(sqlite3_finalize(stmt_insert_environment));
+    blob_table_clear(&arguments_table);
+    blob_table_clear(&environments_table);
+    free(path_rows);
+    path_rows = NULL;
+    path_rows_size = 0;
     check(sqlite3_close(db));
-    return 0;
+    return failed?-1:0;
 
 sqlerror:
     log_critical(0, "sqlite3 error on exit: %s", sqlite3_errmsg(db));
     return -1;
 }
 
-#define DB_NO_PARENT ((unsigned int)-2)
+/* ********************
+ * Event queue, called by the tracer
+ */
 
-int db_add_process(unsigned int *id, unsigned int parent_id,
-                   const char *working_dir)
+static struct DbEvent *db_new_event(int type, unsigned int process,
+                                    size_t data_size)
+{
+    size_t size = sizeof(struct DbEvent) + data_size;
+    struct DbEvent *event = malloc(size);
+    event->next = NULL;
+    event->size = size;
+    event->type = type;
+    event->timestamp = gettime();
+    event->process = process;
+    event->parent = 0;
+    event->value = 0;
+    event->is_dir = 0;
+    event->name = event->argv = event->envp = event->workingdir = NULL;
+    event->name_path = event->workingdir_path = 0;
+    event->argv_len = event->envp_len = 0;
+    event->file_id = 0;
+    return event;
+}
+
+static int db_queue_event(struct DbEvent *event)
 {
-    if(parent_id == DB_NO_PARENT)
+    int failed;
+    if(event_log != NULL)
     {
-        check(sqlite3_bind_null(stmt_insert_process, 1));
+        failed = event_log_write(event);
+        free(event);
+        return failed;
     }
-    else
+    pthread_mutex_lock(&queue_mutex);
+    /* Backpressure: waits for the writer to catch up */
+    while(!writer_failed && queue_bytes > 0
+        && queue_bytes + event->size > db_queue_max_bytes)
     {
-        check(sqlite3_bind_int(stmt_insert_process, 1, parent_id));
+        ++db_stats.queue_waits;
+        pthread_cond_signal(&queue_not_empty);
+        pthread_cond_wait(&queue_not_full, &queue_mutex);
     }
-    /* This assumes that we won't go over 2^32 seconds (~135 years) */
-    check(sqlite3_bind_int64(stmt_insert_process, 2, gettime()));
-
-    if(sqlite3_step(stmt_insert_process) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_insert_process);
+    failed = writer_failed;
+    if(!failed)
+    {
+        if(queue_tail == NULL)
+            queue_head = queue_tail = event;
+        else
+        {
+            queue_tail->next = event;
+            queue_tail = event;
+        }
+        queue_bytes += event->size;
+        if(++queue_count == DB_WRITER_BATCH)
+            pthread_cond_signal(&queue_not_empty);
+        if(queue_count > db_stats.queue_max_events)
+            db_stats.queue_max_events = queue_count;
+        if(queue_bytes > db_stats.queue_max_bytes)
+            db_stats.queue_max_bytes = queue_bytes;
+    }
+    pthread_mutex_unlock(&queue_mutex);
+    if(failed)
+    {
+        free(event);
+        return -1;
+    }
+    return 0;
+}
 
-    /* Get id */
-    if(sqlite3_step(stmt_last_rowid) != SQLITE_ROW)
-        goto sqlerror;
-    *id = sqlite3_column_int(stmt_last_rowid, 0);
-    if(sqlite3_step(stmt_last_rowid) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_last_rowid);
+int db_add_process(unsigned int *id, unsigned int parent_id,
+                   unsigned int working_dir)
+{
+    struct DbEvent *event = db_new_event(DB_EVENT_PROCESS,
+                                         next_process_id, 0);
+    event->parent = parent_id;
+    *id = next_process_id++;
+    if(db_queue_event(event) != 0)
+        return -1;
 
     return db_add_file_open(*id, working_dir, FILE_WDIR, 1);
-
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error inserting process: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
 }
 
-int db_add_first_process(unsigned int *id, const char *working_dir)
+int db_add_first_process(unsigned int *id, unsigned int working_dir)
 {
     return db_add_process(id, DB_NO_PARENT, working_dir);
 }
 
 int db_add_exit(unsigned int id, int exitcode)
 {
-    check(sqlite3_bind_int(stmt_set_exitcode, 1, exitcode));
-    check(sqlite3_bind_int(stmt_set_exitcode, 2, id));
+    struct DbEvent *event = db_new_event(DB_EVENT_EXIT, id, 0);
+    event->value = exitcode;
+    return db_queue_event(event);
+}
 
-    if(sqlite3_step(stmt_set_exitcode) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_set_exitcode);
+int db_add_usage(unsigned int id, const struct ProcessUsage *usage)
+{
+    struct DbEvent *event = db_new_event(DB_EVENT_USAGE, id,
+                                         sizeof(*usage));
+    memcpy(event + 1, usage, sizeof(*usage));
+    return db_queue_event(event);
+}
 
-    return 0;
+/**
+ * Records the canonical path of a path, and the links that were traversed,
+ * the first time it is used and again if its resolution was invalidated.
+ */
+static int db_announce_path(unsigned int path)
+{
+    struct DbEvent *event;
+    struct PathRef *refs;
+    const unsigned int *links;
+    size_t nb_links, i;
+    unsigned int canonical;
 
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error setting exitcode: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
+    if(path >= path_announced_size)
+    {
+        size_t new_size = path_announced_size?path_announced_size:1024;
+        while(new_size <= path)
+            new_size <<= 1;
+        path_announced = realloc(path_announced,
+                                 new_size * sizeof(*path_announced));
+        memset(path_announced + path_announced_size, 0,
+               (new_size - path_announced_size) * sizeof(*path_announced));
+        path_announced_size = new_size;
+    }
+    else if(path_announced[path] == path_resolve_generation)
+        return 0;
+    path_announced[path] = path_resolve_generation;
+
+    canonical = path_resolve(path, &links, &nb_links);
+    event = db_new_event(DB_EVENT_PATH, 0, nb_links * sizeof(*refs));
+    event->name_path = path;
+    event->name = path_string(path);
+    event->workingdir_path = canonical;
+    event->workingdir = path_string(canonical);
+    event->value = nb_links;
+    refs = (struct PathRef*)(event + 1);
+    for(i = 0; i < nb_links; ++i)
+    {
+        refs[i].id = links[i];
+        refs[i].name = path_string(links[i]);
+    }
+    return db_queue_event(event);
 }
 
-int db_add_file_open(unsigned int process, const char *name,
+int db_add_file_open(unsigned int process, unsigned int path,
                      unsigned int mode, int is_dir)
 {
-    check(sqlite3_bind_text(stmt_insert_file, 1, name, -1, SQLITE_TRANSIENT));
-    /* This assumes that we won't go over 2^32 seconds (~135 years) */
-    check(sqlite3_bind_int64(stmt_insert_file, 2, gettime()));
-    check(sqlite3_bind_int(stmt_insert_file, 3, mode));
-    check(sqlite3_bind_int(stmt_insert_file, 4, is_dir));
-    check(sqlite3_bind_int(stmt_insert_file, 5, process));
-
-    if(sqlite3_step(stmt_insert_file) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_insert_file);
-    return 0;
-
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error inserting file: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
+    struct DbEvent *event;
+    if(path_excluded(path))
+        return 0;
+    if(db_dedup_files && db_file_seen(process, path, mode, next_file_id))
+        return 0;
+    if(db_announce_path(path) != 0)
+        return -1;
+    event = db_new_event(DB_EVENT_FILE, process, 0);
+    event->file_id = next_file_id++;
+    event->name_path = path;
+    event->name = path_string(path);
+    event->value = mode;
+    event->is_dir = is_dir;
+    return db_queue_event(event);
 }
 
-static char *strarray2nulsep(const char *const *array, size_t *plen)
+static size_t strarraylen(const char *const *array)
 {
-    char *list;
     size_t len = 0;
+    while(*array)
     {
-        const char *const *a = array;
-        while(*a)
-        {
-            len += strlen(*a) + 1;
-            ++a;
-        }
+        len += strlen(*array) + 1;
+        ++array;
     }
+    return len;
+}
+
+static char *strarray2nulsep(char *p, const char *const *array)
+{
+    while(*array)
     {
-        const char *const *a = array;
-        char *p;
-        p = list = malloc(len);
-        while(*a)
-        {
-            const char *s = *a;
-            while(*s)
-                *p++ = *s++;
-            *p++ = '\0';
-            ++a;
-        }
+        const char *s = *array;
+        while(*s)
+            *p++ = *s++;
+        *p++ = '\0';
+        ++array;
     }
-    *plen = len;
-    return list;
+    return p;
 }
 
-int db_add_exec(unsigned int process, const char *binary,
+int db_add_exec(unsigned int process, unsigned int binary_path,
                 const char *const *argv, const char *const *envp,
-                const char *workingdir)
+                unsigned int workingdir_path)
 {
-    check(sqlite3_bind_text(stmt_insert_exec, 1, binary,
-                            -1, SQLITE_TRANSIENT));
-    /* This assumes that we won't go over 2^32 seconds (~135 years) */
-    check(sqlite3_bind_int64(stmt_insert_exec, 2, gettime()));
-    check(sqlite3_bind_int(stmt_insert_exec, 3, process));
+    size_t argv_len = strarraylen(argv);
+    size_t envp_len = strarraylen(envp);
+    struct DbEvent *event;
+    char *data;
+
+    if(db_announce_path(binary_path) != 0
+     || db_announce_path(workingdir_path) != 0)
+        return -1;
+    event = db_new_event(DB_EVENT_EXEC, process, argv_len + envp_len);
+    data = (char*)(event + 1);
+
+    event->name_path = binary_path;
+    event->name = path_string(binary_path);
+    event->argv = data;
+    event->argv_len = argv_len;
+    data = strarray2nulsep(data, argv);
+    event->envp = data;
+    event->envp_len = envp_len;
+    strarray2nulsep(data, envp);
+    event->workingdir_path = workingdir_path;
+    event->workingdir = path_string(workingdir_path);
+
+    return db_queue_event(event);
+}
+
+int db_load_event_log(const char *filename)
+{
+    FILE *fp;
+    int ret = 0;
+    /* Process and file access identifiers continue after the ones already
+     * in the database */
+    unsigned int id_offset = next_process_id - 1;
+    unsigned int file_id_offset = next_file_id - 1;
+
+    fp = fopen(filename, "rb");
+    if(fp == NULL)
     {
-        size_t len;
-        char *arglist = strarray2nulsep(argv, &len);
-        check(sqlite3_bind_text(stmt_insert_exec, 4, arglist, len,
-                                SQLITE_TRANSIENT));
-        free(arglist);
+        log_critical(0, "couldn't open event log %s: %s", filename,
+                     strerror(errno));
+        return -1;
     }
     {
-        size_t len;
-        char *envlist = strarray2nulsep(envp, &len);
-        check(sqlite3_bind_text(stmt_insert_exec, 5, envlist, len,
-                                SQLITE_TRANSIENT));
-        free(envlist);
+        char magic[EVENT_LOG_MAGIC_LEN];
+        if(fread(magic, EVENT_LOG_MAGIC_LEN, 1, fp) != 1
+         || memcmp(magic, EVENT_LOG_MAGIC, EVENT_LOG_MAGIC_LEN) != 0)
+        {
+            log_critical(0, "%s is not an event log", filename);
+            fclose(fp);
+            return -1;
+        }
     }
-    check(sqlite3_bind_text(stmt_insert_exec, 6, workingdir,
-                            -1, SQLITE_TRANSIENT));
 
-    if(sqlite3_step(stmt_insert_exec) != SQLITE_DONE)
-        goto sqlerror;
-    sqlite3_reset(stmt_insert_exec);
-    return 0;
+    for(;;)
+    {
+        struct EventLogRecord record;
+        struct DbEvent *event;
+        size_t strings_size, nread;
+        char *data;
 
-sqlerror:
-    /* LCOV_EXCL_START : Insertions shouldn't fail */
-    log_critical(0, "sqlite3 error inserting exec: %s", sqlite3_errmsg(db));
-    return -1;
-    /* LCOV_EXCL_END */
+        nread = fread(&record, 1, sizeof(record), fp);
+        if(nread == 0)
+            break;
+        else if(nread < sizeof(record) || record.length < sizeof(record))
+        {
+            log_warn(0, "event log is truncated");
+            break;
+        }
+        strings_size = record.length - sizeof(record);
+        event = db_new_event(record.type, record.process + id_offset,
+                             strings_size);
+        data = (char*)(event + 1);
+        if(fread(data, 1, strings_size, fp) != strings_size)
+        {
+            free(event);
+            log_warn(0, "event log is truncated");
+            break;
+        }
+        event->timestamp = record.timestamp;
+        event->value = record.value;
+        event->is_dir = record.is_dir;
+
+        /* Sets up the string pointers, checking that they are in the record
+         */
+        if(record.type == DB_EVENT_FILE || record.type == DB_EVENT_EXEC
+         || record.type == DB_EVENT_PATH)
+        {
+            const char *end = memchr(data, '\0', strings_size);
+            event->name = data;
+            if(end == NULL)
+                goto badrecord;
+            event->name_path = path_intern(event->name);
+            data = (char*)end + 1;
+            strings_size -= data - event->name;
+        }
+        if(record.type == DB_EVENT_EXEC)
+        {
+            if((size_t)record.argv_len + record.envp_len >= strings_size
+             || data[strings_size - 1] != '\0')
+                goto badrecord;
+            event->argv = data;
+            event->argv_len = record.argv_len;
+            event->envp = data + record.argv_len;
+            event->envp_len = record.envp_len;
+            event->workingdir = event->envp + record.envp_len;
+            event->workingdir_path = path_intern(event->workingdir);
+        }
+        else if(record.type == DB_EVENT_PROCESS)
+        {
+            if(record.parent == DB_NO_PARENT)
+                event->parent = DB_NO_PARENT;
+            else
+                event->parent = record.parent + id_offset;
+            if(event->process >= next_process_id)
+                next_process_id = event->process + 1;
+        }
+        else if(record.type == DB_EVENT_FILE_COUNT)
+        {
+            event->parent = record.parent;
+            event->file_id = record.file_id + file_id_offset;
+        }
+        else if(record.type == DB_EVENT_PATH)
+        {
+            /* The links are interned and referenced from a new event */
+            struct DbEvent *path_event;
+            struct PathRef *refs;
+            const char *end = data + strings_size;
+            const char *p;
+            int i;
+            if(strings_size == 0 || data[strings_size - 1] != '\0'
+             || record.value < 0)
+                goto badrecord;
+            path_event = db_new_event(DB_EVENT_PATH, 0,
+                                      record.value * sizeof(*refs));
+            path_event->timestamp = record.timestamp;
+            path_event->value = record.value;
+            path_event->name_path = event->name_path;
+            path_event->name = path_string(event->name_path);
+            path_event->workingdir_path = path_intern(data);
+            path_event->workingdir = path_string(
+                    path_event->workingdir_path);
+            refs = (struct PathRef*)(path_event + 1);
+            p = data + strlen(data) + 1;
+            for(i = 0; i < record.value; ++i)
+            {
+                if(p >= end)
+                {
+                    free(path_event);
+                    goto badrecord;
+                }
+                refs[i].id = path_intern(p);
+                refs[i].name = path_string(refs[i].id);
+                p += strlen(p) + 1;
+            }
+            free(event);
+            event = path_event;
+        }
+        else if(record.type == DB_EVENT_USAGE)
+        {
+            if(strings_size != sizeof(struct ProcessUsage))
+                goto badrecord;
+        }
+        else if(record.type == DB_EVENT_FILE)
+        {
+            event->file_id = record.file_id + file_id_offset;
+            if(event->file_id >= next_file_id)
+                next_file_id = event->file_id + 1;
+        }
+        else if(record.type != DB_EVENT_EXIT)
+            goto badrecord;
+
+        if(db_queue_event(event) != 0)
+        {
+            ret = -1;
+            break;
+        }
+        continue;
+
+    badrecord:
+        free(event);
+        log_critical(0, "invalid record in event log");
+        ret = -1;
+        break;
+    }
+
+    fclose(fp);
+    return ret;
 }
@@ -1,22 +1,79 @@
 #ifndef DATABASE_H
 #define DATABASE_H
 
+#include <stddef.h>
+
 #define FILE_READ   0x01
 #define FILE_WRITE  0x02
 #define FILE_WDIR   0x04
 #define FILE_STAT   0x08
 
+/* Insertions are committed every db_commit_events events or every
+ * db_commit_interval milliseconds, whichever comes first (0 disables a
+ * criterion; with both disabled, everything is committed by db_close()) */
+#define DB_DEFAULT_COMMIT_EVENTS    1000
+#define DB_DEFAULT_COMMIT_INTERVAL  1000
+#define DB_DEFAULT_SYNCHRONOUS      "NORMAL"
+/* Events are inserted by a separate thread; the tracer waits for it if the
+ * queued events use more than db_queue_max_bytes */
+#define DB_DEFAULT_QUEUE_MAX_BYTES  (64 * 1024 * 1024)
+
+extern unsigned int db_commit_events;
+extern unsigned int db_commit_interval;
+/* Values for the journal_mode and synchronous pragmas, NULL to keep SQLite's
+ * default */
+extern const char *db_journal_mode;
+extern const char *db_synchronous;
+extern size_t db_queue_max_bytes;
+/* If set, db_init() opens a binary event log instead of a database, to be
+ * loaded later by db_load_event_log() */
+extern int db_use_event_log;
+/* If set, a process accessing the same path with the same mode is only
+ * recorded once, with the number of accesses in opened_files.occurrences */
+extern int db_dedup_files;
+
+/* Counters about the database writer, reset by db_init() */
+#define DB_LATENCY_BUCKETS 16
+
+struct DbStats {
+    unsigned long events;
+    /* Number of events whose insertion (including the commit it caused, if
+     * any) took less than 2^i microseconds, the last bucket getting the rest
+     */
+    unsigned long insert_latency[DB_LATENCY_BUCKETS];
+    /* Largest number of events and bytes waiting in the queue */
+    unsigned int queue_max_events;
+    size_t queue_max_bytes;
+    /* Number of times the tracer had to wait for the writer to catch up */
+    unsigned long queue_waits;
+};
+
+extern struct DbStats db_stats;
+
+/* Resources used by a process, read when it exits */
+struct ProcessUsage {
+    unsigned long long user_time;       /* CPU time, in microseconds */
+    unsigned long long system_time;
+    unsigned long long max_rss;         /* peak resident set, in kilobytes */
+    unsigned long long io_read;         /* bytes read and written */
+    unsigned long long io_written;
+};
+
 int db_init(const char *filename);
 int db_close(void);
+/* Paths are passed as interned path ids, see utils.h */
 int db_add_process(unsigned int *id, unsigned int parent_id,
-                   const char *working_dir);
+                   unsigned int working_dir);
 int db_add_exit(unsigned int id, int exitcode);
-int db_add_first_process(unsigned int *id, const char *working_dir);
+int db_add_usage(unsigned int id, const struct ProcessUsage *usage);
+int db_add_first_process(unsigned int *id, unsigned int working_dir);
 int db_add_file_open(unsigned int process,
-                     const char *name, unsigned int mode,
+                     unsigned int path, unsigned int mode,
                      int is_dir);
-int db_add_exec(unsigned int process, const char *binary,
+int db_add_exec(unsigned int process, unsigned int binary,
                 const char *const *argv, const char *const *envp,
-                const char *workingdir);
+                unsigned int workingdir);
+
+int db_load_event_log(const char *filename);
 
 #endif
@@ -40,7 +40,7 @@ void log_real_(pid_t tid, const char *tag, int lvl, const char *format, ...)
 {
     va_list args;
     char datestr[13]; /* HH:MM:SS.mmm */
-    static char buffer[4096];
+    char buffer[4096];
     int length;
     va_start(args, format);
     {
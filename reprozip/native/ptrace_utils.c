@@ -1,9 +1,12 @@
+#define _GNU_SOURCE /* process_vm_readv() */
+
 #include <errno.h>
 #include <inttypes.h>
 #include <stdlib.h>
 #include <string.h>
 #include <sys/ptrace.h>
 #include <sys/types.h>
+#include <sys/uio.h>
 #include <unistd.h>
 
 #include "config.h"
@@ -12,11 +15,22 @@
 #include "tracer.h"
 
 
+/* Memory is read from the tracee in chunks that never cross a page boundary,
+ * so that a read doesn't fail because of the page after a string */
+#define TRACEE_READ_CHUNK 4096
+
+int tracee_use_vm_readv = 1;
+
+unsigned long long tracee_bytes_read = 0;
+unsigned long tracee_read_syscalls = 0;
+
+
 static long tracee_getword(pid_t tid, const void *addr)
 {
     long res;
     errno = 0;
     res = ptrace(PTRACE_PEEKDATA, tid, addr, NULL);
+    ++tracee_read_syscalls;
     if(errno)
     {
         /* LCOV_EXCL_START : We only do that on things that went through the
@@ -26,6 +40,7 @@ static long tracee_getword(pid_t tid, const void *addr)
         return 0;
         /* LCOV_EXCL_END */
     }
+    tracee_bytes_read += sizeof(res);
     return res;
 }
 
@@ -98,7 +113,8 @@ size_t tracee_strlen(pid_t tid, const char *str)
     return size;
 }
 
-void tracee_read(pid_t tid, char *dst, const char *src, size_t size)
+static void tracee_peek_read(pid_t tid, char *dst, const char *src,
+                             size_t size)
 {
     uintptr_t ptr = (uintptr_t)src;
     size_t j = ptr % WORD_SIZE;
@@ -113,48 +129,148 @@ void tracee_read(pid_t tid, char *dst, const char *src, size_t size)
     }
 }
 
+/**
+ * Reads from the tracee's memory using process_vm_readv().
+ *
+ * Returns the number of bytes that were read, which is less than size if an
+ * unreadable page was encountered, or 0 if process_vm_readv() can't be used.
+ */
+static size_t tracee_vm_read(pid_t tid, char *dst, const char *src,
+                             size_t size)
+{
+    struct iovec local, remote;
+    ssize_t ret;
+    if(!tracee_use_vm_readv)
+        return 0;
+    local.iov_base = dst;
+    local.iov_len = size;
+    remote.iov_base = (void*)src;
+    remote.iov_len = size;
+    ret = process_vm_readv(tid, &local, 1, &remote, 1, 0);
+    if(ret < 0)
+    {
+        /* LCOV_EXCL_START : process_vm_readv() is available since Linux 3.2,
+         * and we are allowed to use it since we are ptrace()ing */
+        if(errno == ENOSYS || errno == EPERM)
+        {
+            log_info(tid, "process_vm_readv() failed (%s), falling back to "
+                     "PTRACE_PEEKDATA", strerror(errno));
+            tracee_use_vm_readv = 0;
+        }
+        return 0;
+        /* LCOV_EXCL_END */
+    }
+    ++tracee_read_syscalls;
+    tracee_bytes_read += ret;
+    return ret;
+}
+
+void tracee_read(pid_t tid, char *dst, const char *src, size_t size)
+{
+    size_t done = tracee_vm_read(tid, dst, src, size);
+    if(done < size)
+        tracee_peek_read(tid, dst + done, src + done, size - done);
+}
+
 char *tracee_strdup(pid_t tid, const char *str)
 {
-    size_t length = tracee_strlen(tid, str);
-    char *res = malloc(length + 1);
-    tracee_read(tid, res, str, length);
-    res[length] = '\0';
+    char buffer[TRACEE_READ_CHUNK];
+    char *res = NULL;
+    size_t length = 0;
+    /* Fast path: reads the string page by page, until the terminating NUL */
+    while(tracee_use_vm_readv)
+    {
+        uintptr_t addr = (uintptr_t)str + length;
+        size_t chunk = TRACEE_READ_CHUNK - addr % TRACEE_READ_CHUNK;
+        size_t size = tracee_vm_read(tid, buffer, (const char*)addr, chunk);
+        const char *end = memchr(buffer, '\0', size);
+        if(end != NULL)
+            size = end - buffer;
+        res = realloc(res, length + size + 1);
+        memcpy(res + length, buffer, size);
+        length += size;
+        if(end != NULL)
+        {
+            res[length] = '\0';
+            return res;
+        }
+        else if(size < chunk)
+            break;
+    }
+    /* Slow path: reads the rest word by word with PTRACE_PEEKDATA */
+    {
+        size_t rest = tracee_strlen(tid, str + length);
+        res = realloc(res, length + rest + 1);
+        tracee_peek_read(tid, res + length, str + length, rest);
+        length += rest;
+        res[length] = '\0';
+    }
     return res;
 }
 
 char **tracee_strarraydup(int mode, pid_t tid, const char *const *argv)
 {
     /* FIXME : This is probably broken on x32 */
+    const size_t wordsize = tracee_getwordsize(mode);
+    const char **pointers = NULL;
     char **array;
-    /* Reads number of pointers in pointer array */
     size_t nb_args = 0;
+    /* Reads the pointer array, a page at a time */
     {
-        const char *const *a = argv;
-        /* xargv = *a */
-        const char *xargv = tracee_getptr(mode, tid, a);
-        while(xargv != NULL)
+        uintptr_t addr = (uintptr_t)argv;
+        int done = 0;
+        while(!done)
         {
-            ++nb_args;
-            ++a;
-            xargv = tracee_getptr(mode, tid, a);
+            unsigned char buffer[TRACEE_READ_CHUNK];
+            size_t chunk = TRACEE_READ_CHUNK - addr % TRACEE_READ_CHUNK;
+            size_t size, i;
+            if(chunk < wordsize)
+                chunk = wordsize;
+            size = tracee_vm_read(tid, (char*)buffer, (const char*)addr,
+                                  chunk);
+            size -= size % wordsize;
+            if(size == 0)
+            {
+                /* Fallback: reads a single pointer */
+                tracee_read(tid, (char*)buffer, (const char*)addr, wordsize);
+                size = wordsize;
+            }
+            pointers = realloc(pointers,
+                               (nb_args + size/wordsize) * sizeof(char*));
+            for(i = 0; i < size; i += wordsize)
+            {
+                const char *xargv;
+                if(mode == MODE_I386)
+                {
+                    uint32_t ptr;
+                    memcpy(&ptr, buffer + i, sizeof(ptr));
+                    xargv = (const char*)(uint64_t)ptr;
+                }
+                else /* mode == MODE_X86_64 */
+                {
+                    uint64_t ptr;
+                    memcpy(&ptr, buffer + i, sizeof(ptr));
+                    xargv = (const char*)ptr;
+                }
+                if(xargv == NULL)
+                {
+                    done = 1;
+                    break;
+                }
+                pointers[nb_args++] = xargv;
+            }
+            addr += size;
         }
     }
-    /* Allocs pointer array */
-    array = malloc((nb_args + 1) * sizeof(char*));
     /* Dups array elements */
     {
-        size_t i = 0;
-        /* xargv = argv[0] */
-        const char *xargv = tracee_getptr(mode, tid, argv);
-        while(xargv != NULL)
-        {
-            array[i] = tracee_strdup(tid, xargv);
-            ++i;
-            /* xargv = argv[i] */
-            xargv = tracee_getptr(mode, tid, argv + i);
-        }
-        array[i] = NULL;
+        size_t i;
+        array = malloc((nb_args + 1) * sizeof(char*));
+        for(i = 0; i < nb_args; ++i)
+            array[i] = tracee_strdup(tid, pointers[i]);
+        array[nb_args] = NULL;
     }
+    free(pointers);
     return array;
 }
 
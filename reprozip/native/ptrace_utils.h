@@ -1,6 +1,14 @@
 #ifndef PTRACE_UTILS_H
 #define PTRACE_UTILS_H
 
+/* If set (the default), tracee memory is read in bulk using
+ * process_vm_readv(), falling back on PTRACE_PEEKDATA if needed */
+extern int tracee_use_vm_readv;
+
+/* Amount of tracee memory read, and number of syscalls used for it */
+extern unsigned long long tracee_bytes_read;
+extern unsigned long tracee_read_syscalls;
+
 void *tracee_getptr(int mode, pid_t tid, const void *addr);
 uint64_t tracee_getlong(int mode, pid_t tid, const void *addr);
 size_t tracee_getwordsize(int mode);
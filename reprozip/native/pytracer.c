@@ -1,7 +1,10 @@
 #include <Python.h>
 
 #include "database.h"
+#include "ptrace_utils.h"
+#include "syscalls.h"
 #include "tracer.h"
+#include "utils.h"
 
 
 PyObject *Err_Base;
@@ -57,30 +60,270 @@ static char *get_string(PyObject *obj)
 }
 
 
-static PyObject *pytracer_execute(PyObject *self, PyObject *args)
+/**
+ * Sets a key in a dictionary, stealing the reference to value.
+ */
+static int dict_set(PyObject *dict, const char *key, PyObject *value)
+{
+    int ret;
+    if(value == NULL)
+        return -1;
+    ret = PyDict_SetItemString(dict, key, value);
+    Py_DECREF(value);
+    return ret;
+}
+
+/**
+ * Makes a dictionary from the database writer's counters.
+ */
+static PyObject *get_db_stats(void)
+{
+    PyObject *dict = PyDict_New();
+    PyObject *latency = PyDict_New();
+    size_t i;
+    int err = 0;
+    if(dict == NULL || latency == NULL)
+    {
+        Py_XDECREF(dict);
+        Py_XDECREF(latency);
+        return NULL;
+    }
+    /* Keys are the upper bound of each bucket, in microseconds */
+    for(i = 0; i < DB_LATENCY_BUCKETS; ++i)
+    {
+        char key[24];
+        if(i == DB_LATENCY_BUCKETS - 1)
+            strcpy(key, "inf");
+        else
+            sprintf(key, "%lu", 1ul << i);
+        err |= dict_set(latency, key,
+                        PyLong_FromUnsignedLong(db_stats.insert_latency[i]));
+    }
+    err |= dict_set(dict, "insert_latency_us", latency);
+    err |= dict_set(dict, "events", PyLong_FromUnsignedLong(db_stats.events));
+    err |= dict_set(dict, "queue_max_events",
+                    PyLong_FromUnsignedLong(db_stats.queue_max_events));
+    err |= dict_set(dict, "queue_max_bytes",
+                    PyLong_FromSize_t(db_stats.queue_max_bytes));
+    err |= dict_set(dict, "queue_waits",
+                    PyLong_FromUnsignedLong(db_stats.queue_waits));
+    if(err)
+    {
+        Py_DECREF(dict);
+        return NULL;
+    }
+    return dict;
+}
+
+/**
+ * Makes a dictionary from the tracer's counters.
+ */
+static PyObject *get_trace_stats(void)
+{
+    static const char *const table_names[SYSCALL_TYPES] = {
+        "i386", "x86_64", "x32"};
+    PyObject *dict = PyDict_New();
+    PyObject *stops;
+    size_t i;
+    int err = 0;
+    if(dict == NULL)
+        return NULL;
+    stops = PyDict_New();
+    err |= dict_set(dict, "syscall_stops", stops);
+    for(i = 0; !err && i < SYSCALL_TYPES; ++i)
+    {
+        PyObject *table = PyDict_New();
+        int syscall;
+        if(table == NULL)
+        {
+            err = 1;
+            break;
+        }
+        for(syscall = 0; syscall < TRACE_STATS_SYSCALLS; ++syscall)
+        {
+            unsigned long n = trace_stats.syscall_stops[i][syscall];
+            const char *name;
+            char number[16];
+            if(n == 0)
+                continue;
+            name = syscall_name(i, syscall);
+            if(name == NULL)
+            {
+                sprintf(number, "%d", syscall);
+                name = number;
+            }
+            err |= dict_set(table, name, PyLong_FromUnsignedLong(n));
+        }
+        if(PyDict_Size(table) > 0)
+            err |= dict_set(stops, table_names[i], table);
+        else
+            Py_DECREF(table);
+    }
+    err |= dict_set(dict, "other_stops",
+                    PyLong_FromUnsignedLong(trace_stats.other_stops));
+    err |= dict_set(dict, "syscall_info_reads",
+                    PyLong_FromUnsignedLong(trace_stats.syscall_info_reads));
+    err |= dict_set(dict, "register_reads",
+                    PyLong_FromUnsignedLong(trace_stats.register_reads));
+    err |= dict_set(dict, "exits_skipped",
+                    PyLong_FromUnsignedLong(trace_stats.exits_skipped));
+    err |= dict_set(dict, "wall_time",
+                    PyFloat_FromDouble(trace_stats.wall_time * 1.0e-9));
+    err |= dict_set(dict, "stopped_time",
+                    PyFloat_FromDouble(trace_stats.stopped_time * 1.0e-9));
+    err |= dict_set(dict, "running_time",
+                    PyFloat_FromDouble(
+                            (trace_stats.wall_time -
+                             trace_stats.stopped_time) * 1.0e-9));
+    err |= dict_set(dict, "tracee_bytes_read",
+                    PyLong_FromUnsignedLongLong(tracee_bytes_read));
+    err |= dict_set(dict, "tracee_read_syscalls",
+                    PyLong_FromUnsignedLong(tracee_read_syscalls));
+    err |= dict_set(dict, "excluded_paths",
+                    PyLong_FromUnsignedLong(path_excluded_count));
+    err |= dict_set(dict, "database", get_db_stats());
+    if(err)
+    {
+        Py_DECREF(dict);
+        return NULL;
+    }
+    return dict;
+}
+
+
+/**
+ * Sets the tracer's options from the arguments of execute() or attach().
+ *
+ * Returns 0, or -1 with a Python exception set.
+ */
+static int set_options(int verbosity, int commit_events, int commit_interval,
+                       const char *journal_mode, const char *synchronous,
+                       PyObject *py_seccomp, PyObject *py_eventlog,
+                       PyObject *py_dedup, const char *profile,
+                       PyObject *py_exclude)
+{
+    if(verbosity < 0)
+    {
+        PyErr_SetString(Err_Base, "verbosity should be >= 0");
+        return -1;
+    }
+    trace_verbosity = verbosity;
+
+    if(commit_events < 0 || commit_interval < 0)
+    {
+        PyErr_SetString(Err_Base,
+                        "commit_events and commit_interval should be >= 0");
+        return -1;
+    }
+    db_commit_events = commit_events;
+    db_commit_interval = commit_interval;
+    db_journal_mode = journal_mode;
+    db_synchronous = synchronous;
+    trace_use_seccomp = py_seccomp != NULL && PyObject_IsTrue(py_seccomp);
+    db_use_event_log = py_eventlog != NULL && PyObject_IsTrue(py_eventlog);
+    db_dedup_files = py_dedup != NULL && PyObject_IsTrue(py_dedup);
+    if(syscall_profile(profile, &trace_syscall_groups) != 0)
+    {
+        PyErr_Format(Err_Base, "unknown capture profile %s", profile);
+        return -1;
+    }
+
+    /* Excluded path prefixes */
+    path_exclude_clear();
+    if(py_exclude != NULL && py_exclude != Py_None)
+    {
+        PyObject *iterator = PyObject_GetIter(py_exclude);
+        PyObject *item;
+        if(iterator == NULL)
+            return -1;
+        while((item = PyIter_Next(iterator)) != NULL)
+        {
+            char *prefix = get_string(item);
+            Py_DECREF(item);
+            if(prefix == NULL)
+            {
+                Py_DECREF(iterator);
+                if(!PyErr_Occurred())
+                    PyErr_SetString(PyExc_TypeError,
+                                    "exclude should contain strings");
+                return -1;
+            }
+            path_exclude(prefix);
+            free(prefix);
+        }
+        Py_DECREF(iterator);
+        if(PyErr_Occurred())
+            return -1;
+    }
+
+    tracee_bytes_read = 0;
+    tracee_read_syscalls = 0;
+    path_excluded_count = 0;
+    return 0;
+}
+
+/**
+ * Makes the return value of execute() or attach(), stealing the reference to
+ * status.
+ */
+static PyObject *make_result(PyObject *status, PyObject *py_stats)
+{
+    if(status != NULL && py_stats != NULL && PyObject_IsTrue(py_stats))
+    {
+        PyObject *stats = get_trace_stats();
+        if(stats == NULL)
+        {
+            Py_DECREF(status);
+            return NULL;
+        }
+        return Py_BuildValue("(NN)", status, stats);
+    }
+    return status;
+}
+
+static PyObject *pytracer_execute(PyObject *self, PyObject *args,
+                                  PyObject *kwargs)
 {
     PyObject *ret;
     int exit_status;
 
     /* Reads arguments */
+    static char *kwlist[] = {"binary", "argv", "databasepath", "verbosity",
+                             "commit_events", "commit_interval",
+                             "journal_mode", "synchronous", "seccomp",
+                             "eventlog", "dedup", "stats", "profile",
+                             "exclude", NULL};
     const char *binary, *databasepath;
     char **argv;
     size_t argv_len;
     int verbosity;
+    int commit_events = DB_DEFAULT_COMMIT_EVENTS;
+    int commit_interval = DB_DEFAULT_COMMIT_INTERVAL;
+    const char *journal_mode = NULL;
+    const char *synchronous = DB_DEFAULT_SYNCHRONOUS;
+    PyObject *py_seccomp = NULL;
+    PyObject *py_eventlog = NULL;
+    PyObject *py_dedup = NULL;
+    PyObject *py_stats = NULL;
+    const char *profile = "full";
+    PyObject *py_exclude = NULL;
     PyObject *py_binary, *py_argv, *py_databasepath;
-    if(!(PyArg_ParseTuple(args, "OO!Oi",
-                          &py_binary,
-                          &PyList_Type, &py_argv,
-                          &py_databasepath,
-                          &verbosity)))
+    if(!(PyArg_ParseTupleAndKeywords(args, kwargs, "OO!Oi|iizzOOOOsO", kwlist,
+                                     &py_binary,
+                                     &PyList_Type, &py_argv,
+                                     &py_databasepath,
+                                     &verbosity,
+                                     &commit_events, &commit_interval,
+                                     &journal_mode, &synchronous,
+                                     &py_seccomp, &py_eventlog,
+                                     &py_dedup, &py_stats, &profile,
+                                     &py_exclude)))
         return NULL;
 
-    if(verbosity < 0)
-    {
-        PyErr_SetString(Err_Base, "verbosity should be >= 0");
+    if(set_options(verbosity, commit_events, commit_interval,
+                   journal_mode, synchronous, py_seccomp, py_eventlog,
+                   py_dedup, profile, py_exclude) != 0)
         return NULL;
-    }
-    trace_verbosity = verbosity;
 
     binary = get_string(py_binary);
     if(binary == NULL)
@@ -115,9 +358,7 @@ static PyObject *pytracer_execute(PyObject *self, PyObject *args)
     }
 
     if(fork_and_trace(binary, argv_len, argv, databasepath, &exit_status) == 0)
-    {
-        ret = PyLong_FromLong(exit_status);
-    }
+        ret = make_result(PyLong_FromLong(exit_status), py_stats);
     else
     {
         PyErr_SetString(Err_Base, "Error occurred");
@@ -136,12 +377,191 @@ static PyObject *pytracer_execute(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *pytracer_attach(PyObject *self, PyObject *args,
+                                 PyObject *kwargs)
+{
+    PyObject *ret;
+    int exit_status;
+
+    /* Reads arguments */
+    static char *kwlist[] = {"pid", "databasepath", "verbosity", "duration",
+                             "commit_events", "commit_interval",
+                             "journal_mode", "synchronous", "seccomp",
+                             "eventlog", "dedup", "stats", "profile",
+                             "exclude", NULL};
+    char *databasepath;
+    int pid, verbosity;
+    int duration = 0;
+    int commit_events = DB_DEFAULT_COMMIT_EVENTS;
+    int commit_interval = DB_DEFAULT_COMMIT_INTERVAL;
+    const char *journal_mode = NULL;
+    const char *synchronous = DB_DEFAULT_SYNCHRONOUS;
+    PyObject *py_seccomp = NULL;
+    PyObject *py_eventlog = NULL;
+    PyObject *py_dedup = NULL;
+    PyObject *py_stats = NULL;
+    const char *profile = "full";
+    PyObject *py_exclude = NULL;
+    PyObject *py_databasepath;
+    if(!(PyArg_ParseTupleAndKeywords(args, kwargs, "iOi|iiizzOOOOsO", kwlist,
+                                     &pid, &py_databasepath, &verbosity,
+                                     &duration,
+                                     &commit_events, &commit_interval,
+                                     &journal_mode, &synchronous,
+                                     &py_seccomp, &py_eventlog,
+                                     &py_dedup, &py_stats, &profile,
+                                     &py_exclude)))
+        return NULL;
+
+    if(pid <= 0)
+    {
+        PyErr_SetString(Err_Base, "pid should be > 0");
+        return NULL;
+    }
+    if(duration < 0)
+    {
+        PyErr_SetString(Err_Base, "duration should be >= 0");
+        return NULL;
+    }
+    if(set_options(verbosity, commit_events, commit_interval,
+                   journal_mode, synchronous, py_seccomp, py_eventlog,
+                   py_dedup, profile, py_exclude) != 0)
+        return NULL;
+
+    databasepath = get_string(py_databasepath);
+    if(databasepath == NULL)
+        return NULL;
+
+    if(attach_and_trace(pid, duration, databasepath, &exit_status) == 0)
+    {
+        PyObject *status;
+        if(exit_status == -1)
+        {
+            Py_INCREF(Py_None);
+            status = Py_None;
+        }
+        else
+            status = PyLong_FromLong(exit_status);
+        ret = make_result(status, py_stats);
+    }
+    else
+    {
+        PyErr_SetString(Err_Base, "Error occurred");
+        ret = NULL;
+    }
+
+    free(databasepath);
+    return ret;
+}
+
+
+static PyObject *pytracer_load_event_log(PyObject *self, PyObject *args)
+{
+    PyObject *py_eventlog, *py_databasepath;
+    char *eventlog, *databasepath;
+    unsigned int commit_events = db_commit_events;
+    unsigned int commit_interval = db_commit_interval;
+    int ret;
+
+    if(!PyArg_ParseTuple(args, "OO", &py_eventlog, &py_databasepath))
+        return NULL;
+    eventlog = get_string(py_eventlog);
+    if(eventlog == NULL)
+        return NULL;
+    databasepath = get_string(py_databasepath);
+    if(databasepath == NULL)
+    {
+        free(eventlog);
+        return NULL;
+    }
+
+    /* Loads everything in a single transaction */
+    db_use_event_log = 0;
+    db_commit_events = 0;
+    db_commit_interval = 0;
+    ret = db_init(databasepath);
+    if(ret == 0)
+    {
+        ret = db_load_event_log(eventlog);
+        if(db_close() != 0)
+            ret = -1;
+        path_intern_free();
+    }
+    db_commit_events = commit_events;
+    db_commit_interval = commit_interval;
+
+    free(eventlog);
+    free(databasepath);
+
+    if(ret != 0)
+    {
+        PyErr_SetString(Err_Base, "Error occurred");
+        return NULL;
+    }
+    return get_db_stats();
+}
+
+
 static PyMethodDef methods[] = {
-    {"execute", pytracer_execute, METH_VARARGS,
-     "execute(binary, argv, databasepath, verbosity)\n"
+    {"execute", (PyCFunction)pytracer_execute,
+     METH_VARARGS | METH_KEYWORDS,
+     "execute(binary, argv, databasepath, verbosity, commit_events=1000,\n"
+     "        commit_interval=1000, journal_mode=None, "
+     "synchronous='NORMAL',\n"
+     "        seccomp=False, eventlog=False, dedup=False, stats=False,\n"
+     "        profile='full', exclude=None)\n"
      "\n"
      "Runs the specified binary with the argument list argv under trace and "
-     "writes\nthe captured events to SQLite3 database databasepath."},
+     "writes\nthe captured events to SQLite3 database databasepath.\n"
+     "\n"
+     "Events are committed every commit_events events or every "
+     "commit_interval\nmilliseconds (0 disables either criterion). "
+     "journal_mode and synchronous set\nthe corresponding SQLite pragmas "
+     "(None keeps SQLite's default).\n"
+     "\n"
+     "If seccomp is True, a seccomp filter is installed so that the traced "
+     "processes\nonly stop on the syscalls the tracer handles (requires "
+     "Linux 4.8; setuid\nprograms will not gain privileges).\n"
+     "\n"
+     "If eventlog is True, databasepath is instead a binary event log "
+     "file, to be\nloaded with load_event_log().\n"
+     "\n"
+     "If dedup is True, repeated accesses of a process to a file with the "
+     "same mode\nare recorded once, with their number in the occurrences "
+     "column.\n"
+     "\n"
+     "profile selects which syscalls are handled: 'full', 'files-only' "
+     "(no stat(),\naccess(), readlink(), or network connections) or "
+     "'exec-only' (only\nexecutions and changes to the filesystem).\n"
+     "\n"
+     "Accesses to paths under the prefixes in exclude are not recorded.\n"
+     "\n"
+     "Returns the exit status of the program, or if stats is True, a tuple "
+     "of the\nexit status and a dictionary of counters about the tracer's "
+     "overhead."},
+    {"attach", (PyCFunction)pytracer_attach,
+     METH_VARARGS | METH_KEYWORDS,
+     "attach(pid, databasepath, verbosity, duration=0, commit_events=1000,\n"
+     "       commit_interval=1000, journal_mode=None, "
+     "synchronous='NORMAL',\n"
+     "       seccomp=False, eventlog=False, dedup=False, stats=False,\n"
+     "       profile='full', exclude=None)\n"
+     "\n"
+     "Traces the running process pid and its descendants, until they exit, "
+     "duration\nseconds have elapsed (0 for no limit), or SIGINT or SIGTERM "
+     "is received, then\ndetaches and leaves them running. The options are "
+     "the same as execute()'s,\nexcept that seccomp is not available.\n"
+     "\n"
+     "Returns the exit status of the process, or None if it is still "
+     "running, or if\nstats is True, a tuple of that and a dictionary of "
+     "counters."},
+    {"load_event_log", pytracer_load_event_log, METH_VARARGS,
+     "load_event_log(eventlog, databasepath)\n"
+     "\n"
+     "Inserts the events from the binary log written by execute() in "
+     "SQLite3\ndatabase databasepath, creating it if needed.\n"
+     "\n"
+     "Returns a dictionary of counters about the insertions."},
     { NULL, NULL, 0, NULL }
 };
 
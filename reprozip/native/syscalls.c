@@ -1,12 +1,19 @@
+#include <errno.h>
+#include <stddef.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 
 #include <arpa/inet.h>
 #include <fcntl.h>
+#include <linux/audit.h>
+#include <linux/filter.h>
+#include <linux/seccomp.h>
 #include <netdb.h>
 #include <netinet/in.h>
 #include <sched.h>
+#include <sys/prctl.h>
 #include <sys/ptrace.h>
 #include <sys/socket.h>
 #include <sys/stat.h>
@@ -34,15 +41,12 @@
 #endif
 
 
-#define SYSCALL_I386        0
-#define SYSCALL_X86_64      1
-#define SYSCALL_X86_64_x32  2
-
-
 #define verbosity trace_verbosity
 
+#define count(x) (sizeof((x))/sizeof(*(x)))
+
 struct ExecveInfo {
-    char *binary;
+    unsigned int binary;
     char **argv;
     char **envp;
 };
@@ -60,19 +64,41 @@ struct syscall_table {
     struct syscall_table_entry *entries;
 };
 
+#if defined(I386)
+#define NB_SYSCALL_TABLES 1
+#elif defined(X86_64)
+#define NB_SYSCALL_TABLES 3
+#else
+#   error Unrecognized architecture!
+#endif
+
 struct syscall_table *syscall_tables = NULL;
 
+/* Groups the current tables were built with */
+static unsigned int syscall_tables_groups = 0;
+
 
-static char *abs_path_arg(const struct Process *process, size_t arg)
+/**
+ * Whether a dirfd argument is AT_FDCWD.
+ *
+ * dirfd is an int: on x86_64, the upper half of the register is not
+ * sign-extended, so it can't be compared to AT_FDCWD as a long.
+ */
+static int is_at_fdcwd(const struct Process *process, size_t arg)
+{
+    return (int)process->params[arg].i == AT_FDCWD;
+}
+
+
+/**
+ * Reads a path from the tracee, makes it absolute and interns it.
+ */
+static unsigned int abs_path_arg(const struct Process *process, size_t arg)
 {
     char *pathname = tracee_strdup(process->tid, process->params[arg].p);
-    if(pathname[0] != '/')
-    {
-        char *oldpath = pathname;
-        pathname = abspath(process->wd, oldpath);
-        free(oldpath);
-    }
-    return pathname;
+    unsigned int path = path_intern_abs(process->wd, pathname);
+    free(pathname);
+    return path;
 }
 
 
@@ -111,16 +137,9 @@ static int syscall_unhandled_path1(const char *name, struct Process *process,
     if(verbosity >= 1 && process->in_syscall && process->retvalue.i >= 0
      && name != NULL)
     {
-        char *pathname = tracee_strdup(process->tid,
-                                       process->params[0].p);
-        if(pathname[0] != '/')
-        {
-            char *oldpath = pathname;
-            pathname = abspath(process->wd, oldpath);
-            free(oldpath);
-        }
+        unsigned int path = abs_path_arg(process, 0);
         log_warn(process->tid, "process used unhandled system call %s(\"%s\")",
-                 name, pathname);
+                 name, path_string(path));
     }
     return 0;
 }
@@ -147,7 +166,8 @@ static int syscall_fileopening(const char *name, struct Process *process,
                                unsigned int syscall)
 {
     unsigned int mode;
-    char *pathname = abs_path_arg(process, 0);
+    unsigned int path = abs_path_arg(process, 0);
+    const char *pathname = path_string(path);
 
     if(syscall == SYSCALL_OPENING_ACCESS)
         mode = FILE_STAT;
@@ -193,13 +213,12 @@ static int syscall_fileopening(const char *name, struct Process *process,
     if(process->retvalue.i >= 0)
     {
         if(db_add_file_open(process->identifier,
-                            pathname,
+                            path,
                             mode,
-                            path_is_dir(pathname)) != 0)
+                            path_is_dir(path)) != 0)
             return -1;
     }
 
-    free(pathname);
     return 0;
 }
 
@@ -211,16 +230,15 @@ static int syscall_fileopening(const char *name, struct Process *process,
 static int syscall_filestat(const char *name, struct Process *process,
                         unsigned int udata)
 {
-    char *pathname = abs_path_arg(process, 0);
+    unsigned int path = abs_path_arg(process, 0);
     if(process->retvalue.i >= 0)
     {
         if(db_add_file_open(process->identifier,
-                            pathname,
+                            path,
                             FILE_STAT,
-                            path_is_dir(pathname)) != 0)
+                            path_is_dir(path)) != 0)
             return -1;
     }
-    free(pathname);
     return 0;
 }
 
@@ -232,16 +250,15 @@ static int syscall_filestat(const char *name, struct Process *process,
 static int syscall_readlink(const char *name, struct Process *process,
                             unsigned int udata)
 {
-    char *pathname = abs_path_arg(process, 0);
+    unsigned int path = abs_path_arg(process, 0);
     if(process->retvalue.i >= 0)
     {
         if(db_add_file_open(process->identifier,
-                            pathname,
+                            path,
                             FILE_STAT,
                             0) != 0)
             return -1;
     }
-    free(pathname);
     return 0;
 }
 
@@ -253,11 +270,13 @@ static int syscall_readlink(const char *name, struct Process *process,
 static int syscall_mkdir(const char *name, struct Process *process,
                          unsigned int udata)
 {
-    char *pathname = abs_path_arg(process, 0);
+    unsigned int path = abs_path_arg(process, 0);
+    /* No need to invalidate the path cache: mkdir() only succeeds if nothing
+     * was there, and nothing is cached for paths that don't exist */
     if(process->retvalue.i >= 0)
     {
         if(db_add_file_open(process->identifier,
-                            pathname,
+                            path,
                             FILE_WRITE,
                             1) != 0)
             return -1;
@@ -273,17 +292,27 @@ static int syscall_mkdir(const char *name, struct Process *process,
 static int syscall_symlink(const char *name, struct Process *process,
                            unsigned int is_symlinkat)
 {
-    char *pathname;
-    if(is_symlinkat && process->params[1].i != AT_FDCWD)
+    unsigned int path;
+    if(is_symlinkat && !is_at_fdcwd(process, 1))
+    {
+        if(process->retvalue.i >= 0)
+        {
+            path_cache_invalidate(0);
+            path_resolve_invalidate(0);
+        }
         return syscall_unhandled_other(name, process, 0);
+    }
     else if(is_symlinkat)
-        pathname = abs_path_arg(process, 2);
+        path = abs_path_arg(process, 2);
     else /* symlink */
-        pathname = abs_path_arg(process, 1);
+        path = abs_path_arg(process, 1);
     if(process->retvalue.i >= 0)
     {
+        path_cache_invalidate(path);
+        /* The new link might be in the way of a path that was resolved */
+        path_resolve_invalidate(0);
         if(db_add_file_open(process->identifier,
-                            pathname,
+                            path,
                             FILE_WRITE,
                             1) != 0)
             return -1;
@@ -292,6 +321,41 @@ static int syscall_symlink(const char *name, struct Process *process,
 }
 
 
+/* ********************
+ * unlink(), rmdir(), rename()
+ *
+ * These are not recorded, but they change what's at a path, so the cached
+ * result of path_is_dir() has to go, as well as resolved paths if a link was
+ * removed.
+ */
+
+#define SYSCALL_REMOVE          1
+#define SYSCALL_REMOVE_AT       2
+#define SYSCALL_RENAME          3
+#define SYSCALL_RENAME_AT       4
+
+static int syscall_path_changed(const char *name, struct Process *process,
+                                unsigned int syscall)
+{
+    if(process->retvalue.i >= 0)
+    {
+        unsigned int path = 0;
+        if(syscall == SYSCALL_REMOVE)
+            path = abs_path_arg(process, 0);
+        else if(syscall == SYSCALL_REMOVE_AT && is_at_fdcwd(process, 0))
+            path = abs_path_arg(process, 1);
+        /* If path is 0, we don't know which paths were affected (relative to
+         * a file descriptor, or a whole directory tree got moved) */
+        path_cache_invalidate(path);
+        path_resolve_invalidate(path);
+    }
+    if(syscall == SYSCALL_REMOVE || syscall == SYSCALL_RENAME)
+        return syscall_unhandled_path1(name, process, 0);
+    else
+        return syscall_unhandled_other(name, process, 0);
+}
+
+
 /* ********************
  * chdir()
  */
@@ -299,19 +363,16 @@ static int syscall_symlink(const char *name, struct Process *process,
 static int syscall_chdir(const char *name, struct Process *process,
                          unsigned int udata)
 {
-    char *pathname = abs_path_arg(process, 0);
+    unsigned int path = abs_path_arg(process, 0);
     if(process->retvalue.i >= 0)
     {
-        free(process->wd);
-        process->wd = pathname;
+        process->wd = path;
         if(db_add_file_open(process->identifier,
-                            pathname,
+                            path,
                             FILE_WDIR,
                             1) != 0)
             return -1;
     }
-    else
-        free(pathname);
     return 0;
 }
 
@@ -335,7 +396,7 @@ static int syscall_execve_in(const char *name, struct Process *process,
     if(verbosity >= 3)
     {
         log_debug(process->tid, "execve called:\n  binary=%s\n  argv:",
-                  execi->binary);
+                  path_string(execi->binary));
         {
             /* Note: this conversion is correct and shouldn't need a
              * cast */
@@ -357,6 +418,23 @@ static int syscall_execve_in(const char *name, struct Process *process,
     return 0;
 }
 
+/**
+ * Finds the thread of a thread group that is in a call to execve().
+ */
+static struct Process *find_execve_caller(pid_t tgid, int execve_syscall)
+{
+    struct Process *p;
+    for(p = trace_first_in_group(tgid); p != NULL; p = trace_next_in_group(p))
+    {
+        if(p->status == PROCESS_ATTACHED
+         && p->in_syscall
+         && p->current_syscall == execve_syscall
+         && p->syscall_info != NULL)
+            return p;
+    }
+    return NULL;
+}
+
 static int syscall_execve_out(const char *name, struct Process *process,
                               unsigned int execve_syscall)
 {
@@ -371,19 +449,7 @@ static int syscall_execve_out(const char *name, struct Process *process,
          * So we start by finding the one which called execve.
          * Possible confusion here if two threads call execve at the same
          * time, but that would be very bad code. */
-        size_t i;
-        for(i = 0; i < processes_size; ++i)
-        {
-            if(processes[i]->status == PROCESS_ATTACHED
-             && processes[i]->tgid == process->tgid
-             && processes[i]->in_syscall
-             && processes[i]->current_syscall == (int)execve_syscall
-             && processes[i]->syscall_info != NULL)
-            {
-                exec_process = processes[i];
-                break;
-            }
-        }
+        exec_process = find_execve_caller(process->tgid, (int)execve_syscall);
         if(exec_process == NULL)
         {
             /* LCOV_EXCL_START : internal error */
@@ -397,8 +463,7 @@ static int syscall_execve_out(const char *name, struct Process *process,
         /* The process that called execve() disappears without any trace */
         if(db_add_exit(exec_process->identifier, 0) != 0)
             return -1;
-        free(exec_process->wd);
-        exec_process->status = PROCESS_FREE;
+        trace_free_process(exec_process);
     }
     if(process->retvalue.i >= 0)
     {
@@ -415,16 +480,15 @@ static int syscall_execve_out(const char *name, struct Process *process,
          * called execve, instead of thread exec_process->tid. */
         if(verbosity >= 2)
             log_info(exec_process->tid, "successfully exec'd %s",
-                     execi->binary);
+                     path_string(execi->binary));
         /* Process will get SIGTRAP with PTRACE_EVENT_EXEC */
         if(trace_add_files_from_proc(process->identifier, process->tid,
-                                     execi->binary) != 0)
+                                     path_string(execi->binary)) != 0)
             return -1;
     }
 
     free_strarray(execi->argv);
     free_strarray(execi->envp);
-    free(execi->binary);
     free(execi);
     exec_process->syscall_info = NULL;
     return 0;
@@ -460,7 +524,7 @@ static int syscall_forking(const char *name, struct Process *process,
                      (syscall == SYSCALL_FORK_VFORK)?"vfork()":
                      "clone()",
                      is_thread?"yes":"no",
-                     process->wd);
+                     path_string(process->wd));
 
         /* At this point, the process might have been seen by waitpid in
          * trace() or not. */
@@ -477,8 +541,8 @@ static int syscall_forking(const char *name, struct Process *process,
                 return -1;
                 /* LCOV_EXCL_END */
             }
-            new_process->status = PROCESS_ATTACHED;
-            ptrace(PTRACE_SYSCALL, new_process->tid, NULL, NULL);
+            trace_set_status(new_process, PROCESS_ATTACHED);
+            trace_resume(new_process, 0);
             if(verbosity >= 2)
             {
                 unsigned int nproc, unknown;
@@ -490,17 +554,14 @@ static int syscall_forking(const char *name, struct Process *process,
         else
         {
             /* Process hasn't been seen before (syscall returned first) */
-            new_process = trace_get_empty_process();
-            new_process->status = PROCESS_ALLOCATED;
+            new_process = trace_new_process(new_tid, PROCESS_ALLOCATED);
             /* New process gets a SIGSTOP, but we resume on attach */
-            new_process->tid = new_tid;
-            new_process->in_syscall = 0;
         }
         if(is_thread)
-            new_process->tgid = process->tgid;
+            trace_set_tgid(new_process, process->tgid);
         else
-            new_process->tgid = new_process->tid;
-        new_process->wd = strdup(process->wd);
+            trace_set_tgid(new_process, new_process->tid);
+        new_process->wd = process->wd;
 
         /* Parent will also get a SIGTRAP with PTRACE_EVENT_FORK */
 
@@ -590,7 +651,7 @@ static int syscall_connect(const char *name, struct Process *process,
 static int syscall_xxx_at(const char *name, struct Process *process,
                           unsigned int real_syscall)
 {
-    if(process->params[0].i == AT_FDCWD)
+    if(is_at_fdcwd(process, 0))
     {
         struct syscall_table_entry *entry = NULL;
         struct syscall_table *tbl;
@@ -643,8 +704,72 @@ struct unprocessed_table_entry {
 
 };
 
+static const struct {
+    const char *name;
+    unsigned int groups;
+} syscall_profiles[] = {
+    {"full", SYSCALL_GROUPS_ALL},
+    {"files-only", SYSCALL_GROUP_PROCESSES | SYSCALL_GROUP_CHANGES
+                 | SYSCALL_GROUP_OPEN},
+    {"exec-only", SYSCALL_GROUP_PROCESSES | SYSCALL_GROUP_CHANGES},
+    {NULL, 0}
+};
+
+int syscall_profile(const char *name, unsigned int *groups)
+{
+    size_t i;
+    for(i = 0; syscall_profiles[i].name != NULL; ++i)
+    {
+        if(strcmp(syscall_profiles[i].name, name) == 0)
+        {
+            *groups = syscall_profiles[i].groups;
+            return 0;
+        }
+    }
+    return -1;
+}
+
+/**
+ * Returns the group of an entry, from its handler.
+ *
+ * The *at() variants are in the group of the syscall they dispatch to, which
+ * is looked up in the same list.
+ */
+static unsigned int entry_group(const struct unprocessed_table_entry *list,
+                                const struct unprocessed_table_entry *entry)
+{
+    const struct unprocessed_table_entry *pos;
+    if(entry->proc_exit == syscall_xxx_at)
+    {
+        for(pos = list; pos->proc_entry || pos->proc_exit; ++pos)
+            if(pos->n == entry->udata)
+                return entry_group(list, pos);
+        return SYSCALL_GROUP_UNHANDLED; /* LCOV_EXCL_LINE */
+    }
+    else if(entry->proc_exit == syscall_fileopening)
+        return (entry->udata == SYSCALL_OPENING_ACCESS)?
+            SYSCALL_GROUP_STAT:SYSCALL_GROUP_OPEN;
+    else if(entry->proc_exit == syscall_filestat
+          || entry->proc_exit == syscall_readlink)
+        return SYSCALL_GROUP_STAT;
+    else if(entry->proc_exit == syscall_mkdir
+          || entry->proc_exit == syscall_symlink
+          || entry->proc_exit == syscall_path_changed)
+        return SYSCALL_GROUP_CHANGES;
+    else if(entry->proc_exit == syscall_accept
+          || entry->proc_exit == syscall_connect
+          || entry->proc_exit == syscall_socketcall)
+        return SYSCALL_GROUP_NETWORK;
+    else if(entry->proc_exit == syscall_unhandled_path1
+          || entry->proc_exit == syscall_unhandled_other)
+        return SYSCALL_GROUP_UNHANDLED;
+    else /* execve(), fork(), chdir() */
+        return SYSCALL_GROUP_PROCESSES;
+}
+
 struct syscall_table *process_table(struct syscall_table *table,
-                                    const struct unprocessed_table_entry *orig)
+                                    const struct unprocessed_table_entry *orig,
+                                    unsigned int groups)
 {
     size_t i, length = 0;
     const struct unprocessed_table_entry *pos;
@@ -675,6 +800,11 @@ struct syscall_table *process_table(struct syscall_table *table,
         pos = orig;
         while(pos->proc_entry || pos->proc_exit)
         {
+            if(!(entry_group(orig, pos) & groups))
+            {
+                ++pos;
+                continue;
+            }
             table->entries[pos->n].name = pos->name;
             table->entries[pos->n].proc_entry = pos->proc_entry;
             table->entries[pos->n].proc_exit = pos->proc_exit;
@@ -686,18 +816,23 @@ struct syscall_table *process_table(struct syscall_table *table,
     return table;
 }
 
-void syscall_build_table(void)
+void syscall_build_table(unsigned int groups)
 {
+    /* The groups we can't do without */
+    groups |= SYSCALL_GROUP_PROCESSES | SYSCALL_GROUP_CHANGES;
+
     if(syscall_tables != NULL)
-        return ;
+    {
+        size_t i;
+        if(groups == syscall_tables_groups)
+            return ;
+        for(i = 0; i < NB_SYSCALL_TABLES; ++i)
+            free(syscall_tables[i].entries);
+        free(syscall_tables);
+    }
+    syscall_tables_groups = groups;
 
-#if defined(I386)
-    syscall_tables = malloc(1 * sizeof(struct syscall_table));
-#elif defined(X86_64)
-    syscall_tables = malloc(3 * sizeof(struct syscall_table));
-#else
-#   error Unrecognized architecture!
-#endif
+    syscall_tables = malloc(NB_SYSCALL_TABLES * sizeof(struct syscall_table));
 
     /* i386 */
     {
@@ -739,12 +874,12 @@ void syscall_build_table(void)
             {304, "symlinkat", NULL, syscall_symlink, 1},
 
             /* Unhandled with path as first argument */
-            { 38, "rename", NULL, syscall_unhandled_path1, 0},
-            { 40, "rmdir", NULL, syscall_unhandled_path1, 0},
+            { 38, "rename", NULL, syscall_path_changed, SYSCALL_RENAME},
+            { 40, "rmdir", NULL, syscall_path_changed, SYSCALL_REMOVE},
             {  9, "link", NULL, syscall_unhandled_path1, 0},
             { 92, "truncate", NULL, syscall_unhandled_path1, 0},
             {193, "truncate64", NULL, syscall_unhandled_path1, 0},
-            { 10, "unlink", NULL, syscall_unhandled_path1, 0},
+            { 10, "unlink", NULL, syscall_path_changed, SYSCALL_REMOVE},
             { 15, "chmod", NULL, syscall_unhandled_path1, 0},
             {182, "chown", NULL, syscall_unhandled_path1, 0},
             {212, "chown32", NULL, syscall_unhandled_path1, 0},
@@ -757,8 +892,12 @@ void syscall_build_table(void)
 
             /* Unhandled which use open descriptors */
             {303, "linkat", NULL, syscall_unhandled_other, 0},
-            {302, "renameat", NULL, syscall_unhandled_other, 0},
-            {301, "unlinkat", NULL, syscall_unhandled_other, 0},
+            {302, "renameat", NULL, syscall_path_changed,
+             SYSCALL_RENAME_AT},
+            {353, "renameat2", NULL, syscall_path_changed,
+             SYSCALL_RENAME_AT},
+            {301, "unlinkat", NULL, syscall_path_changed,
+             SYSCALL_REMOVE_AT},
             {306, "fchmodat", NULL, syscall_unhandled_other, 0},
             {298, "fchownat", NULL, syscall_unhandled_other, 0},
 
@@ -769,7 +908,7 @@ void syscall_build_table(void)
             /* Sentinel */
             {0, NULL, NULL, NULL, 0}
         };
-        process_table(&syscall_tables[SYSCALL_I386], list);
+        process_table(&syscall_tables[SYSCALL_I386], list, groups);
     }
 
 #ifdef X86_64
@@ -811,11 +950,11 @@ void syscall_build_table(void)
             {266, "symlinkat", NULL, syscall_symlink, 1},
 
             /* Unhandled with path as first argument */
-            { 82, "rename", NULL, syscall_unhandled_path1, 0},
-            { 84, "rmdir", NULL, syscall_unhandled_path1, 0},
+            { 82, "rename", NULL, syscall_path_changed, SYSCALL_RENAME},
+            { 84, "rmdir", NULL, syscall_path_changed, SYSCALL_REMOVE},
             { 86, "link", NULL, syscall_unhandled_path1, 0},
             { 76, "truncate", NULL, syscall_unhandled_path1, 0},
-            { 87, "unlink", NULL, syscall_unhandled_path1, 0},
+            { 87, "unlink", NULL, syscall_path_changed, SYSCALL_REMOVE},
             { 90, "chmod", NULL, syscall_unhandled_path1, 0},
             { 92, "chown", NULL, syscall_unhandled_path1, 0},
             { 94, "lchown", NULL, syscall_unhandled_path1, 0},
@@ -826,8 +965,12 @@ void syscall_build_table(void)
 
             /* Unhandled which use open descriptors */
             {265, "linkat", NULL, syscall_unhandled_other, 0},
-            {264, "renameat", NULL, syscall_unhandled_other, 0},
-            {263, "unlinkat", NULL, syscall_unhandled_other, 0},
+            {264, "renameat", NULL, syscall_path_changed,
+             SYSCALL_RENAME_AT},
+            {316, "renameat2", NULL, syscall_path_changed,
+             SYSCALL_RENAME_AT},
+            {263, "unlinkat", NULL, syscall_path_changed,
+             SYSCALL_REMOVE_AT},
             {268, "fchmodat", NULL, syscall_unhandled_other, 0},
             {260, "fchownat", NULL, syscall_unhandled_other, 0},
 
@@ -838,7 +981,7 @@ void syscall_build_table(void)
             /* Sentinel */
             {0, NULL, NULL, NULL, 0}
         };
-        process_table(&syscall_tables[SYSCALL_X86_64], list);
+        process_table(&syscall_tables[SYSCALL_X86_64], list, groups);
     }
 
     /* x32 */
@@ -880,11 +1023,11 @@ void syscall_build_table(void)
             {266, "symlinkat", NULL, syscall_symlink, 1},
 
             /* Unhandled with path as first argument */
-            { 82, "rename", NULL, syscall_unhandled_path1, 0},
-            { 84, "rmdir", NULL, syscall_unhandled_path1, 0},
+            { 82, "rename", NULL, syscall_path_changed, SYSCALL_RENAME},
+            { 84, "rmdir", NULL, syscall_path_changed, SYSCALL_REMOVE},
             { 86, "link", NULL, syscall_unhandled_path1, 0},
             { 76, "truncate", NULL, syscall_unhandled_path1, 0},
-            { 87, "unlink", NULL, syscall_unhandled_path1, 0},
+            { 87, "unlink", NULL, syscall_path_changed, SYSCALL_REMOVE},
             { 90, "chmod", NULL, syscall_unhandled_path1, 0},
             { 92, "chown", NULL, syscall_unhandled_path1, 0},
             { 94, "lchown", NULL, syscall_unhandled_path1, 0},
@@ -895,8 +1038,12 @@ void syscall_build_table(void)
 
             /* Unhandled which use open descriptors */
             {265, "linkat", NULL, syscall_unhandled_other, 0},
-            {264, "renameat", NULL, syscall_unhandled_other, 0},
-            {263, "unlinkat", NULL, syscall_unhandled_other, 0},
+            {264, "renameat", NULL, syscall_path_changed,
+             SYSCALL_RENAME_AT},
+            {316, "renameat2", NULL, syscall_path_changed,
+             SYSCALL_RENAME_AT},
+            {263, "unlinkat", NULL, syscall_path_changed,
+             SYSCALL_REMOVE_AT},
             {268, "fchmodat", NULL, syscall_unhandled_other, 0},
             {260, "fchownat", NULL, syscall_unhandled_other, 0},
 
@@ -907,7 +1054,7 @@ void syscall_build_table(void)
             /* Sentinel */
             {0, NULL, NULL, NULL, 0}
         };
-        process_table(&syscall_tables[SYSCALL_X86_64_x32], list);
+        process_table(&syscall_tables[SYSCALL_X86_64_x32], list, groups);
     }
 #endif
 }
@@ -917,76 +1064,83 @@ void syscall_build_table(void)
  * Handle a syscall via the table
  */
 
-int syscall_handle(struct Process *process)
+const char *syscall_name(size_t syscall_type, int syscall)
+{
+    struct syscall_table *tbl;
+    if(syscall_tables == NULL || syscall_type >= SYSCALL_TYPES)
+        return NULL;
+    tbl = &syscall_tables[syscall_type];
+    if(syscall < 0 || (size_t)syscall >= tbl->length)
+        return NULL;
+    return tbl->entries[syscall].name;
+}
+
+/**
+ * Returns the syscall table for the current syscall of a process.
+ */
+static size_t process_syscall_type(const struct Process *process)
 {
-    pid_t tid = process->tid;
-    const int syscall = process->current_syscall & ~__X32_SYSCALL_BIT;
-    size_t syscall_type;
     if(process->mode == MODE_I386)
-    {
-        syscall_type = SYSCALL_I386;
-        if(verbosity >= 4)
-            log_debug(process->tid, "syscall %d (i386)", syscall);
-    }
+        return SYSCALL_I386;
     else if(process->current_syscall & __X32_SYSCALL_BIT)
-    {
-        /* LCOV_EXCL_START : x32 is not supported right now */
-        syscall_type = SYSCALL_X86_64_x32;
-        if(verbosity >= 4)
-            log_debug(process->tid, "syscall %d (x32)", syscall);
-        /* LCOV_EXCL_END */
-    }
+        return SYSCALL_X86_64_x32; /* LCOV_EXCL_LINE : x32 is not supported
+                                    * right now */
     else
-    {
-        syscall_type = SYSCALL_X86_64;
-        if(verbosity >= 4)
-            log_debug(process->tid, "syscall %d (x64)", syscall);
-    }
+        return SYSCALL_X86_64;
+}
+
+int syscall_exit_handled(const struct Process *process)
+{
+    const int syscall = process->current_syscall & ~__X32_SYSCALL_BIT;
+    const struct syscall_table *tbl =
+            &syscall_tables[process_syscall_type(process)];
+    if(syscall < 0 || (size_t)syscall >= tbl->length)
+        return 0;
+    return tbl->entries[syscall].proc_exit != NULL;
+}
+
+int syscall_handle(struct Process *process)
+{
+    static const char *const type_names[SYSCALL_TYPES] = {
+        "i386", "x64", "x32"};
+    const int syscall = process->current_syscall & ~__X32_SYSCALL_BIT;
+    const size_t syscall_type = process_syscall_type(process);
+    if(verbosity >= 4)
+        log_debug(process->tid, "syscall %d (%s)",
+                  syscall, type_names[syscall_type]);
 
     {
         struct syscall_table_entry *entry = NULL;
         struct syscall_table *tbl = &syscall_tables[syscall_type];
         if(syscall < 0 || syscall >= 2000)
             log_error(process->tid, "INVALID SYSCALL %d", syscall);
+        if(syscall >= 0 && syscall < TRACE_STATS_SYSCALLS)
+            ++trace_stats.syscall_stops[syscall_type][syscall];
+        else
+            ++trace_stats.other_stops;
 #ifdef X86_64
         /* Workaround for execve() transition x64 -> i386 */
         if(syscall == 59 && process->in_syscall)
         {
-            size_t i;
-            for(i = 0; i < processes_size; ++i)
+            if(find_execve_caller(process->tgid, 59) != NULL)
             {
-                if(processes[i]->status == PROCESS_ATTACHED
-                 && processes[i]->tgid == process->tgid
-                 && processes[i]->in_syscall
-                 && processes[i]->current_syscall == 59
-                 && processes[i]->syscall_info != NULL)
-                {
-                    if(verbosity >= 3)
-                        log_debug(process->tid,
-                                  "transition x64 -> i386, syscall 59 is still "
-                                  "execve");
-                    entry = &syscall_tables[SYSCALL_X86_64].entries[59];
-                }
+                if(verbosity >= 3)
+                    log_debug(process->tid,
+                              "transition x64 -> i386, syscall 59 is still "
+                              "execve");
+                entry = &syscall_tables[SYSCALL_X86_64].entries[59];
             }
         }
         /* Workaround for execve() transition i386 -> x64 */
         else if(syscall == 11 && process->in_syscall)
         {
-            size_t i;
-            for(i = 0; i < processes_size; ++i)
+            if(find_execve_caller(process->tgid, 11) != NULL)
             {
-                if(processes[i]->status == PROCESS_ATTACHED
-                 && processes[i]->tgid == process->tgid
-                 && processes[i]->in_syscall
-                 && processes[i]->current_syscall == 11
-                 && processes[i]->syscall_info != NULL)
-                {
-                    if(verbosity >= 3)
-                        log_debug(process->tid,
-                                  "transition i386 -> x64, syscall 11 is still "
-                                  "execve");
-                    entry = &syscall_tables[SYSCALL_I386].entries[11];
-                }
+                if(verbosity >= 3)
+                    log_debug(process->tid,
+                              "transition i386 -> x64, syscall 11 is still "
+                              "execve");
+                entry = &syscall_tables[SYSCALL_I386].entries[11];
             }
         }
         else
@@ -1016,7 +1170,146 @@ int syscall_handle(struct Process *process)
     }
     else
         process->in_syscall = 1;
-    ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+    trace_resume(process, 0);
 
     return 0;
 }
+
+int syscall_handle_missed_entry(struct Process *process)
+{
+    const int syscall = process->current_syscall & ~__X32_SYSCALL_BIT;
+    const struct syscall_table *tbl =
+            &syscall_tables[process_syscall_type(process)];
+    if(verbosity >= 3)
+        log_debug(process->tid, "exit of syscall %d, entered before we "
+                  "attached", syscall);
+    ++trace_stats.other_stops;
+    if(syscall >= 0 && (size_t)syscall < tbl->length)
+    {
+        const struct syscall_table_entry *entry = &tbl->entries[syscall];
+        /* Exits that use what their entry recorded can't be handled */
+        if(entry->proc_exit != NULL && entry->proc_entry == NULL)
+        {
+            if(entry->proc_exit(entry->name, process, entry->udata) != 0)
+                return -1;
+        }
+    }
+
+    process->in_syscall = 0;
+    process->current_syscall = -1;
+    process->syscall_info = NULL;
+    trace_resume(process, 0);
+    return 0;
+}
+
+
+/* ********************
+ * seccomp filter, so that we only stop on the syscalls from the table
+ */
+
+#define BPF_STMT_(code, k) { (unsigned short)(code), 0, 0, (k) }
+#define BPF_JUMP_(code, k, jt, jf) \
+    { (unsigned short)(code), (unsigned char)(jt), (unsigned char)(jf), (k) }
+
+/**
+ * Adds the filter instructions for one architecture.
+ *
+ * Checks that the architecture is arch, then traps if the syscall number is
+ * in one of the given tables (x32 syscalls are reported with the x86_64
+ * architecture). Returns the new instruction count.
+ */
+static size_t build_filter_arch(struct sock_filter *filter, size_t pos,
+                                uint32_t arch,
+                                const struct syscall_table *tables,
+                                const uint32_t *offsets, size_t nb_tables)
+{
+    size_t i, t, nb_syscalls = 0;
+    for(t = 0; t < nb_tables; ++t)
+        for(i = 0; i < tables[t].length; ++i)
+            if(tables[t].entries[i].proc_entry
+             || tables[t].entries[i].proc_exit)
+                ++nb_syscalls;
+
+    {
+        struct sock_filter header[] = {
+            BPF_STMT_(BPF_LD | BPF_W | BPF_ABS,
+                      offsetof(struct seccomp_data, arch)),
+            /* If not this architecture, skip this whole block (which is
+             * syscall load + comparisons + 2 returns) */
+            BPF_JUMP_(BPF_JMP | BPF_JEQ | BPF_K, arch, 0, nb_syscalls + 3),
+            BPF_STMT_(BPF_LD | BPF_W | BPF_ABS,
+                      offsetof(struct seccomp_data, nr)),
+        };
+        memcpy(filter + pos, header, sizeof(header));
+        pos += count(header);
+    }
+    for(t = 0; t < nb_tables; ++t)
+    {
+        for(i = 0; i < tables[t].length; ++i)
+        {
+            if(tables[t].entries[i].proc_entry
+             || tables[t].entries[i].proc_exit)
+            {
+                /* If equal, jump over the remaining comparisons and the
+                 * ALLOW, to the TRACE */
+                struct sock_filter cmp = BPF_JUMP_(
+                        BPF_JMP | BPF_JEQ | BPF_K,
+                        (uint32_t)i | offsets[t],
+                        nb_syscalls, 0);
+                filter[pos++] = cmp;
+                --nb_syscalls;
+            }
+        }
+    }
+    {
+        struct sock_filter footer[] = {
+            BPF_STMT_(BPF_RET | BPF_K, SECCOMP_RET_ALLOW),
+            BPF_STMT_(BPF_RET | BPF_K, SECCOMP_RET_TRACE),
+        };
+        memcpy(filter + pos, footer, sizeof(footer));
+        pos += count(footer);
+    }
+    return pos;
+}
+
+int syscall_install_filter(void)
+{
+    /* At most 255 comparisons per architecture, because of jump offsets */
+    struct sock_filter filter[3 + 255 + 2 + 3 + 255 + 2 + 1];
+    struct sock_fprog prog;
+    size_t pos = 0;
+#if defined(X86_64)
+    {
+        const struct syscall_table tables[2] = {
+            syscall_tables[SYSCALL_X86_64],
+            syscall_tables[SYSCALL_X86_64_x32]};
+        const uint32_t offsets[2] = {0, __X32_SYSCALL_BIT};
+        pos = build_filter_arch(filter, pos, AUDIT_ARCH_X86_64,
+                                tables, offsets, 2);
+    }
+#endif
+    {
+        const uint32_t offsets[1] = {0};
+        pos = build_filter_arch(filter, pos, AUDIT_ARCH_I386,
+                                &syscall_tables[SYSCALL_I386], offsets, 1);
+    }
+    {
+        /* Unknown architecture */
+        struct sock_filter allow = BPF_STMT_(BPF_RET | BPF_K,
+                                             SECCOMP_RET_ALLOW);
+        filter[pos++] = allow;
+    }
+    prog.len = pos;
+    prog.filter = filter;
+
+    /* Installing a filter requires either CAP_SYS_ADMIN or no_new_privs, which
+     * means setuid binaries won't get their privileges */
+    if(prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) != 0
+     || prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, &prog) != 0)
+    {
+        log_critical(0, "couldn't install seccomp filter: %s",
+                     strerror(errno));
+        return -1;
+    }
+    return 0;
+}
@@ -3,8 +3,38 @@
 
 #include "tracer.h"
 
-void syscall_build_table(void);
+/* Returns the name of a syscall in a table, or NULL if it is unknown */
+const char *syscall_name(size_t syscall_type, int syscall);
+
+/* Groups of syscalls, by what their handlers record. Processes (execve(),
+ * fork(), chdir()) and changes to the filesystem (which invalidate the
+ * tracer's caches) are always handled */
+#define SYSCALL_GROUP_PROCESSES 0x01
+#define SYSCALL_GROUP_CHANGES   0x02    /* mkdir(), symlink(), unlink()... */
+#define SYSCALL_GROUP_OPEN      0x04    /* open(), creat() */
+#define SYSCALL_GROUP_STAT      0x08    /* stat(), access(), readlink() */
+#define SYSCALL_GROUP_NETWORK   0x10    /* connect(), accept() */
+#define SYSCALL_GROUP_UNHANDLED 0x20    /* warnings about unhandled syscalls */
+#define SYSCALL_GROUPS_ALL      0x3F
+
+/* Gets the groups of a named capture profile ("full", "files-only",
+ * "exec-only"); returns -1 if there is no such profile */
+int syscall_profile(const char *name, unsigned int *groups);
+
+/* Builds the tables with the handlers from the given groups, replacing
+ * previous tables if they were built with different groups */
+void syscall_build_table(unsigned int groups);
+
+/* Indicates whether the exit of the current syscall has a handler, so that
+ * the tracer doesn't have to decode the exits it would ignore */
+int syscall_exit_handled(const struct Process *process);
 
 int syscall_handle(struct Process *process);
 
+/* Handles the exit of a syscall that the process entered before we attached
+ * to it; its number and arguments must have been read already */
+int syscall_handle_missed_entry(struct Process *process);
+
+int syscall_install_filter(void);
+
 #endif
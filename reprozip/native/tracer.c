@@ -1,3 +1,4 @@
+#include <dirent.h>
 #include <errno.h>
 #include <signal.h>
 #include <stdint.h>
@@ -5,17 +6,21 @@
 #include <stdlib.h>
 #include <string.h>
 
+#include <linux/audit.h>
 #include <sys/ptrace.h>
 #include <sys/reg.h>
+#include <sys/stat.h>
 #include <sys/types.h>
 #include <sys/uio.h>
 #include <sys/user.h>
+#include <sys/utsname.h>
 #include <sys/wait.h>
 #include <unistd.h>
 
 #include "config.h"
 #include "database.h"
 #include "log.h"
+#include "ptrace_utils.h"
 #include "syscalls.h"
 #include "tracer.h"
 #include "utils.h"
@@ -24,6 +29,27 @@
 #ifndef NT_PRSTATUS
 #define NT_PRSTATUS 1
 #endif
+#ifndef PTRACE_O_TRACESECCOMP
+#define PTRACE_O_TRACESECCOMP 0x00000080
+#endif
+#ifndef PTRACE_EVENT_SECCOMP
+#define PTRACE_EVENT_SECCOMP 7
+#endif
+#ifndef PTRACE_GET_SYSCALL_INFO
+#define PTRACE_GET_SYSCALL_INFO 0x420e
+#endif
+#ifndef PTRACE_SEIZE
+#define PTRACE_SEIZE 0x4206
+#endif
+#ifndef PTRACE_INTERRUPT
+#define PTRACE_INTERRUPT 0x4207
+#endif
+#ifndef PTRACE_LISTEN
+#define PTRACE_LISTEN 0x4208
+#endif
+#ifndef PTRACE_EVENT_STOP
+#define PTRACE_EVENT_STOP 128
+#endif
 
 
 struct i386_regs {
@@ -78,6 +104,35 @@ struct x86_64_regs {
 };
 
 
+/* Result of PTRACE_GET_SYSCALL_INFO (struct ptrace_syscall_info) */
+#define SYSCALL_INFO_ENTRY      1
+#define SYSCALL_INFO_EXIT       2
+#define SYSCALL_INFO_SECCOMP    3
+
+struct syscall_info_data {
+    uint8_t op;
+    uint8_t pad[3];
+    uint32_t arch;
+    uint64_t instruction_pointer;
+    uint64_t stack_pointer;
+    union {
+        struct {
+            uint64_t nr;
+            uint64_t args[6];
+        } entry;
+        struct {
+            int64_t rval;
+            uint8_t is_error;
+        } exit;
+        struct {
+            uint64_t nr;
+            uint64_t args[6];
+            uint32_t ret_data;
+        } seccomp;
+    } u;
+};
+
+
 static void get_i386_reg(register_type *reg, uint32_t value)
 {
     reg->i = (int32_t)value;
@@ -96,106 +151,314 @@ static void get_x86_64_reg(register_type *reg, uint64_t value)
 int trace_verbosity = 0;
 #define verbosity trace_verbosity
 
+int trace_use_seccomp = 0;
 
-struct Process **processes = NULL;
-size_t processes_size;
+int trace_use_syscall_info = 1;
 
-struct Process *trace_find_process(pid_t tid)
+unsigned int trace_syscall_groups = SYSCALL_GROUPS_ALL;
+
+struct TraceStats trace_stats;
+
+
+/* Set by the SIGINT handler when the user asked to abort */
+static volatile sig_atomic_t interrupted = 0;
+
+/* Set by attach_and_trace(): the processes were already running, and we
+ * detach from them instead of killing them */
+static int attached_mode = 0;
+/* Set by the signal handler when it's time to detach */
+static volatile sig_atomic_t detach_requested = 0;
+/* Set once we started detaching; trace_resume() then detaches */
+static int detaching = 0;
+
+
+/* The process table. Live processes are indexed by tid in a hash table, and
+ * by thread group in a second one (used by the execve() workaround). Process
+ * structures are allocated in pools and recycled through a free list. The
+ * counts of processes are maintained as their status changes. */
+
+static struct Process **tid_table = NULL;
+static struct Process **tgid_table = NULL;
+static size_t table_size = 0; /* number of buckets, a power of 2 */
+
+static struct Process *free_processes = NULL;
+static size_t pool_size = 0;
+
+static unsigned int nb_processes = 0; /* not FREE */
+static unsigned int nb_unknown = 0;
+static unsigned int nb_detached = 0;
+
+#define PROCESS_HASH(pid) ((size_t)(pid) & (table_size - 1))
+
+static void trace_grow_pool(size_t nb)
 {
     size_t i;
-    for(i = 0; i < processes_size; ++i)
+    struct Process *pool = malloc(nb * sizeof(*pool));
+    for(i = 0; i < nb; ++i)
     {
-        if(processes[i]->status != PROCESS_FREE && processes[i]->tid == tid)
-            return processes[i];
+        pool[i].status = PROCESS_FREE;
+        pool[i].wd = 0;
+        pool[i].syscall_info = NULL;
+        pool[i].tid_next = free_processes;
+        free_processes = &pool[i];
     }
-    return NULL;
+    pool_size += nb;
 }
 
-struct Process *trace_get_empty_process(void)
+static void trace_resize_tables(size_t new_size)
 {
+    struct Process **old_tid_table = tid_table;
+    struct Process **old_tgid_table = tgid_table;
+    size_t old_size = table_size;
     size_t i;
-    for(i = 0; i < processes_size; ++i)
+    tid_table = calloc(new_size, sizeof(*tid_table));
+    tgid_table = calloc(new_size, sizeof(*tgid_table));
+    table_size = new_size;
+    for(i = 0; i < old_size; ++i)
+    {
+        struct Process *process, *next;
+        for(process = old_tid_table[i]; process != NULL; process = next)
+        {
+            size_t h = PROCESS_HASH(process->tid);
+            next = process->tid_next;
+            process->tid_next = tid_table[h];
+            tid_table[h] = process;
+        }
+        for(process = old_tgid_table[i]; process != NULL; process = next)
+        {
+            size_t h = PROCESS_HASH(process->tgid);
+            next = process->tgid_next;
+            process->tgid_next = tgid_table[h];
+            tgid_table[h] = process;
+        }
+    }
+    free(old_tid_table);
+    free(old_tgid_table);
+}
+
+static void trace_remove_from_group(struct Process *process)
+{
+    struct Process **link;
+    if(!process->in_tgid_index)
+        return;
+    link = &tgid_table[PROCESS_HASH(process->tgid)];
+    while(*link != process)
+        link = &(*link)->tgid_next;
+    *link = process->tgid_next;
+    process->in_tgid_index = 0;
+}
+
+struct Process *trace_find_process(pid_t tid)
+{
+    struct Process *process;
+    for(process = tid_table[PROCESS_HASH(tid)];
+        process != NULL;
+        process = process->tid_next)
     {
-        if(processes[i]->status == PROCESS_FREE)
-            return processes[i];
+        if(process->tid == tid)
+            return process;
     }
+    return NULL;
+}
+
+struct Process *trace_first_in_group(pid_t tgid)
+{
+    struct Process *process;
+    for(process = tgid_table[PROCESS_HASH(tgid)];
+        process != NULL;
+        process = process->tgid_next)
+    {
+        if(process->tgid == tgid)
+            return process;
+    }
+    return NULL;
+}
+
+struct Process *trace_next_in_group(struct Process *process)
+{
+    pid_t tgid = process->tgid;
+    for(process = process->tgid_next;
+        process != NULL;
+        process = process->tgid_next)
+    {
+        if(process->tgid == tgid)
+            return process;
+    }
+    return NULL;
+}
+
+void trace_set_status(struct Process *process, int status)
+{
+    if(process->status == PROCESS_FREE)
+        ++nb_processes;
+    else if(process->status == PROCESS_UNKNOWN)
+        --nb_unknown;
+    else if(process->status == PROCESS_DETACHED)
+        --nb_detached;
+    if(status == PROCESS_FREE)
+        --nb_processes;
+    else if(status == PROCESS_UNKNOWN)
+        ++nb_unknown;
+    else if(status == PROCESS_DETACHED)
+        ++nb_detached;
+    process->status = status;
+}
 
-    /* Count unknown processes */
+struct Process *trace_new_process(pid_t tid, int status)
+{
+    struct Process *process;
+    if(free_processes == NULL)
     {
-        size_t unknown = 0;
-        for(i = 0; i < processes_size; ++i)
-            if(processes[i]->status == PROCESS_UNKNOWN)
-                ++unknown;
         {
-            int many_unknown = unknown * 2 >= processes_size;
+            int many_unknown = nb_unknown * 2 >= pool_size;
             if(many_unknown && verbosity >= 1)
                 log_warn(0, "there are %u/%u UNKNOWN processes",
-                         (unsigned int)unknown, (unsigned int)processes_size);
+                         nb_unknown, (unsigned int)pool_size);
             else if(verbosity >= 2)
                 log_info(0, "there are %u/%u UNKNOWN processes",
-                         (unsigned int)unknown, (unsigned int)processes_size);
+                         nb_unknown, (unsigned int)pool_size);
         }
+
+        /* Allocate more! */
+        if(verbosity >= 3)
+            log_debug(0, "process table full (%d), reallocating",
+                      (int)pool_size);
+        trace_grow_pool(pool_size);
     }
+    process = free_processes;
+    free_processes = process->tid_next;
 
-    /* Allocate more! */
-    if(verbosity >= 3)
-        log_debug(0, "process table full (%d), reallocating",
-                  (int)processes_size);
-    {
-        struct Process *pool;
-        size_t prev_size = processes_size;
-        processes_size *= 2;
-        pool = malloc((processes_size - prev_size) * sizeof(*pool));
-        processes = realloc(processes, processes_size * sizeof(*processes));
-        for(; i < processes_size; ++i)
-        {
-            processes[i] = pool++;
-            processes[i]->status = PROCESS_FREE;
-        }
-        return processes[prev_size];
+    trace_set_status(process, status);
+    process->tid = tid;
+    process->tgid = 0;
+    process->in_tgid_index = 0;
+    process->in_syscall = 0;
+    process->current_syscall = -1;
+    process->syscall_info = NULL;
+    process->wd = 0;
+
+    if(nb_processes > table_size)
+        trace_resize_tables(table_size * 2);
+    {
+        size_t h = PROCESS_HASH(tid);
+        process->tid_next = tid_table[h];
+        tid_table[h] = process;
     }
+    return process;
+}
+
+void trace_set_tgid(struct Process *process, pid_t tgid)
+{
+    size_t h = PROCESS_HASH(tgid);
+    trace_remove_from_group(process);
+    process->tgid = tgid;
+    process->tgid_next = tgid_table[h];
+    tgid_table[h] = process;
+    process->in_tgid_index = 1;
+}
+
+void trace_free_process(struct Process *process)
+{
+    struct Process **link = &tid_table[PROCESS_HASH(process->tid)];
+    while(*link != process)
+        link = &(*link)->tid_next;
+    *link = process->tid_next;
+    trace_remove_from_group(process);
+
+    process->wd = 0;
+    trace_set_status(process, PROCESS_FREE);
+    process->tid_next = free_processes;
+    free_processes = process;
 }
 
 void trace_count_processes(unsigned int *p_nproc, unsigned int *p_unknown)
 {
-    unsigned int nproc = 0, unknown = 0;
+    /* UNKNOWN processes exist but no corresponding syscall has returned yet;
+     * ALLOCATED processes are not yet attached but they will show up
+     * eventually */
+    if(p_nproc != NULL)
+        *p_nproc = nb_processes;
+    if(p_unknown != NULL)
+        *p_unknown = nb_unknown;
+}
+
+/* The files mapped by a program right after execve() are remembered by
+ * binary, so that executing the same program again doesn't parse
+ * /proc/<pid>/maps and stat() each file again. Entries are only used if the
+ * binary's device, inode and modification time are still the same. */
+
+struct MappedFile {
+    unsigned int path;
+    int is_dir;
+};
+
+struct ExecCacheEntry {
+    struct ExecCacheEntry *next;
+    char *binary;
+    dev_t dev;
+    ino_t ino;
+    time_t mtime;
+    long mtime_nsec;
+    size_t nb_files;
+    struct MappedFile *files;
+};
+
+#define EXEC_CACHE_SIZE 256
+
+static struct ExecCacheEntry *exec_cache[EXEC_CACHE_SIZE];
+
+static void exec_cache_free_entry(struct ExecCacheEntry *entry)
+{
+    free(entry->files);
+    free(entry->binary);
+    free(entry);
+}
+
+static void exec_cache_clear(void)
+{
     size_t i;
-    for(i = 0; i < processes_size; ++i)
+    for(i = 0; i < EXEC_CACHE_SIZE; ++i)
     {
-        switch(processes[i]->status)
+        while(exec_cache[i] != NULL)
         {
-        case PROCESS_FREE:
-            break;
-        case PROCESS_UNKNOWN:
-            /* Exists but no corresponding syscall has returned yet */
-            ++unknown;
-        case PROCESS_ALLOCATED:
-            /* Not yet attached but it will show up eventually */
-        case PROCESS_ATTACHED:
-            /* Running */
-            ++nproc;
-            break;
+            struct ExecCacheEntry *next = exec_cache[i]->next;
+            exec_cache_free_entry(exec_cache[i]);
+            exec_cache[i] = next;
         }
     }
-    if(p_nproc != NULL)
-        *p_nproc = nproc;
-    if(p_unknown != NULL)
-        *p_unknown = unknown;
 }
 
-int trace_add_files_from_proc(unsigned int process, pid_t tid,
-                              const char *binary)
+/**
+ * Reads the files mapped by a process from /proc/<pid>/maps, except binary.
+ */
+static struct ExecCacheEntry *read_mapped_files(pid_t tid, const char *binary)
 {
-    FILE *fp;
-    char dummy;
-    char *line = NULL;
-    size_t length = 0;
-    char previous_path[4096] = "";
+    struct ExecCacheEntry *entry;
+    size_t capacity = 16;
+    char *maps, *line;
+    size_t size;
+    unsigned int previous_path = 0;
+
+    char procfile[64];
+    snprintf(procfile, sizeof(procfile), "/proc/%d/maps", tid);
+
+#ifdef DEBUG_PROC_PARSER
+    log_info(tid, "parsing %s", procfile);
+#endif
+    maps = read_file(procfile, &size);
+    if(maps == NULL)
+    {
+        /* LCOV_EXCL_START : We are tracing this process */
+        log_error(tid, "couldn't read %s: %s", procfile, strerror(errno));
+        return NULL;
+        /* LCOV_EXCL_END */
+    }
 
-    const char *const fmt = "/proc/%d/maps";
-    int len = snprintf(&dummy, 1, fmt, tid);
-    char *procfile = malloc(len + 1);
-    snprintf(procfile, len + 1, fmt, tid);
+    entry = malloc(sizeof(*entry));
+    entry->next = NULL;
+    entry->binary = strdup(binary);
+    entry->nb_files = 0;
+    entry->files = malloc(capacity * sizeof(*entry->files));
 
     /* Loops on lines
      * Format:
@@ -204,28 +467,27 @@ int trace_add_files_from_proc(unsigned int process, pid_t tid,
      * b7721000-b7740000 r-xp 00000000 fe:00 901950     /lib/ld-2.18.so
      * bfe44000-bfe65000 rw-p 00000000 00:00 0          [stack]
      */
-
-#ifdef DEBUG_PROC_PARSER
-    log_info(tid, "parsing %s", procfile);
-#endif
-    fp = fopen(procfile, "r");
-
-    while((line = read_line(line, &length, fp)) != NULL)
+    for(line = maps; *line != '\0'; )
     {
         unsigned long int addr_start, addr_end;
         char perms[5];
         unsigned long int offset;
         unsigned int dev_major, dev_minor;
         unsigned long int inode;
-        char pathname[4096];
+        char *pathname;
+        int path_pos = 0;
+        char *eol = strchr(line, '\n');
+        if(eol != NULL)
+            *eol = '\0';
         sscanf(line,
-               "%lx-%lx %4s %lx %x:%x %lu %s",
+               "%lx-%lx %4s %lx %x:%x %lu %n",
                &addr_start, &addr_end,
                perms,
                &offset,
                &dev_major, &dev_minor,
                &inode,
-               pathname);
+               &path_pos);
+        pathname = line + path_pos;
 
 #ifdef DEBUG_PROC_PARSER
         log_info(tid,
@@ -245,48 +507,495 @@ int trace_add_files_from_proc(unsigned int process, pid_t tid,
                  inode,
                  pathname);
 #endif
-        if(inode > 0)
+        if(path_pos > 0 && inode > 0 && strcmp(pathname, binary) != 0)
         {
-            if(strncmp(pathname, binary, 4096) != 0
-             && strncmp(previous_path, pathname, 4096) != 0)
+            unsigned int path = path_intern(pathname);
+            if(path != previous_path)
             {
 #ifdef DEBUG_PROC_PARSER
                 log_info(tid, "    adding to database");
 #endif
-                if(db_add_file_open(process, pathname,
-                                    FILE_READ, path_is_dir(pathname)) != 0)
-                    return -1;
-                strncpy(previous_path, pathname, 4096);
+                if(entry->nb_files == capacity)
+                {
+                    capacity <<= 1;
+                    entry->files = realloc(entry->files,
+                                           capacity * sizeof(*entry->files));
+                }
+                entry->files[entry->nb_files].path = path;
+                entry->files[entry->nb_files].is_dir = path_is_dir(path);
+                previous_path = path;
+                ++entry->nb_files;
             }
         }
+        if(eol == NULL)
+            break;
+        line = eol + 1;
     }
-    return 0;
+    free(maps);
+    return entry;
 }
 
-static void trace_set_options(pid_t tid)
+int trace_add_files_from_proc(unsigned int process, pid_t tid,
+                              const char *binary)
+{
+    struct ExecCacheEntry *entry = NULL, **bucket = NULL;
+    struct stat st;
+    size_t i;
+    int ret = 0;
+
+    if(stat(binary, &st) == 0)
+    {
+        bucket = &exec_cache[hash_str(binary) % EXEC_CACHE_SIZE];
+        for(entry = *bucket; entry != NULL; entry = entry->next)
+        {
+            if(strcmp(entry->binary, binary) == 0)
+                break;
+        }
+        if(entry != NULL
+         && (entry->dev != st.st_dev || entry->ino != st.st_ino
+           || entry->mtime != st.st_mtim.tv_sec
+           || entry->mtime_nsec != st.st_mtim.tv_nsec))
+        {
+            /* Binary changed, forget this entry */
+            struct ExecCacheEntry **link = bucket;
+            while(*link != entry)
+                link = &(*link)->next;
+            *link = entry->next;
+            exec_cache_free_entry(entry);
+            entry = NULL;
+        }
+        if(entry != NULL && verbosity >= 3)
+            log_debug(tid, "using cached mapped files for %s", binary);
+    }
+
+    if(entry == NULL)
+    {
+        entry = read_mapped_files(tid, binary);
+        if(entry == NULL)
+            return 0;
+        if(bucket != NULL)
+        {
+            entry->dev = st.st_dev;
+            entry->ino = st.st_ino;
+            entry->mtime = st.st_mtim.tv_sec;
+            entry->mtime_nsec = st.st_mtim.tv_nsec;
+            entry->next = *bucket;
+            *bucket = entry;
+        }
+    }
+
+    for(i = 0; i < entry->nb_files; ++i)
+    {
+        if(db_add_file_open(process, entry->files[i].path,
+                            FILE_READ, entry->files[i].is_dir) != 0)
+        {
+            ret = -1;
+            break;
+        }
+    }
+
+    /* Not cached if we couldn't stat() the binary */
+    if(bucket == NULL)
+        exec_cache_free_entry(entry);
+    return ret;
+}
+
+/**
+ * Decodes the current syscall using PTRACE_GET_SYSCALL_INFO.
+ *
+ * This is a single call, where GETREGSET copies all the registers. Returns 0
+ * if it couldn't be used, in which case trace_get_registers() should be used,
+ * and -1 if this is the exit of a syscall whose entry we didn't see.
+ */
+static int trace_get_syscall_info(struct Process *process)
+{
+    struct syscall_info_data info;
+    size_t i;
+    if(!trace_use_syscall_info)
+        return 0;
+    if(ptrace(PTRACE_GET_SYSCALL_INFO, process->tid,
+              (void*)sizeof(info), &info) < 0)
+    {
+        /* LCOV_EXCL_START : PTRACE_GET_SYSCALL_INFO was added by Linux 5.3
+         * in September 2019 (201766a2) */
+        if(errno == EIO)
+        {
+            log_info(process->tid, "PTRACE_GET_SYSCALL_INFO is not "
+                     "available, falling back to PTRACE_GETREGSET");
+            trace_use_syscall_info = 0;
+        }
+        return 0;
+        /* LCOV_EXCL_END */
+    }
+    /* This is the exit of a syscall that was running when we attached */
+    if(!process->in_syscall && info.op == SYSCALL_INFO_EXIT)
+        return -1;
+    /* Let the registers sort it out if the kernel doesn't agree on which
+     * stop this is */
+    if(process->in_syscall && info.op != SYSCALL_INFO_EXIT)
+        return 0;
+    if(!process->in_syscall && info.op != SYSCALL_INFO_ENTRY
+     && info.op != SYSCALL_INFO_SECCOMP)
+        return 0;
+    ++trace_stats.syscall_info_reads;
+
+#if defined(X86_64)
+    if(info.arch == AUDIT_ARCH_I386)
+        process->mode = MODE_I386;
+    else
+        /* Might still be either native x64 or Linux's x32 layer */
+        process->mode = MODE_X86_64;
+#else
+    process->mode = MODE_I386;
+#endif
+    if(process->in_syscall)
+    {
+        /* The syscall number isn't part of the exit info, we keep the one
+         * from the entry */
+        if(process->mode == MODE_I386)
+            get_i386_reg(&process->retvalue, (uint32_t)info.u.exit.rval);
+        else
+            get_x86_64_reg(&process->retvalue, (uint64_t)info.u.exit.rval);
+    }
+    else
+    {
+        /* entry and seccomp start the same way */
+        process->current_syscall = (int)info.u.entry.nr;
+        for(i = 0; i < PROCESS_ARGS; ++i)
+        {
+            if(process->mode == MODE_I386)
+                get_i386_reg(&process->params[i],
+                             (uint32_t)info.u.entry.args[i]);
+            else
+                get_x86_64_reg(&process->params[i], info.u.entry.args[i]);
+        }
+    }
+    return 1;
+}
+
+static void trace_get_registers(struct Process *process)
 {
-    ptrace(PTRACE_SETOPTIONS, tid, 0,
-           PTRACE_O_TRACESYSGOOD |  /* Adds 0x80 bit to SIGTRAP signals
+    size_t len = 0;
+#ifdef I386
+    struct i386_regs regs;
+#else /* def X86_64 */
+    struct x86_64_regs regs;
+#endif
+    /* Try to use GETREGSET first, since iov_len allows us to know if
+     * 32bit or 64bit mode was used */
+#ifdef PTRACE_GETREGSET
+#ifndef NT_PRSTATUS
+#define NT_PRSTATUS  1
+#endif
+    {
+        struct iovec iov;
+        iov.iov_base = &regs;
+        iov.iov_len = sizeof(regs);
+        if(ptrace(PTRACE_GETREGSET, process->tid, NT_PRSTATUS, &iov) == 0)
+            len = iov.iov_len;
+    }
+    if(len == 0)
+#endif
+    /* GETREGSET undefined or call failed, fallback on GETREGS */
+    {
+        /* LCOV_EXCL_START : GETREGSET was added by Linux 2.6.34 in
+         * May 2010 (2225a122) */
+        ptrace(PTRACE_GETREGS, process->tid, NULL, &regs);
+        /* LCOV_EXCL_END */
+    }
+    ++trace_stats.register_reads;
+#if defined(I386)
+    if(!process->in_syscall || regs.orig_eax >= 0)
+        process->current_syscall = regs.orig_eax;
+    if(process->in_syscall)
+        get_i386_reg(&process->retvalue, regs.eax);
+    else
+    {
+        get_i386_reg(&process->params[0], regs.ebx);
+        get_i386_reg(&process->params[1], regs.ecx);
+        get_i386_reg(&process->params[2], regs.edx);
+        get_i386_reg(&process->params[3], regs.esi);
+        get_i386_reg(&process->params[4], regs.edi);
+        get_i386_reg(&process->params[5], regs.ebp);
+    }
+    process->mode = MODE_I386;
+#elif defined(X86_64)
+    /* On x86_64, process might be 32 or 64 bits */
+    /* If len is known (not 0) and not that of x86_64 registers,
+     * or if len is not known (0) and CS is 0x23 (not as reliable) */
+    if( (len != 0 && len != sizeof(regs))
+     || (len == 0 && regs.cs == 0x23) )
+    {
+        /* 32 bit mode */
+        struct i386_regs *x86regs = (struct i386_regs*)&regs;
+        if(!process->in_syscall || x86regs->orig_eax >= 0)
+            process->current_syscall = x86regs->orig_eax;
+        if(process->in_syscall)
+            get_i386_reg(&process->retvalue, x86regs->eax);
+        else
+        {
+            get_i386_reg(&process->params[0], x86regs->ebx);
+            get_i386_reg(&process->params[1], x86regs->ecx);
+            get_i386_reg(&process->params[2], x86regs->edx);
+            get_i386_reg(&process->params[3], x86regs->esi);
+            get_i386_reg(&process->params[4], x86regs->edi);
+            get_i386_reg(&process->params[5], x86regs->ebp);
+        }
+        process->mode = MODE_I386;
+    }
+    else
+    {
+        /* 64 bit mode */
+        if(!process->in_syscall || regs.orig_rax >= 0)
+            process->current_syscall = regs.orig_rax;
+        if(process->in_syscall)
+            get_x86_64_reg(&process->retvalue, regs.rax);
+        else
+        {
+            get_x86_64_reg(&process->params[0], regs.rdi);
+            get_x86_64_reg(&process->params[1], regs.rsi);
+            get_x86_64_reg(&process->params[2], regs.rdx);
+            get_x86_64_reg(&process->params[3], regs.r10);
+            get_x86_64_reg(&process->params[4], regs.r8);
+            get_x86_64_reg(&process->params[5], regs.r9);
+        }
+        /* Might still be either native x64 or Linux's x32 layer */
+        process->mode = MODE_X86_64;
+    }
+#endif
+}
+
+static long trace_options(void)
+{
+    return PTRACE_O_TRACESYSGOOD |  /* Adds 0x80 bit to SIGTRAP signals
                                      * if paused because of syscall */
 #ifdef PTRACE_O_EXITKILL
-           PTRACE_O_EXITKILL |
+           /* Processes we attached to survive us */
+           (attached_mode?0:PTRACE_O_EXITKILL) |
 #endif
+           (trace_use_seccomp?PTRACE_O_TRACESECCOMP:0) |
            PTRACE_O_TRACECLONE |
            PTRACE_O_TRACEFORK |
            PTRACE_O_TRACEVFORK |
-           PTRACE_O_TRACEEXEC);
+           PTRACE_O_TRACEEXEC |
+           PTRACE_O_TRACEEXIT;      /* To read resource usage, see
+                                     * trace_record_usage() */
+}
+
+static void trace_set_options(pid_t tid)
+{
+    ptrace(PTRACE_SETOPTIONS, tid, 0, trace_options());
+}
+
+void trace_resume(struct Process *process, int signum)
+{
+    /* When detaching, processes are let go instead of resumed; they are
+     * removed from the table by trace() */
+    if(detaching)
+    {
+        ptrace(PTRACE_DETACH, process->tid, NULL, signum);
+        trace_set_status(process, PROCESS_DETACHED);
+    }
+    /* With the seccomp filter, the process only stops when entering a
+     * syscall we handle; we still need to see that syscall's exit */
+    else if(trace_use_seccomp && !process->in_syscall)
+        ptrace(PTRACE_CONT, process->tid, NULL, signum);
+    else
+        ptrace(PTRACE_SYSCALL, process->tid, NULL, signum);
+}
+
+/**
+ * Checks that the kernel is recent enough for our use of seccomp.
+ *
+ * Before Linux 4.8, PTRACE_EVENT_SECCOMP stops happened before the
+ * syscall-entry-stop, instead of taking its place.
+ */
+static int seccomp_supported(void)
+{
+    struct utsname name;
+    int major, minor;
+    if(uname(&name) != 0
+     || sscanf(name.release, "%d.%d", &major, &minor) != 2)
+        return 0;
+    return major > 4 || (major == 4 && minor >= 8);
+}
+
+/**
+ * Reads the numbers following a label in a /proc file such as status or io.
+ */
+static unsigned long long proc_field(const char *data, const char *label)
+{
+    const char *pos = strstr(data, label);
+    if(pos == NULL)
+        return 0;
+    return strtoull(pos + strlen(label), NULL, 10);
+}
+
+/**
+ * Records the resources used by a process that is about to exit.
+ *
+ * This is called at the PTRACE_EVENT_EXIT stop, when the process' files in
+ * /proc are still there: CPU times from stat and bytes read and written from
+ * io are the thread's own, the peak resident set size from status is that of
+ * its address space, shared with the other threads.
+ */
+static int trace_record_usage(struct Process *process)
+{
+    static long ticks_per_second = 0;
+    char filename[64];
+    char *data, *end;
+    size_t size;
+    unsigned long long user_ticks, system_ticks;
+    struct ProcessUsage usage;
+
+    if(ticks_per_second == 0)
+        ticks_per_second = sysconf(_SC_CLK_TCK);
+
+    /* Fields 14 and 15, after the command name in parentheses */
+    sprintf(filename, "/proc/%d/task/%d/stat",
+            (int)process->tgid, (int)process->tid);
+    data = read_file(filename, &size);
+    if(data == NULL)
+        return 0;
+    end = strrchr(data, ')');
+    if(end == NULL
+     || sscanf(end + 1, " %*c %*d %*d %*d %*d %*d %*u %*u %*u %*u %*u "
+               "%llu %llu", &user_ticks, &system_ticks) != 2)
+    {
+        free(data);
+        return 0;
+    }
+    free(data);
+    usage.user_time = user_ticks * 1000000 / ticks_per_second;
+    usage.system_time = system_ticks * 1000000 / ticks_per_second;
+
+    sprintf(filename, "/proc/%d/task/%d/status",
+            (int)process->tgid, (int)process->tid);
+    data = read_file(filename, &size);
+    usage.max_rss = data == NULL?0:proc_field(data, "\nVmHWM:");
+    free(data);
+
+    sprintf(filename, "/proc/%d/task/%d/io",
+            (int)process->tgid, (int)process->tid);
+    data = read_file(filename, &size);
+    usage.io_read = data == NULL?0:proc_field(data, "rchar:");
+    usage.io_written = data == NULL?0:proc_field(data, "wchar:");
+    free(data);
+
+    if(verbosity >= 3)
+        log_debug(process->tid, "used %llu us user, %llu us system, "
+                  "%llu kB, read %llu bytes, wrote %llu bytes",
+                  usage.user_time, usage.system_time, usage.max_rss,
+                  usage.io_read, usage.io_written);
+    return db_add_usage(process->identifier, &usage);
+}
+
+/**
+ * Starts detaching from the processes, see attach_and_trace().
+ *
+ * Every running process is interrupted; trace_resume() then detaches from
+ * them instead of resuming them, as their pending stops are handled.
+ */
+static void trace_start_detach(void)
+{
+    size_t i;
+    if(verbosity >= 2)
+        log_info(0, "detaching from %u processes", nb_processes);
+    detaching = 1;
+    for(i = 0; i < table_size; ++i)
+    {
+        struct Process *process;
+        for(process = tid_table[i];
+            process != NULL;
+            process = process->tid_next)
+        {
+            if(process->status == PROCESS_ATTACHED)
+                ptrace(PTRACE_INTERRUPT, process->tid, NULL, NULL);
+        }
+    }
+}
+
+/**
+ * Frees the processes we detached from, and returns the number of processes
+ * we still have to detach from.
+ *
+ * Once that is 0, the UNKNOWN processes left, whose creator was detached
+ * before its fork() returned, are detached as well.
+ */
+static unsigned int trace_sweep_detached(void)
+{
+    size_t i;
+    int done = nb_processes - nb_unknown - nb_detached == 0;
+    for(i = 0; i < table_size; ++i)
+    {
+        struct Process **link = &tid_table[i];
+        while(*link != NULL)
+        {
+            struct Process *process = *link;
+            if(done && process->status == PROCESS_UNKNOWN)
+                ptrace(PTRACE_DETACH, process->tid, NULL, 0);
+            else if(process->status != PROCESS_DETACHED)
+            {
+                link = &process->tid_next;
+                continue;
+            }
+            trace_free_process(process);
+        }
+    }
+    return nb_processes;
+}
+
+/**
+ * Handles the new process announced by a ptrace event while detaching.
+ *
+ * Its creator is detached at that event, so fork() won't return under trace;
+ * the new process is detached when it shows up instead.
+ */
+static void trace_detach_new_process(struct Process *process, int event)
+{
+    unsigned long msg;
+    pid_t new_tid;
+    struct Process *new_process;
+    if(event != PTRACE_EVENT_FORK && event != PTRACE_EVENT_VFORK
+     && event != PTRACE_EVENT_CLONE)
+        return;
+    if(ptrace(PTRACE_GETEVENTMSG, process->tid, NULL, &msg) != 0)
+        return;
+    new_tid = (pid_t)msg;
+    new_process = trace_find_process(new_tid);
+    if(new_process == NULL)
+        trace_new_process(new_tid, PROCESS_ALLOCATED);
+    else if(new_process->status == PROCESS_UNKNOWN)
+    {
+        trace_set_status(new_process, PROCESS_ATTACHED);
+        trace_resume(new_process, 0);
+    }
 }
 
 static int trace(pid_t first_proc, int *first_exit_code)
 {
+    unsigned long long handling_start = 0;
     for(;;)
     {
         int status;
         pid_t tid;
         struct Process *process;
 
+        if(detach_requested && !detaching)
+            trace_start_detach();
+        if(detaching && trace_sweep_detached() == 0)
+            break;
+
         /* Wait for a process */
+        if(handling_start != 0)
+            trace_stats.stopped_time += monotonic_ns() - handling_start;
         tid = waitpid(-1, &status, __WALL);
+        handling_start = monotonic_ns();
+        if(interrupted)
+            return -1;
+        /* The signal handler asks us to detach */
+        if(tid == -1 && errno == EINTR)
+            continue;
         if(tid == -1)
         {
             /* LCOV_EXCL_START : internal error: waitpid() won't fail unless we
@@ -312,8 +1021,7 @@ static int trace(pid_t first_proc, int *first_exit_code)
             {
                 if(db_add_exit(process->identifier, exitcode) != 0)
                     return -1;
-                free(process->wd);
-                process->status = PROCESS_FREE;
+                trace_free_process(process);
             }
             trace_count_processes(&nprocs, &unknown);
             if(verbosity >= 2)
@@ -322,7 +1030,7 @@ static int trace(pid_t first_proc, int *first_exit_code)
                          (unsigned int)nprocs);
             if(nprocs <= 0)
                 break;
-            if(unknown >= nprocs)
+            if(unknown >= nprocs && !detaching)
             {
                 /* LCOV_EXCL_START : This can't happen because UNKNOWN
                  * processes are the forked processes whose creator has not
@@ -341,11 +1049,7 @@ static int trace(pid_t first_proc, int *first_exit_code)
         {
             if(verbosity >= 3)
                 log_debug(tid, "process appeared");
-            process = trace_get_empty_process();
-            process->status = PROCESS_UNKNOWN;
-            process->tid = tid;
-            process->in_syscall = 0;
-            process->wd = NULL;
+            process = trace_new_process(tid, PROCESS_UNKNOWN);
             trace_set_options(tid);
             /* Don't resume, it will be set to ATTACHED and resumed when fork()
              * returns */
@@ -353,12 +1057,12 @@ static int trace(pid_t first_proc, int *first_exit_code)
         }
         else if(process->status == PROCESS_ALLOCATED)
         {
-            process->status = PROCESS_ATTACHED;
+            trace_set_status(process, PROCESS_ATTACHED);
 
             if(verbosity >= 3)
                 log_debug(tid, "process attached");
             trace_set_options(tid);
-            ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+            trace_resume(process, 0);
             if(verbosity >= 2)
             {
                 unsigned int nproc, unknown;
@@ -371,93 +1075,30 @@ static int trace(pid_t first_proc, int *first_exit_code)
 
         if(WIFSTOPPED(status) && WSTOPSIG(status) & 0x80)
         {
-            size_t len = 0;
-#ifdef I386
-            struct i386_regs regs;
-#else /* def X86_64 */
-            struct x86_64_regs regs;
-#endif
-            /* Try to use GETREGSET first, since iov_len allows us to know if
-             * 32bit or 64bit mode was used */
-#ifdef PTRACE_GETREGSET
-#ifndef NT_PRSTATUS
-#define NT_PRSTATUS  1
-#endif
-            {
-                struct iovec iov;
-                iov.iov_base = &regs;
-                iov.iov_len = sizeof(regs);
-                if(ptrace(PTRACE_GETREGSET, tid, NT_PRSTATUS, &iov) == 0)
-                    len = iov.iov_len;
-            }
-            if(len == 0)
-#endif
-            /* GETREGSET undefined or call failed, fallback on GETREGS */
-            {
-                /* LCOV_EXCL_START : GETREGSET was added by Linux 2.6.34 in
-                 * May 2010 (2225a122) */
-                ptrace(PTRACE_GETREGS, tid, NULL, &regs);
-                /* LCOV_EXCL_END */
-            }
-#if defined(I386)
-            if(!process->in_syscall || regs.orig_eax >= 0)
-                process->current_syscall = regs.orig_eax;
-            if(process->in_syscall)
-                get_i386_reg(&process->retvalue, regs.eax);
-            else
-            {
-                get_i386_reg(&process->params[0], regs.ebx);
-                get_i386_reg(&process->params[1], regs.ecx);
-                get_i386_reg(&process->params[2], regs.edx);
-                get_i386_reg(&process->params[3], regs.esi);
-                get_i386_reg(&process->params[4], regs.edi);
-                get_i386_reg(&process->params[5], regs.ebp);
-            }
-            process->mode = MODE_I386;
-#elif defined(X86_64)
-            /* On x86_64, process might be 32 or 64 bits */
-            /* If len is known (not 0) and not that of x86_64 registers,
-             * or if len is not known (0) and CS is 0x23 (not as reliable) */
-            if( (len != 0 && len != sizeof(regs))
-             || (len == 0 && regs.cs == 0x23) )
+            int decoded = 0;
+            /* We don't need anything from the exits we don't handle */
+            if(process->in_syscall && !syscall_exit_handled(process))
+                ++trace_stats.exits_skipped;
+            else if((decoded = trace_get_syscall_info(process)) == 0)
+                trace_get_registers(process);
+            if(decoded < 0)
             {
-                /* 32 bit mode */
-                struct i386_regs *x86regs = (struct i386_regs*)&regs;
-                if(!process->in_syscall || x86regs->orig_eax >= 0)
-                    process->current_syscall = x86regs->orig_eax;
-                if(process->in_syscall)
-                    get_i386_reg(&process->retvalue, x86regs->eax);
-                else
-                {
-                    get_i386_reg(&process->params[0], x86regs->ebx);
-                    get_i386_reg(&process->params[1], x86regs->ecx);
-                    get_i386_reg(&process->params[2], x86regs->edx);
-                    get_i386_reg(&process->params[3], x86regs->esi);
-                    get_i386_reg(&process->params[4], x86regs->edi);
-                    get_i386_reg(&process->params[5], x86regs->ebp);
-                }
-                process->mode = MODE_I386;
-            }
-            else
-            {
-                /* 64 bit mode */
-                if(!process->in_syscall || regs.orig_rax >= 0)
-                    process->current_syscall = regs.orig_rax;
-                if(process->in_syscall)
-                    get_x86_64_reg(&process->retvalue, regs.rax);
-                else
-                {
-                    get_x86_64_reg(&process->params[0], regs.rdi);
-                    get_x86_64_reg(&process->params[1], regs.rsi);
-                    get_x86_64_reg(&process->params[2], regs.rdx);
-                    get_x86_64_reg(&process->params[3], regs.r10);
-                    get_x86_64_reg(&process->params[4], regs.r8);
-                    get_x86_64_reg(&process->params[5], regs.r9);
-                }
-                /* Might still be either native x64 or Linux's x32 layer */
-                process->mode = MODE_X86_64;
+                /* The number and arguments are still in the registers */
+                trace_get_registers(process);
+                process->in_syscall = 1;
+                trace_get_registers(process);
+                if(syscall_handle_missed_entry(process) != 0)
+                    return -1;
             }
-#endif
+            else if(syscall_handle(process) != 0)
+                return -1;
+        }
+        /* Stopped by the seccomp filter: this is a syscall entry */
+        else if(WIFSTOPPED(status)
+              && status >> 8 == (SIGTRAP | (PTRACE_EVENT_SECCOMP << 8)))
+        {
+            if(!trace_get_syscall_info(process))
+                trace_get_registers(process);
             if(syscall_handle(process) != 0)
                 return -1;
         }
@@ -465,17 +1106,34 @@ static int trace(pid_t first_proc, int *first_exit_code)
         else if(WIFSTOPPED(status))
         {
             int signum = WSTOPSIG(status) & 0x7F;
+            ++trace_stats.other_stops;
 
+            /* Group-stop of a process we attached to: it stays stopped,
+             * PTRACE_LISTEN lets us know when it's continued */
+            if(status >> 16 == PTRACE_EVENT_STOP && signum != SIGTRAP)
+            {
+                if(detaching)
+                    trace_resume(process, 0);
+                else
+                    ptrace(PTRACE_LISTEN, tid, NULL, NULL);
+            }
             /* Synthetic signal for ptrace event: resume */
-            if(signum == SIGTRAP && status & 0xFF0000)
-                ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+            else if(signum == SIGTRAP && status & 0xFF0000)
+            {
+                if(status >> 16 == PTRACE_EVENT_EXIT
+                 && trace_record_usage(process) != 0)
+                    return -1;
+                if(detaching)
+                    trace_detach_new_process(process, status >> 16);
+                trace_resume(process, 0);
+            }
             else if(signum == SIGTRAP)
             {
                 /* LCOV_EXCL_START : Processes shouldn't be getting SIGTRAPs */
                 log_warn(0,
                          "NOT delivering SIGTRAP to %d\n"
                          "    waitstatus=0x%X", tid, status);
-                ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+                trace_resume(process, 0);
                 /* LCOV_EXCL_END */
             }
             /* Other signal, let the process handle it */
@@ -485,14 +1143,14 @@ static int trace(pid_t first_proc, int *first_exit_code)
                 if(verbosity >= 2)
                     log_info(tid, "caught signal %d", signum);
                 if(ptrace(PTRACE_GETSIGINFO, tid, 0, (long)&si) >= 0)
-                    ptrace(PTRACE_SYSCALL, tid, NULL, signum);
+                    trace_resume(process, signum);
                 else
                 {
                     /* LCOV_EXCL_START : Not sure what this is for... doesn't
                      * seem to happen in practice */
                     log_error(tid, "    NOT delivering: %s", strerror(errno));
                     if(signum != SIGSTOP)
-                        ptrace(PTRACE_SYSCALL, tid, NULL, NULL);
+                        trace_resume(process, 0);
                     /* LCOV_EXCL_END */
                 }
             }
@@ -522,21 +1180,30 @@ static void restore_signals(void)
 static void cleanup(void)
 {
     size_t i;
+    if(attached_mode)
+        log_error(0, "cleaning up, %u processes to detach from...",
+                  nb_processes);
+    else
+        log_error(0, "cleaning up, %u processes to kill...", nb_processes);
+    for(i = 0; i < table_size; ++i)
     {
-        size_t nb = 0;
-        for(i = 0; i < processes_size; ++i)
-            if(processes[i]->status != PROCESS_FREE)
-                ++nb;
-        /* size_t size is implementation dependent; %u for size_t can trigger
-         * a warning */
-        log_error(0, "cleaning up, %u processes to kill...", (unsigned int)nb);
-    }
-    for(i = 0; i < processes_size; ++i)
-    {
-        if(processes[i]->status != PROCESS_FREE)
+        while(tid_table[i] != NULL)
         {
-            kill(processes[i]->tid, SIGKILL);
-            free(processes[i]->wd);
+            struct Process *process = tid_table[i];
+            if(!attached_mode)
+                kill(process->tid, SIGKILL);
+            else if(process->status != PROCESS_DETACHED)
+            {
+                /* UNKNOWN processes are already stopped */
+                if(process->status != PROCESS_UNKNOWN)
+                {
+                    int status;
+                    ptrace(PTRACE_INTERRUPT, process->tid, NULL, NULL);
+                    waitpid(process->tid, &status, __WALL);
+                }
+                ptrace(PTRACE_DETACH, process->tid, NULL, 0);
+            }
+            trace_free_process(process);
         }
     }
 }
@@ -549,50 +1216,113 @@ static void sigint_handler(int signo)
     (void)signo;
     if(now - last_int < 2)
     {
+        size_t i;
         if(verbosity >= 1)
             log_error(0, "cleaning up on SIGINT");
-        cleanup();
-        restore_signals();
-        exit(1);
+        /* Kill the processes so that waitpid() returns; trace() then sees
+         * the flag and we exit from fork_and_trace(), after the database has
+         * been committed */
+        interrupted = 1;
+        for(i = 0; i < table_size; ++i)
+        {
+            struct Process *process;
+            for(process = tid_table[i];
+                process != NULL;
+                process = process->tid_next)
+                kill(process->tid, SIGKILL);
+        }
     }
     else if(verbosity >= 1)
         log_error(0, "Got SIGINT, press twice to abort...");
     last_int = now;
 }
 
+/* Signals that make attach_and_trace() detach, restored by
+ * restore_detach_signals() */
+static const int detach_signals[] = {SIGINT, SIGTERM, SIGALRM};
+#define NB_DETACH_SIGNALS (sizeof(detach_signals) / sizeof(detach_signals[0]))
+static struct sigaction previous_detach_actions[NB_DETACH_SIGNALS];
+
+static void detach_handler(int signo)
+{
+    size_t i;
+    (void)signo;
+    if(verbosity >= 1 && signo != SIGALRM)
+        log_info(0, "Got signal %d, detaching...", signo);
+    detach_requested = 1;
+    /* waitpid() gets interrupted, but we might not have been in it yet;
+     * stopping the processes makes sure that it returns */
+    for(i = 0; i < table_size; ++i)
+    {
+        struct Process *process;
+        for(process = tid_table[i];
+            process != NULL;
+            process = process->tid_next)
+        {
+            if(process->status == PROCESS_ATTACHED)
+                ptrace(PTRACE_INTERRUPT, process->tid, NULL, NULL);
+        }
+    }
+}
+
+static void catch_detach_signals(void)
+{
+    size_t i;
+    struct sigaction action;
+    memset(&action, 0, sizeof(action));
+    action.sa_handler = detach_handler;
+    sigemptyset(&action.sa_mask);
+    /* No SA_RESTART, so that waitpid() gets interrupted */
+    action.sa_flags = 0;
+    for(i = 0; i < NB_DETACH_SIGNALS; ++i)
+        sigaction(detach_signals[i], &action, &previous_detach_actions[i]);
+}
+
+static void restore_detach_signals(void)
+{
+    size_t i;
+    for(i = 0; i < NB_DETACH_SIGNALS; ++i)
+        sigaction(detach_signals[i], &previous_detach_actions[i], NULL);
+}
+
 static void trace_init(void)
 {
     /* Store Python's handlers for restore_signals() */
     python_sigchld_handler = signal(SIGCHLD, SIG_DFL);
     python_sigint_handler = signal(SIGINT, sigint_handler);
 
-    if(processes == NULL)
+    if(tid_table == NULL)
     {
-        size_t i;
-        struct Process *pool;
-        processes_size = 16;
-        processes = malloc(processes_size * sizeof(*processes));
-        pool = malloc(processes_size * sizeof(*pool));
-        for(i = 0; i < processes_size; ++i)
-        {
-            processes[i] = pool++;
-            processes[i]->status = PROCESS_FREE;
-            processes[i]->in_syscall = 0;
-            processes[i]->current_syscall = -1;
-            processes[i]->syscall_info = NULL;
-            processes[i]->wd = NULL;
-        }
+        trace_resize_tables(64);
+        trace_grow_pool(16);
     }
 
-    syscall_build_table();
+    syscall_build_table(trace_syscall_groups);
+}
+
+static int open_log_file(void)
+{
+    char logfilename[1024];
+    strcpy(logfilename, getenv("HOME"));
+    strcat(logfilename, "/.reprozip/log");
+    return log_open_file(logfilename);
 }
 
 int fork_and_trace(const char *binary, int argc, char **argv,
                    const char *database_path, int *exit_status)
 {
     pid_t child;
+    int ret;
+    unsigned long long start;
 
     trace_init();
+    memset(&trace_stats, 0, sizeof(trace_stats));
+
+    if(trace_use_seccomp && !seccomp_supported())
+    {
+        log_warn(0, "seccomp filtering requires Linux 4.8, disabling");
+        trace_use_seccomp = 0;
+    }
 
     child = fork();
 
@@ -606,6 +1336,9 @@ int fork_and_trace(const char *binary, int argc, char **argv,
         args[argc] = NULL;
         /* Trace this process */
         ptrace(PTRACE_TRACEME, 0, NULL, NULL);
+        /* Only stop on the syscalls we handle */
+        if(trace_use_seccomp && syscall_install_filter() != 0)
+            exit(1);
         /* Stop this once so tracer can set options */
         kill(getpid(), SIGSTOP);
         /* Execute the target */
@@ -615,16 +1348,10 @@ int fork_and_trace(const char *binary, int argc, char **argv,
         exit(1);
     }
 
-    /* Open log file */
+    if(open_log_file() != 0)
     {
-        char logfilename[1024];
-        strcpy(logfilename, getenv("HOME"));
-        strcat(logfilename, "/.reprozip/log");
-        if(log_open_file(logfilename) != 0)
-        {
-            restore_signals();
-            return 1;
-        }
+        restore_signals();
+        return 1;
     }
 
     if(db_init(database_path) != 0)
@@ -637,13 +1364,15 @@ int fork_and_trace(const char *binary, int argc, char **argv,
 
     /* Creates entry for first process */
     {
-        struct Process *process = trace_get_empty_process();
-        process->status = PROCESS_ALLOCATED; /* Not yet attached... */
+        /* Not yet attached... */
+        struct Process *process = trace_new_process(child, PROCESS_ALLOCATED);
         /* We sent a SIGSTOP, but we resume on attach */
-        process->tid = child;
-        process->tgid = child;
-        process->in_syscall = 0;
-        process->wd = get_wd();
+        trace_set_tgid(process, child);
+        {
+            char *wd = get_wd();
+            process->wd = path_intern(wd);
+            free(wd);
+        }
 
         if(verbosity >= 2)
             log_info(0, "process %d created by initial fork()", child);
@@ -658,16 +1387,27 @@ int fork_and_trace(const char *binary, int argc, char **argv,
         }
     }
 
-    if(trace(child, exit_status) != 0)
+    start = monotonic_ns();
+    ret = trace(child, exit_status);
+    trace_stats.wall_time = monotonic_ns() - start;
+    exec_cache_clear();
+    path_cache_free();
+    if(ret != 0)
     {
         cleanup();
         db_close();
+        path_intern_free();
         log_close_file();
         restore_signals();
+        if(interrupted)
+            exit(1);
         return 1;
     }
 
-    if(db_close() != 0)
+    /* The database thread uses the interned paths until it's done */
+    ret = db_close();
+    path_intern_free();
+    if(ret != 0)
     {
         log_close_file();
         restore_signals();
@@ -677,3 +1417,292 @@ int fork_and_trace(const char *binary, int argc, char **argv,
     restore_signals();
     return 0;
 }
+
+
+/* ********************
+ * Attaching to running processes
+ */
+
+/**
+ * Reads a symbolic link from /proc/<pid>/, such as cwd or exe.
+ *
+ * Returns a string that the caller must free(), or NULL.
+ */
+static char *read_proc_link(pid_t pid, const char *name)
+{
+    char filename[64];
+    size_t size = 1024;
+    sprintf(filename, "/proc/%d/%s", (int)pid, name);
+    for(;;)
+    {
+        char *target = malloc(size);
+        ssize_t len = readlink(filename, target, size);
+        if(len < 0)
+        {
+            free(target);
+            return NULL;
+        }
+        else if((size_t)len < size)
+        {
+            target[len] = '\0';
+            return target;
+        }
+        free(target);
+        size <<= 1;
+    }
+}
+
+/**
+ * Reads a list of NUL-terminated strings from /proc/<pid>/, such as cmdline
+ * or environ, into a NULL-terminated array for free_strarray().
+ */
+static char **read_proc_strings(pid_t pid, const char *name)
+{
+    char filename[64];
+    char *data;
+    size_t size, pos, nb = 0;
+    char **array;
+    sprintf(filename, "/proc/%d/%s", (int)pid, name);
+    data = read_file(filename, &size);
+    if(data == NULL)
+    {
+        array = malloc(sizeof(char*));
+        array[0] = NULL;
+        return array;
+    }
+    for(pos = 0; pos < size; pos += strlen(data + pos) + 1)
+        ++nb;
+    array = malloc((nb + 1) * sizeof(char*));
+    nb = 0;
+    for(pos = 0; pos < size; pos += strlen(data + pos) + 1)
+        array[nb++] = strdup(data + pos);
+    array[nb] = NULL;
+    free(data);
+    return array;
+}
+
+/**
+ * Reads the parent of a process from /proc/<pid>/stat, or returns -1.
+ */
+static pid_t read_parent_pid(pid_t pid)
+{
+    char filename[64];
+    char *data, *end;
+    size_t size;
+    int ppid;
+    sprintf(filename, "/proc/%d/stat", (int)pid);
+    data = read_file(filename, &size);
+    if(data == NULL)
+        return -1;
+    /* The command name is in parentheses, and can contain anything */
+    end = strrchr(data, ')');
+    if(end == NULL || sscanf(end + 1, " %*c %d", &ppid) != 1)
+        ppid = -1;
+    free(data);
+    return ppid;
+}
+
+/**
+ * Attaches to a thread with PTRACE_SEIZE and interrupts it, so that trace()
+ * gets to resume it with PTRACE_SYSCALL.
+ *
+ * parent is the process whose row the new one refers to, or NULL for the
+ * first process.
+ */
+static struct Process *trace_seize(pid_t tid, pid_t tgid,
+                                   struct Process *parent)
+{
+    struct Process *process;
+    if(ptrace(PTRACE_SEIZE, tid, NULL, trace_options()) != 0)
+    {
+        if(verbosity >= 2)
+            log_info(tid, "couldn't attach: %s", strerror(errno));
+        return NULL;
+    }
+    ptrace(PTRACE_INTERRUPT, tid, NULL, NULL);
+    process = trace_new_process(tid, PROCESS_ATTACHED);
+    trace_set_tgid(process, tgid);
+    {
+        char *wd = read_proc_link(tid, "cwd");
+        process->wd = path_intern(wd != NULL?wd:"/UNKNOWN");
+        free(wd);
+    }
+    if(verbosity >= 2)
+        log_info(tid, "attached (thread group %d, working directory: %s)",
+                 tgid, path_string(process->wd));
+    if(parent == NULL)
+    {
+        if(db_add_first_process(&process->identifier, process->wd) != 0)
+            return NULL;
+    }
+    else if(db_add_process(&process->identifier, parent->identifier,
+                           process->wd) != 0)
+        return NULL;
+    return process;
+}
+
+/**
+ * Attaches to every thread of a process, the thread group leader first.
+ *
+ * Returns the leader, or NULL if it couldn't be attached to.
+ */
+static struct Process *trace_seize_group(pid_t pid, struct Process *parent)
+{
+    char dirname[64];
+    DIR *tasks;
+    struct dirent *entry;
+    struct Process *leader = trace_seize(pid, pid, parent);
+    if(leader == NULL)
+        return NULL;
+    sprintf(dirname, "/proc/%d/task", (int)pid);
+    tasks = opendir(dirname);
+    if(tasks == NULL)
+        return leader;
+    while((entry = readdir(tasks)) != NULL)
+    {
+        pid_t tid = atoi(entry->d_name);
+        /* Threads created since were attached automatically */
+        if(tid > 0 && trace_find_process(tid) == NULL)
+            trace_seize(tid, pid, leader);
+    }
+    closedir(tasks);
+    return leader;
+}
+
+/**
+ * Attaches to a process and all its descendants.
+ *
+ * The processes they create from now on are attached automatically, but
+ * /proc is scanned again until no process that was created in between is
+ * found.
+ */
+static int trace_seize_tree(pid_t pid)
+{
+    struct Process *first;
+    unsigned int found;
+    first = trace_seize_group(pid, NULL);
+    if(first == NULL)
+    {
+        log_critical(pid, "couldn't attach to process: %s", strerror(errno));
+        return -1;
+    }
+    if(verbosity >= 2)
+        log_info(pid, "attached to first process");
+
+    /* Record what the process is running, so that it makes a run */
+    {
+        char *binary = read_proc_link(pid, "exe");
+        char **argv = read_proc_strings(pid, "cmdline");
+        char **envp = read_proc_strings(pid, "environ");
+        int ret = -1;
+        if(binary != NULL)
+        {
+            ret = db_add_exec(first->identifier, path_intern(binary),
+                              (const char *const*)argv,
+                              (const char *const*)envp,
+                              first->wd);
+            if(ret == 0)
+                ret = trace_add_files_from_proc(first->identifier, pid,
+                                                binary);
+        }
+        else
+            log_critical(pid, "couldn't read the process' executable");
+        free(binary);
+        free_strarray(argv);
+        free_strarray(envp);
+        if(ret != 0)
+            return -1;
+    }
+
+    do
+    {
+        DIR *procs = opendir("/proc");
+        struct dirent *entry;
+        found = 0;
+        if(procs == NULL)
+            break;
+        while((entry = readdir(procs)) != NULL)
+        {
+            pid_t child = atoi(entry->d_name);
+            pid_t ppid;
+            struct Process *parent;
+            if(child <= 0 || trace_find_process(child) != NULL)
+                continue;
+            ppid = read_parent_pid(child);
+            parent = ppid > 0?trace_find_process(ppid):NULL;
+            if(parent == NULL || parent->status == PROCESS_UNKNOWN)
+                continue;
+            if(trace_seize_group(child, parent) != NULL)
+                ++found;
+        }
+        closedir(procs);
+    } while(found > 0);
+    return 0;
+}
+
+int attach_and_trace(pid_t pid, unsigned int duration,
+                     const char *database_path, int *exit_status)
+{
+    int ret;
+    unsigned long long start;
+
+    trace_init();
+    memset(&trace_stats, 0, sizeof(trace_stats));
+
+    /* The filter can only be installed by the process itself */
+    if(trace_use_seccomp)
+    {
+        log_warn(0, "seccomp filtering is not available when attaching, "
+                 "disabling");
+        trace_use_seccomp = 0;
+    }
+
+    attached_mode = 1;
+    detach_requested = 0;
+    detaching = 0;
+    *exit_status = -1;
+
+    if(open_log_file() != 0)
+    {
+        attached_mode = 0;
+        restore_signals();
+        return 1;
+    }
+
+    if(db_init(database_path) != 0)
+    {
+        attached_mode = 0;
+        log_close_file();
+        restore_signals();
+        return 1;
+    }
+
+    catch_detach_signals();
+    start = monotonic_ns();
+    if(trace_seize_tree(pid) == 0)
+    {
+        if(duration > 0)
+            alarm(duration);
+        ret = trace(pid, exit_status);
+        alarm(0);
+    }
+    else
+        ret = -1;
+    trace_stats.wall_time = monotonic_ns() - start;
+    if(ret != 0)
+        cleanup();
+    restore_detach_signals();
+    attached_mode = 0;
+    detach_requested = 0;
+    detaching = 0;
+    exec_cache_clear();
+    path_cache_free();
+
+    /* The database thread uses the interned paths until it's done */
+    if(db_close() != 0)
+        ret = -1;
+    path_intern_free();
+    log_close_file();
+    restore_signals();
+    return ret == 0?0:1;
+}
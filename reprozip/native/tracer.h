@@ -7,9 +7,54 @@
 int fork_and_trace(const char *binary, int argc, char **argv,
                    const char *database_path, int *exit_status);
 
+/* Traces the already running process pid and its descendants, until they all
+ * exit, duration seconds have elapsed (0 for no limit) or we get SIGINT or
+ * SIGTERM, then detaches from them and leaves them running. exit_status is
+ * set to -1 if the process is still running */
+int attach_and_trace(pid_t pid, unsigned int duration,
+                     const char *database_path, int *exit_status);
+
 
 extern int trace_verbosity;
 
+/* If set, a seccomp filter is installed in the traced program so that it only
+ * stops on the syscalls that we handle */
+extern int trace_use_seccomp;
+
+/* If set (the default), syscalls are decoded using PTRACE_GET_SYSCALL_INFO,
+ * falling back on PTRACE_GETREGSET if needed */
+extern int trace_use_syscall_info;
+
+/* Groups of syscalls that are handled (and trap, with seccomp), see
+ * syscall_profile() */
+extern unsigned int trace_syscall_groups;
+
+/* Syscall tables, see syscalls.c */
+#define SYSCALL_I386        0
+#define SYSCALL_X86_64      1
+#define SYSCALL_X86_64_x32  2
+#define SYSCALL_TYPES       3
+
+/* Counters about the tracer's own overhead, reset by fork_and_trace() */
+#define TRACE_STATS_SYSCALLS 512
+
+struct TraceStats {
+    /* Syscall stops (entry and exit), per syscall table and number */
+    unsigned long syscall_stops[SYSCALL_TYPES][TRACE_STATS_SYSCALLS];
+    /* Other stops: signals, ptrace events, unknown syscalls */
+    unsigned long other_stops;
+    /* How syscall stops were decoded, and exits that didn't need to be */
+    unsigned long syscall_info_reads;
+    unsigned long register_reads;
+    unsigned long exits_skipped;
+    /* Time spent handling stops, during which a tracee is stopped, and total
+     * tracing time, in nanoseconds */
+    unsigned long long stopped_time;
+    unsigned long long wall_time;
+};
+
+extern struct TraceStats trace_stats;
+
 
 /* This is NOT a union because sign-extension rules depend on actual register
  * sizes. */
@@ -30,10 +75,15 @@ struct Process {
     int status;
     int in_syscall;
     int current_syscall;
-    char *wd;
+    unsigned int wd;            /* interned path, see utils.h */
     register_type retvalue;
     register_type params[PROCESS_ARGS];
     void *syscall_info;
+
+    /* Links in the process table, see tracer.c */
+    struct Process *tid_next;   /* tid hash chain, or free list */
+    struct Process *tgid_next;  /* tgid hash chain */
+    int in_tgid_index;
 };
 
 #define PROCESS_FREE        0   /* unallocated entry in table */
@@ -41,19 +91,23 @@ struct Process {
 #define PROCESS_ATTACHED    2   /* running process */
 #define PROCESS_UNKNOWN     3   /* attached but no corresponding fork() call
                                  * has finished yet */
+#define PROCESS_DETACHED    4   /* no longer traced, see attach_and_trace() */
 
 #define MODE_I386           1
 #define MODE_X86_64         2   /* In x86_64 mode, syscalls might be native x64
                                  * or x32 */
 
-/* FIXME : This is only exposed because of execve() workaround */
-extern struct Process **processes;
-extern size_t processes_size;
+struct Process *trace_find_process(pid_t tid);
 
+struct Process *trace_first_in_group(pid_t tgid);
+struct Process *trace_next_in_group(struct Process *process);
 
-struct Process *trace_find_process(pid_t tid);
+void trace_resume(struct Process *process, int signum);
 
-struct Process *trace_get_empty_process(void);
+struct Process *trace_new_process(pid_t tid, int status);
+void trace_set_status(struct Process *process, int status);
+void trace_set_tgid(struct Process *process, pid_t tgid);
+void trace_free_process(struct Process *process);
 
 void trace_count_processes(unsigned int *p_nproc, unsigned int *p_unknown);
 
@@ -4,6 +4,7 @@
 #include <string.h>
 
 #include <fcntl.h>
+#include <time.h>
 #include <sys/stat.h>
 #include <sys/types.h>
 #include <unistd.h>
@@ -52,29 +53,6 @@ unsigned int flags2mode(int flags)
     return mode;
 }
 
-char *abspath(const char *wd, const char *path)
-{
-    size_t len_wd = strlen(wd);
-    if(wd[len_wd-1] == '/')
-    {
-        /* LCOV_EXCL_START : We usually get canonical path names, so we don't
-         * run into this one */
-        char *result = malloc(len_wd + strlen(path) + 1);
-        memcpy(result, wd, len_wd);
-        strcpy(result + len_wd, path);
-        return result;
-        /* LCOV_EXCL_END */
-    }
-    else
-    {
-        char *result = malloc(len_wd + 1 + strlen(path) + 1);
-        memcpy(result, wd, len_wd);
-        result[len_wd] = '/';
-        strcpy(result + len_wd + 1, path);
-        return result;
-    }
-}
-
 char *get_wd(void)
 {
     /* PATH_MAX has issues, don't use it */
@@ -101,46 +79,690 @@ char *get_wd(void)
     }
 }
 
-char *read_line(char *buffer, size_t *size, FILE *fp)
+char *read_file(const char *filename, size_t *size)
 {
+    /* Files in /proc report a size of 0, so we can't use stat() */
+    size_t capacity = 16384;
     size_t pos = 0;
-    if(buffer == NULL)
+    char *buffer;
+    int fd = open(filename, O_RDONLY);
+    if(fd == -1)
+        return NULL;
+    buffer = malloc(capacity);
+    for(;;)
     {
-        *size = 4096;
-        buffer = malloc(*size);
+        ssize_t ret = read(fd, buffer + pos, capacity - pos - 1);
+        if(ret < 0)
+        {
+            if(errno == EINTR)
+                continue;
+            free(buffer);
+            close(fd);
+            return NULL;
+        }
+        else if(ret == 0)
+            break;
+        pos += ret;
+        if(pos + 1 >= capacity)
+        {
+            capacity <<= 1;
+            buffer = realloc(buffer, capacity);
+        }
     }
-    for(;;)
+    close(fd);
+    buffer[pos] = '\0';
+    *size = pos;
+    return buffer;
+}
+
+size_t hash_str(const char *str)
+{
+    /* djb2 */
+    size_t hash = 5381;
+    for(; *str; ++str)
+        hash = hash * 33 + (unsigned char)*str;
+    return hash;
+}
+
+/* Interned paths: each distinct path is stored once for the whole trace, in
+ * large blocks instead of a malloc() per string, and is identified by a
+ * non-zero integer. The blocks are only freed by path_intern_free(), so
+ * strings can be handed to the database thread without copying them. */
+
+#define PATH_BLOCK_SIZE (64 * 1024)
+
+struct PathBlock {
+    struct PathBlock *next;
+    /* Strings are stored after the structure */
+};
+
+static struct PathBlock *path_blocks = NULL;
+static char *path_block_pos = NULL;
+static size_t path_block_left = 0;
+
+/* Strings and their hashes, indexed by id (0 is unused) */
+static const char **path_strings = NULL;
+static size_t *path_hashes = NULL;
+static unsigned int nb_paths = 0;
+static size_t path_strings_size = 0;
+
+/* Open-addressing hash table of ids, 0 meaning empty */
+static unsigned int *path_index = NULL;
+static size_t path_index_size = 0;
+
+static char *path_block_alloc(size_t size)
+{
+    struct PathBlock *block;
+    char *result;
+    if(size > path_block_left)
     {
-        char c;
+        if(size > PATH_BLOCK_SIZE / 4)
         {
-            int t = getc(fp);
-            if(t == EOF)
+            /* Long string: gets its own block, the current one is kept */
+            block = malloc(sizeof(*block) + size);
+            if(path_blocks == NULL)
             {
-                free(buffer);
-                return NULL;
+                block->next = NULL;
+                path_blocks = block;
             }
-            c = t;
+            else
+            {
+                block->next = path_blocks->next;
+                path_blocks->next = block;
+            }
+            return (char*)(block + 1);
         }
-        if(c == '\n')
+        block = malloc(sizeof(*block) + PATH_BLOCK_SIZE);
+        block->next = path_blocks;
+        path_blocks = block;
+        path_block_pos = (char*)(block + 1);
+        path_block_left = PATH_BLOCK_SIZE;
+    }
+    result = path_block_pos;
+    path_block_pos += size;
+    path_block_left -= size;
+    return result;
+}
+
+static void path_index_grow(void)
+{
+    size_t new_size = path_index_size?path_index_size * 2:1024;
+    unsigned int *new_index = calloc(new_size, sizeof(*new_index));
+    unsigned int id;
+    for(id = 1; id <= nb_paths; ++id)
+    {
+        size_t h = path_hashes[id] & (new_size - 1);
+        while(new_index[h] != 0)
+            h = (h + 1) & (new_size - 1);
+        new_index[h] = id;
+    }
+    free(path_index);
+    path_index = new_index;
+    path_index_size = new_size;
+}
+
+static unsigned int path_intern_len(const char *path, size_t len)
+{
+    size_t hash = 5381;
+    size_t i, h;
+    unsigned int id;
+    char *str;
+    /* djb2, same as hash_str() */
+    for(i = 0; i < len; ++i)
+        hash = hash * 33 + (unsigned char)path[i];
+
+    if(path_index_size == 0)
+        path_index_grow();
+    h = hash & (path_index_size - 1);
+    while((id = path_index[h]) != 0)
+    {
+        if(path_hashes[id] == hash
+         && strncmp(path_strings[id], path, len) == 0
+         && path_strings[id][len] == '\0')
+            return id;
+        h = (h + 1) & (path_index_size - 1);
+    }
+
+    /* New path */
+    if(nb_paths + 1 >= path_strings_size)
+    {
+        path_strings_size = path_strings_size?path_strings_size * 2:1024;
+        path_strings = realloc(path_strings,
+                               path_strings_size * sizeof(*path_strings));
+        path_hashes = realloc(path_hashes,
+                              path_strings_size * sizeof(*path_hashes));
+    }
+    id = ++nb_paths;
+    str = path_block_alloc(len + 1);
+    memcpy(str, path, len);
+    str[len] = '\0';
+    path_strings[id] = str;
+    path_hashes[id] = hash;
+    path_index[h] = id;
+    /* Keeps the table at most half full */
+    if(nb_paths * 2 > path_index_size)
+        path_index_grow();
+    return id;
+}
+
+unsigned int path_intern(const char *path)
+{
+    return path_intern_len(path, strlen(path));
+}
+
+unsigned int path_intern_abs(unsigned int wd, const char *path)
+{
+    static char *buffer = NULL;
+    static size_t buffer_size = 0;
+    const char *wd_str;
+    size_t len_wd, len_path;
+    if(path[0] == '/')
+        return path_intern(path);
+    wd_str = path_strings[wd];
+    len_wd = strlen(wd_str);
+    len_path = strlen(path);
+    if(len_wd + 1 + len_path + 1 > buffer_size)
+    {
+        buffer_size = len_wd + 1 + len_path + 1;
+        if(buffer_size < 1024)
+            buffer_size = 1024;
+        buffer = realloc(buffer, buffer_size);
+    }
+    memcpy(buffer, wd_str, len_wd);
+    /* We usually get canonical path names, so wd doesn't end with a slash
+     * (unless it's the root) */
+    if(len_wd == 0 || wd_str[len_wd - 1] != '/')
+        buffer[len_wd++] = '/';
+    memcpy(buffer + len_wd, path, len_path);
+    return path_intern_len(buffer, len_wd + len_path);
+}
+
+static void path_resolve_free(void);
+static void path_exclusions_forget(void);
+
+const char *path_string(unsigned int id)
+{
+    return path_strings[id];
+}
+
+void path_intern_free(void)
+{
+    path_resolve_free();
+    path_exclusions_forget();
+    while(path_blocks != NULL)
+    {
+        struct PathBlock *next = path_blocks->next;
+        free(path_blocks);
+        path_blocks = next;
+    }
+    path_block_pos = NULL;
+    path_block_left = 0;
+    free(path_strings);
+    free(path_hashes);
+    free(path_index);
+    path_strings = NULL;
+    path_hashes = NULL;
+    path_index = NULL;
+    nb_paths = 0;
+    path_strings_size = 0;
+    path_index_size = 0;
+}
+
+/* ********************
+ * Resolution of symbolic links: gets the canonical path of an interned path,
+ * and the links that were traversed to get there. Results are memoized for
+ * every path, so resolving a file only costs a lstat() of that file once its
+ * directory has been seen.
+ */
+
+/* Same limit as Linux */
+#define PATH_RESOLVE_MAX_LINKS 40
+
+struct PathResolution {
+    unsigned int canonical;     /* 0 if not resolved */
+    unsigned int nb_links;
+    unsigned int *links;
+};
+
+static struct PathResolution *path_resolutions = NULL;
+static size_t path_resolutions_size = 0;
+
+unsigned int path_resolve_generation = 1;
+
+/* Links traversed during the current path_resolve() call */
+static unsigned int *resolve_links = NULL;
+static size_t resolve_nb_links = 0;
+static size_t resolve_links_size = 0;
+
+static char *resolve_buffer = NULL;
+static size_t resolve_buffer_size = 0;
+
+static void resolve_add_links(const unsigned int *links, size_t nb)
+{
+    if(resolve_nb_links + nb > resolve_links_size)
+    {
+        while(resolve_nb_links + nb > resolve_links_size)
+            resolve_links_size = resolve_links_size?resolve_links_size * 2:64;
+        resolve_links = realloc(resolve_links,
+                                resolve_links_size * sizeof(*resolve_links));
+    }
+    memcpy(resolve_links + resolve_nb_links, links, nb * sizeof(*links));
+    resolve_nb_links += nb;
+}
+
+/* Interns dir/name */
+static unsigned int resolve_join(const char *dir, const char *name,
+                                 size_t name_len)
+{
+    size_t dir_len = strlen(dir);
+    if(dir_len + 1 + name_len > resolve_buffer_size)
+    {
+        resolve_buffer_size = dir_len + 1 + name_len;
+        if(resolve_buffer_size < 1024)
+            resolve_buffer_size = 1024;
+        resolve_buffer = realloc(resolve_buffer, resolve_buffer_size);
+    }
+    memcpy(resolve_buffer, dir, dir_len);
+    if(dir_len == 0 || dir[dir_len - 1] != '/')
+        resolve_buffer[dir_len++] = '/';
+    memcpy(resolve_buffer + dir_len, name, name_len);
+    return path_intern_len(resolve_buffer, dir_len + name_len);
+}
+
+static unsigned int path_resolve_rec(unsigned int id, unsigned int depth);
+
+/**
+ * Resolves a path whose parent directory (dir) is canonical: only the last
+ * component might be a link.
+ */
+static unsigned int path_resolve_last(unsigned int id, unsigned int dir,
+                                      unsigned int depth)
+{
+    const char *path = path_strings[id];
+    struct stat st;
+    char *target;
+    ssize_t len;
+    unsigned int target_id;
+
+    /* Links in /proc are relative to the process reading them, which is the
+     * tracer and not the tracee */
+    if(strncmp(path, "/proc/", 6) == 0)
+        return id;
+    if(lstat(path, &st) != 0 || !S_ISLNK(st.st_mode))
+        return id;
+    if(depth >= PATH_RESOLVE_MAX_LINKS)
+    {
+        log_warn(0, "too many levels of symbolic links resolving %s", path);
+        return id;
+    }
+
+    target = malloc(st.st_size + 1);
+    len = readlink(path, target, st.st_size + 1);
+    if(len < 0 || len > st.st_size)
+    {
+        /* Changed while we were looking */
+        free(target);
+        return id;
+    }
+    if(len > 0 && target[0] == '/')
+        target_id = path_intern_len(target, len);
+    else
+        target_id = resolve_join(path_strings[dir], target, len);
+    free(target);
+
+    resolve_add_links(&id, 1);
+    return path_resolve_rec(target_id, depth + 1);
+}
+
+static unsigned int path_resolve_rec(unsigned int id, unsigned int depth)
+{
+    const char *path;
+    const char *name;
+    size_t start = resolve_nb_links;
+    unsigned int canonical;
+    struct PathResolution *res;
+
+    if(id < path_resolutions_size && path_resolutions[id].canonical != 0)
+    {
+        res = &path_resolutions[id];
+        resolve_add_links(res->links, res->nb_links);
+        return res->canonical;
+    }
+
+    path = path_strings[id];
+    name = strrchr(path, '/');
+    if(name == NULL || (name == path && name[1] == '\0'))
+        /* Root, or not an absolute path */
+        canonical = id;
+    else
+    {
+        unsigned int parent = path_intern_len(path,
+                                              (name == path)?1:name - path);
+        unsigned int dir = path_resolve_rec(parent, depth);
+        ++name;
+        if(name[0] == '\0' || strcmp(name, ".") == 0)
+            canonical = dir;
+        else if(strcmp(name, "..") == 0)
         {
-            buffer[pos] = '\0';
-            return buffer;
+            const char *dir_str = path_strings[dir];
+            const char *slash = strrchr(dir_str, '/');
+            if(slash == NULL || slash == dir_str)
+                canonical = path_intern_len("/", 1);
+            else
+                canonical = path_intern_len(dir_str, slash - dir_str);
         }
+        else if(dir != parent)
+            canonical = path_resolve_rec(
+                    resolve_join(path_strings[dir], name, strlen(name)),
+                    depth);
         else
+            canonical = path_resolve_last(id, dir, depth);
+    }
+
+    /* Memoizes the result */
+    if(id >= path_resolutions_size)
+    {
+        size_t new_size = path_resolutions_size?path_resolutions_size:1024;
+        while(new_size <= nb_paths)
+            new_size <<= 1;
+        path_resolutions = realloc(path_resolutions,
+                                   new_size * sizeof(*path_resolutions));
+        memset(path_resolutions + path_resolutions_size, 0,
+               (new_size - path_resolutions_size) * sizeof(*path_resolutions));
+        path_resolutions_size = new_size;
+    }
+    res = &path_resolutions[id];
+    res->canonical = canonical;
+    res->nb_links = resolve_nb_links - start;
+    if(res->nb_links > 0)
+    {
+        res->links = malloc(res->nb_links * sizeof(*res->links));
+        memcpy(res->links, resolve_links + start,
+               res->nb_links * sizeof(*res->links));
+    }
+    return canonical;
+}
+
+unsigned int path_resolve(unsigned int id, const unsigned int **links,
+                          size_t *nb_links)
+{
+    unsigned int canonical;
+    resolve_nb_links = 0;
+    canonical = path_resolve_rec(id, 0);
+    *links = resolve_links;
+    *nb_links = resolve_nb_links;
+    return canonical;
+}
+
+void path_resolve_invalidate(unsigned int id)
+{
+    size_t i;
+    /* Removing a path that resolved to itself doesn't change the resolution
+     * of other paths */
+    if(id != 0 && id < path_resolutions_size
+     && path_resolutions[id].canonical == id)
+        return;
+    ++path_resolve_generation;
+    for(i = 0; i < path_resolutions_size; ++i)
+    {
+        free(path_resolutions[i].links);
+        path_resolutions[i].links = NULL;
+        path_resolutions[i].nb_links = 0;
+        path_resolutions[i].canonical = 0;
+    }
+}
+
+static void path_resolve_free(void)
+{
+    path_resolve_invalidate(0);
+    free(path_resolutions);
+    path_resolutions = NULL;
+    path_resolutions_size = 0;
+    free(resolve_links);
+    resolve_links = NULL;
+    resolve_nb_links = resolve_links_size = 0;
+    free(resolve_buffer);
+    resolve_buffer = NULL;
+    resolve_buffer_size = 0;
+}
+
+
+/* ********************
+ * Excluded paths: prefixes whose accesses are not recorded, in a trie of
+ * path components. The result is memoized for every interned path, so each
+ * distinct path only gets looked up once.
+ */
+
+struct PathTrieNode {
+    char *name;                     /* component, NULL for the root */
+    size_t name_len;
+    int excluded;                   /* a prefix ends here */
+    struct PathTrieNode *children;
+    struct PathTrieNode *next;      /* next sibling */
+};
+
+static struct PathTrieNode *path_exclusions = NULL;
+
+/* Indexed by path id: 0 if not looked up yet, 1 if kept, 2 if excluded */
+static unsigned char *path_excluded_memo = NULL;
+static size_t path_excluded_memo_size = 0;
+
+unsigned long path_excluded_count = 0;
+
+static struct PathTrieNode *path_trie_child(struct PathTrieNode *node,
+                                            const char *name, size_t len)
+{
+    struct PathTrieNode *child;
+    for(child = node->children; child != NULL; child = child->next)
+        if(child->name_len == len && strncmp(child->name, name, len) == 0)
+            return child;
+    return NULL;
+}
+
+void path_exclude(const char *prefix)
+{
+    struct PathTrieNode *node;
+    if(path_exclusions == NULL)
+        path_exclusions = calloc(1, sizeof(*path_exclusions));
+    node = path_exclusions;
+    while(*prefix)
+    {
+        size_t len;
+        struct PathTrieNode *child;
+        while(*prefix == '/')
+            ++prefix;
+        if(!*prefix)
+            break;
+        for(len = 0; prefix[len] && prefix[len] != '/'; ++len)
+            ;
+        child = path_trie_child(node, prefix, len);
+        if(child == NULL)
         {
-            if(pos + 1 >= *size)
-            {
-                *size <<= 2;
-                buffer = realloc(buffer, *size);
-            }
-            buffer[pos++] = c;
+            child = calloc(1, sizeof(*child));
+            child->name = malloc(len);
+            memcpy(child->name, prefix, len);
+            child->name_len = len;
+            child->next = node->children;
+            node->children = child;
         }
+        node = child;
+        prefix += len;
     }
+    node->excluded = 1;
+    path_exclusions_forget();
 }
 
-int path_is_dir(const char *pathname)
+static void path_trie_free(struct PathTrieNode *node)
+{
+    while(node != NULL)
+    {
+        struct PathTrieNode *next = node->next;
+        path_trie_free(node->children);
+        free(node->name);
+        free(node);
+        node = next;
+    }
+}
+
+void path_exclude_clear(void)
+{
+    path_trie_free(path_exclusions);
+    path_exclusions = NULL;
+    path_exclusions_forget();
+}
+
+static void path_exclusions_forget(void)
+{
+    free(path_excluded_memo);
+    path_excluded_memo = NULL;
+    path_excluded_memo_size = 0;
+}
+
+int path_excluded(unsigned int id)
+{
+    struct PathTrieNode *node = path_exclusions;
+    const char *path;
+    int excluded = 0;
+    if(node == NULL)
+        return 0;
+    if(id < path_excluded_memo_size && path_excluded_memo[id] != 0)
+        return path_excluded_memo[id] - 1;
+
+    path = path_strings[id];
+    while(!node->excluded)
+    {
+        size_t len;
+        while(*path == '/')
+            ++path;
+        if(!*path)
+            break;
+        for(len = 0; path[len] && path[len] != '/'; ++len)
+            ;
+        node = path_trie_child(node, path, len);
+        if(node == NULL)
+            break;
+        path += len;
+    }
+    excluded = node != NULL && node->excluded;
+
+    if(id >= path_excluded_memo_size)
+    {
+        size_t new_size = path_excluded_memo_size?path_excluded_memo_size:1024;
+        while(new_size <= id)
+            new_size <<= 1;
+        path_excluded_memo = realloc(path_excluded_memo, new_size);
+        memset(path_excluded_memo + path_excluded_memo_size, 0,
+               new_size - path_excluded_memo_size);
+        path_excluded_memo_size = new_size;
+    }
+    path_excluded_memo[id] = excluded + 1;
+    if(excluded)
+        ++path_excluded_count;
+    return excluded;
+}
+
+
+unsigned long long monotonic_ns(void)
+{
+    struct timespec now;
+    if(clock_gettime(CLOCK_MONOTONIC, &now) == -1)
+        return 0; /* LCOV_EXCL_LINE : clock_gettime() is unlikely to fail */
+    return (unsigned long long)now.tv_sec * 1000000000 + now.tv_nsec;
+}
+
+/* Cache of path types, so that files accessed over and over again by the
+ * experiment don't get lstat()'d every time. Only successful lookups are
+ * cached, indexed by path id; entries are dropped by path_cache_invalidate()
+ * when the tracer sees a syscall that might change what a path points to. */
+
+#define PATH_TYPE_UNKNOWN       0
+#define PATH_TYPE_OTHER         1
+#define PATH_TYPE_DIR           2
+#define PATH_TYPE_LINK          3
+
+static unsigned char *path_types = NULL;
+static size_t path_types_size = 0;
+static size_t path_cache_count = 0;
+static unsigned long path_cache_hits = 0;
+static unsigned long path_cache_misses = 0;
+
+static void path_cache_clear(void)
+{
+    if(path_types_size > 0)
+        memset(path_types, PATH_TYPE_UNKNOWN, path_types_size);
+    path_cache_count = 0;
+}
+
+void path_cache_invalidate(unsigned int id)
+{
+    const char *pathname;
+    size_t len, i;
+    unsigned char type;
+    if(path_cache_count == 0)
+        return;
+    if(id == 0)
+    {
+        path_cache_clear();
+        return;
+    }
+    type = PATH_TYPE_UNKNOWN;
+    if(id < path_types_size && path_types[id] != PATH_TYPE_UNKNOWN)
+    {
+        type = path_types[id];
+        path_types[id] = PATH_TYPE_UNKNOWN;
+        --path_cache_count;
+    }
+    /* Nothing can have been cached under a file: lstat() would have failed
+     * with ENOTDIR */
+    if(type == PATH_TYPE_OTHER)
+        return;
+    /* A link that got removed or replaced might have been traversed to get
+     * to cached paths under it, evict them too */
+    pathname = path_strings[id];
+    len = strlen(pathname);
+    if(len <= 1)
+    {
+        path_cache_clear();
+        return;
+    }
+    for(i = 1; i < path_types_size && path_cache_count > 0; ++i)
+    {
+        if(path_types[i] != PATH_TYPE_UNKNOWN
+         && strncmp(path_strings[i], pathname, len) == 0
+         && path_strings[i][len] == '/')
+        {
+            path_types[i] = PATH_TYPE_UNKNOWN;
+            --path_cache_count;
+        }
+    }
+}
+
+void path_cache_free(void)
+{
+    if(trace_verbosity >= 2 && path_cache_hits + path_cache_misses > 0)
+        log_info(0, "path type cache: %lu hits, %lu misses (%.1f%% hit rate)",
+                 path_cache_hits, path_cache_misses,
+                 100.0 * path_cache_hits /
+                 (path_cache_hits + path_cache_misses));
+    free(path_types);
+    path_types = NULL;
+    path_types_size = 0;
+    path_cache_count = 0;
+    path_cache_hits = 0;
+    path_cache_misses = 0;
+}
+
+int path_is_dir(unsigned int id)
 {
     struct stat buf;
+    const char *pathname = path_strings[id];
+    unsigned char type;
+    if(id < path_types_size && path_types[id] != PATH_TYPE_UNKNOWN)
+    {
+        ++path_cache_hits;
+        return path_types[id] == PATH_TYPE_DIR;
+    }
+    ++path_cache_misses;
     if(lstat(pathname, &buf) != 0)
     {
         if(trace_verbosity >= 1)
@@ -152,5 +774,27 @@ int path_is_dir(const char *pathname)
         }
         return 0;
     }
-    return S_ISDIR(buf.st_mode)?1:0;
+    if(S_ISDIR(buf.st_mode))
+        type = PATH_TYPE_DIR;
+    else if(S_ISLNK(buf.st_mode))
+        type = PATH_TYPE_LINK;
+    else
+        type = PATH_TYPE_OTHER;
+    if(id >= path_types_size)
+    {
+        size_t new_size = path_types_size?path_types_size:1024;
+        unsigned char *new_types;
+        while(new_size <= id)
+            new_size <<= 1;
+        new_types = realloc(path_types, new_size);
+        if(new_types == NULL)
+            return type == PATH_TYPE_DIR; /* LCOV_EXCL_LINE */
+        memset(new_types + path_types_size, PATH_TYPE_UNKNOWN,
+               new_size - path_types_size);
+        path_types = new_types;
+        path_types_size = new_size;
+    }
+    path_types[id] = type;
+    ++path_cache_count;
+    return type == PATH_TYPE_DIR;
 }
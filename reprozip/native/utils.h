@@ -11,12 +11,53 @@
 
 unsigned int flags2mode(int flags);
 
-char *abspath(const char *wd, const char *path);
-
 char *get_wd(void);
 
-char *read_line(char *buffer, size_t *size, FILE *fp);
-
-int path_is_dir(const char *pathname);
+/* Reads a whole file into a NUL-terminated buffer that the caller must
+ * free(); returns NULL on error */
+char *read_file(const char *filename, size_t *size);
+
+size_t hash_str(const char *str);
+
+/* Paths are interned for the whole trace: each distinct path is stored once
+ * and identified by a non-zero id. path_string() must only be called from the
+ * tracing thread, but the strings it returns stay valid for every thread
+ * until path_intern_free() */
+unsigned int path_intern(const char *path);
+/* Interns path, made absolute using working directory wd (an id) */
+unsigned int path_intern_abs(unsigned int wd, const char *path);
+const char *path_string(unsigned int id);
+void path_intern_free(void);
+
+/* Gets the canonical path of an interned path, resolving symbolic links as
+ * they are now; links is set to the links that were traversed (valid until
+ * the next call). Results are memoized until path_resolve_invalidate() is
+ * called with a path that was removed, or 0 if links might have changed */
+unsigned int path_resolve(unsigned int id, const unsigned int **links,
+                          size_t *nb_links);
+void path_resolve_invalidate(unsigned int id);
+/* Incremented every time path_resolve_invalidate() drops resolutions */
+extern unsigned int path_resolve_generation;
+
+/* Accesses to paths under an excluded prefix (or the prefix itself) are not
+ * recorded; path_excluded() is memoized for every interned path.
+ * path_excluded_count is the number of distinct paths that were excluded */
+void path_exclude(const char *prefix);
+void path_exclude_clear(void);
+int path_excluded(unsigned int id);
+extern unsigned long path_excluded_count;
+
+/* Monotonic clock, in nanoseconds */
+unsigned long long monotonic_ns(void);
+
+/* Returns 1 if the interned path is a directory; results are cached until
+ * path_cache_invalidate() is called with that path, a parent, or 0 */
+int path_is_dir(unsigned int id);
+
+/* Forgets the type of a path and of the paths under it; 0 flushes the cache */
+void path_cache_invalidate(unsigned int id);
+
+/* Logs the cache hit rate (verbosity 2) and empties it */
+void path_cache_free(void);
 
 #endif
@@ -31,7 +31,8 @@ import sys
 import usagestats
 import yaml
 
-from .utils import CommonEqualityMixin, escape, hsize, unicode_
+from .utils import CommonEqualityMixin, LinkResolver, escape, \
+    find_all_links, hsize, unicode_
 
 
 FILE_READ = 0x01
@@ -42,24 +43,39 @@ FILE_STAT = 0x08
 
 class File(CommonEqualityMixin):
     """A file, used at some point during the experiment.
+
+    There is one of these for every file in a trace, so they only keep the raw
+    path; `path` builds a new `Path` of the original class on each access.
     """
-    comment = None
+    __slots__ = ('_path', '_path_class', 'size', 'comment')
 
     def __init__(self, path, size=None):
         self.path = path
         self.size = size
+        self.comment = None
+
+    @property
+    def path(self):
+        return self._path_class(self._path)
+
+    @path.setter
+    def path(self, path):
+        self._path_class = type(path)
+        self._path = path.path
 
     def __eq__(self, other):
         return (isinstance(other, File) and
-                self.path == other.path)
+                self._path == other._path)
 
     def __hash__(self):
-        return hash(self.path)
+        return hash(self._path)
 
 
 class Package(CommonEqualityMixin):
     """A distribution package, containing a set of files.
     """
+    __slots__ = ('name', 'version', 'files', 'packfiles', 'size')
+
     def __init__(self, name, version, files=None, packfiles=True, size=None):
         self.name = name
         self.version = version
@@ -112,6 +128,12 @@ def read_packages(packages, File=File, Package=Package):
 # 0.4.1: no change
 # 0.5: no change
 # 0.6: no change
+# 0.7:
+#     trace database: schema version 2 (PRAGMA user_version); adds paths,
+#       arguments, environments and runs tables, file_accesses and executions
+#       reference them; opened_files and executed_files become views
+#     trace database: schema version 3; adds processes.user_time,
+#       system_time, max_rss, io_read and io_written
 
 
 def load_config(filename, canonical, File=File, Package=Package):
@@ -270,6 +292,105 @@ other_files:
 """)
 
 
+class TracePaths(object):
+    """Reads paths from a trace database, making each one a `Path` only once.
+
+    Databases from reprozip 0.7 (`version` 2) store each path once in the
+    ``paths`` table, referenced by id from the ``file_accesses`` and
+    ``executions`` tables (the latter also referencing the ``arguments`` and
+    ``environments`` tables), and have a ``run_id`` column; older ones
+    (`version` 1) have everything inline in ``opened_files`` and
+    ``executed_files`` (which newer databases still provide as views).
+
+    Queries should select `column` from `opened_files` or `executed_files`,
+    and look up the value they get with `path()`, `resolve()` or `links()`.
+    The tracer records the canonical path and the symbolic links traversed
+    to get there; for paths without that information, they are found from
+    the filesystem now, through `resolver` (a `LinkResolver`, which can be
+    shared to avoid looking at the same directories again). `Path` is the
+    class used for paths; that requires a concrete one.
+    """
+    def __init__(self, conn, Path=PosixPath, resolver=None):
+        self._path_class = Path
+        if resolver is None:
+            resolver = LinkResolver()
+        self.resolver = resolver
+        cur = conn.cursor()
+        self.version, = cur.execute('PRAGMA user_version;').fetchone()
+        if self.version == 0:
+            self.version = 1
+        if self.version >= 2:
+            self.opened_files = 'file_accesses'
+            self.executed_files = '''(
+                SELECT e.id AS id, e.path AS path,
+                    e.timestamp AS timestamp, e.process AS process,
+                    a.argv AS argv, v.envp AS envp,
+                    e.workingdir AS workingdir, e.run_id AS run_id
+                FROM executions e
+                JOIN arguments a ON a.id=e.argv
+                JOIN environments v ON v.id=e.envp
+                )'''
+            self.column = 'path'
+            self._paths = {}
+            self._canonical = {}
+            rows = cur.execute(
+                    '''
+                    SELECT id, path, canonical
+                    FROM paths;
+                    ''')
+            for r_id, r_path, r_canonical in rows:
+                self._paths[r_id] = Path(r_path)
+                if r_canonical is not None:
+                    self._canonical[r_id] = r_canonical
+            self._links = {}
+            rows = cur.execute(
+                    '''
+                    SELECT path, link
+                    FROM path_links;
+                    ''')
+            for r_path, r_link in rows:
+                self._links.setdefault(r_path, []).append(r_link)
+        else:
+            self.opened_files = 'opened_files'
+            self.executed_files = 'executed_files'
+            self.column = 'name'
+            self._paths = {}
+            self._canonical = {}
+            self._links = {}
+        cur.close()
+        self._resolved = {}
+
+    def path(self, key):
+        """Gets the path for an id (or a name, in old databases).
+        """
+        try:
+            return self._paths[key]
+        except KeyError:
+            path = self._paths[key] = self._path_class(key)
+            return path
+
+    def resolve(self, key):
+        """Gets the path for an id or name with symbolic links resolved.
+        """
+        try:
+            return self._resolved[key]
+        except KeyError:
+            if key in self._canonical:
+                path = self.path(self._canonical[key])
+            else:
+                path = self.resolver.resolve(self.path(key))
+            self._resolved[key] = path
+            return path
+
+    def links(self, key):
+        """Gets the symbolic links traversed by the path for an id or name.
+        """
+        if key in self._canonical:
+            return [self.path(link) for link in self._links.get(key, ())]
+        else:
+            return find_all_links(self.path(key), False, self.resolver)
+
+
 class LoggingDateFormatter(logging.Formatter):
     """Formatter that puts milliseconds in the timestamp.
     """
@@ -28,6 +28,7 @@ from reprozip.common import setup_logging, \
     setup_usage_report, enable_usage_report, \
     submit_usage_report, record_usage
 import reprozip.pack
+from reprozip.tracer.linux_pkgs import magic_dirs
 import reprozip.tracer.trace
 from reprozip.utils import PY3, unicode_
 
@@ -73,7 +74,9 @@ def print_db(database):
             f_parent = "{0: 7d} ".format(r_parent)
         else:
             f_parent = "        "
-        if r_exit & 0x0100:
+        if r_exit is None:
+            f_exit = "       "
+        elif r_exit & 0x0100:
             f_exit = " sig{0: <2d} ".format(r_exit)
         else:
             f_exit = "    {0: <2d} ".format(r_exit)
@@ -113,7 +116,7 @@ def print_db(database):
     cur = conn.cursor()
     processes = cur.execute(
             '''
-            SELECT id, name, timestamp, mode, process
+            SELECT id, name, timestamp, mode, process, occurrences
             FROM opened_files;
             ''')
     print("\nFiles:")
@@ -123,19 +126,79 @@ def print_db(database):
     print("|   id   |     timestamp    | process | mode | name                "
           "           |")
     print(header)
-    for r_id, r_name, r_timestamp, r_mode, r_process in processes:
+    for (r_id, r_name, r_timestamp, r_mode, r_process,
+            r_occurrences) in processes:
         f_id = "{0: 7d} ".format(r_id)
         f_timestamp = "{0: 17d} ".format(r_timestamp)
         f_proc = "{0: 8d} ".format(r_process)
         f_mode = "{0: 5d} ".format(r_mode)
+        if r_occurrences > 1:
+            r_name = "%s (x%d)" % (r_name, r_occurrences)
         f_name = " {0: <30s} ".format(r_name)
         print('|'.join(('', f_id, f_timestamp, f_proc, f_mode, f_name, '')))
         print(header)
     cur.close()
 
+    print_hottest_processes(conn)
+
     conn.close()
 
 
+def print_hottest_processes(conn, limit=5):
+    """Prints the processes that used the most CPU time.
+
+    Processes are shown with the last program they executed, or if they
+    didn't, the program their closest ancestor was running when it forked.
+    """
+    processes = {}
+    executions = {}
+    for r_id, r_parent, r_timestamp in conn.execute(
+            'SELECT id, parent, timestamp FROM processes;'):
+        processes[r_id] = r_parent, r_timestamp
+    for r_process, r_name, r_timestamp in conn.execute(
+            'SELECT process, name, timestamp FROM executed_files '
+            'ORDER BY id;'):
+        executions.setdefault(r_process, []).append((r_timestamp, r_name))
+
+    def program(process):
+        timestamp = None
+        while process is not None:
+            for r_timestamp, r_name in reversed(executions.get(process, [])):
+                if timestamp is None or r_timestamp <= timestamp:
+                    return r_name
+            process, timestamp = processes[process]
+        return ''
+
+    hottest = conn.execute(
+            '''
+            SELECT id, user_time, system_time, max_rss, io_read, io_written
+            FROM processes
+            WHERE user_time NOT NULL
+            ORDER BY user_time + system_time DESC
+            LIMIT ?;
+            ''',
+            (limit,))
+    print("\nHottest processes:")
+    header = ("+--------+---------+---------+---------+---------+---------+---"
+              "-------------------+")
+    print(header)
+    print("|   id   | user(s) |  sys(s) | rss(MB) | read(MB)| wrtn(MB)| pro"
+          "gram              |")
+    print(header)
+    for (r_id, r_user, r_system, r_rss, r_read,
+            r_written) in hottest:
+        f_id = "{0: 7d} ".format(r_id)
+        f_user = "{0: 8.2f} ".format(r_user / 1.0e6)
+        f_system = "{0: 8.2f} ".format(r_system / 1.0e6)
+        f_rss = "{0: 8.1f} ".format(r_rss / 1024.0)
+        f_read = "{0: 8.1f} ".format(r_read / 1048576.0)
+        f_written = "{0: 8.1f} ".format(r_written / 1048576.0)
+        f_program = " {0: <20s} ".format(program(r_id))
+        print('|'.join(('', f_id, f_user, f_system, f_rss, f_read,
+                        f_written, f_program, '')))
+        print(header)
+
+
 def testrun(args):
     """testrun subcommand.
 
@@ -151,10 +214,16 @@ def testrun(args):
             argv = [args.arg0] + args.cmdline[1:]
         else:
             argv = args.cmdline
+        exclude = [Path(e).absolute().path
+                   for e in list(magic_dirs) + args.exclude]
         logging.debug("Starting tracer, binary=%r, argv=%r",
                       args.cmdline[0], argv)
         c = _pytracer.execute(args.cmdline[0], argv, database.path,
-                              args.verbosity)
+                              args.verbosity,
+                              seccomp=args.seccomp,
+                              dedup=args.dedup,
+                              profile=args.profile,
+                              exclude=exclude)
         print("\n\n-----------------------------------------------------------"
               "--------------------")
         print_db(database)
@@ -173,15 +242,33 @@ def trace(args):
 
     Simply calls reprozip.tracer.trace() with the arguments from argparse.
     """
-    if args.arg0 is not None:
-        argv = [args.arg0] + args.cmdline[1:]
+    if args.attach is not None:
+        if args.cmdline:
+            logging.critical("Can't both attach to a process and run a "
+                             "command-line")
+            sys.exit(1)
+        binary = argv = None
+    elif not args.cmdline:
+        logging.critical("Missing command-line")
+        sys.exit(1)
     else:
-        argv = args.cmdline
-    reprozip.tracer.trace.trace(args.cmdline[0],
+        binary = args.cmdline[0]
+        if args.arg0 is not None:
+            argv = [args.arg0] + args.cmdline[1:]
+        else:
+            argv = args.cmdline
+    reprozip.tracer.trace.trace(binary,
                                 argv,
                                 Path(args.dir),
                                 args.append,
-                                args.verbosity)
+                                args.verbosity,
+                                seccomp=args.seccomp,
+                                eventlog=args.eventlog,
+                                dedup=args.dedup,
+                                profile=args.profile,
+                                exclude=args.exclude,
+                                attach=args.attach,
+                                duration=args.duration)
     reprozip.tracer.trace.write_configuration(Path(args.dir),
                                               args.identify_packages,
                                               overwrite=False)
@@ -259,6 +346,31 @@ def main():
             dest='identify_packages',
             help="do not try identify which package each file comes from")
 
+    # Options for the commands that run the tracer
+    tracer_options = argparse.ArgumentParser(add_help=False)
+    tracer_options.add_argument(
+            '--seccomp', action='store_true', default=False,
+            help="only stop the program on the system calls the tracer "
+            "handles, using a seccomp filter (requires Linux 4.8); only "
+            "faster if most system calls are not handled, such as read() "
+            "and write()")
+    tracer_options.add_argument(
+            '--dedup', action='store_true', default=False,
+            help="record repeated accesses of a process to the same file "
+            "only once, with a count")
+    tracer_options.add_argument(
+            '--profile', choices=['full', 'files-only', 'exec-only'],
+            default='full',
+            help="which system calls to record: 'files-only' ignores "
+            "stat(), access(), readlink() and network connections, "
+            "'exec-only' only records executions and changes to the "
+            "filesystem (mkdir(), symlink(), ...) (default: full)")
+    tracer_options.add_argument(
+            '--exclude', action='append', default=[], metavar='DIR',
+            help="don't record accesses to files under this directory, "
+            "for instance scratch space (/dev, /proc and /sys are always "
+            "excluded); can be repeated")
+
     parser = argparse.ArgumentParser(
             description="reprozip is the ReproZip component responsible for "
                         "tracing and packing the execution of an experiment",
@@ -277,7 +389,7 @@ def main():
 
     # trace command
     parser_trace = subparsers.add_parser(
-            'trace', parents=[options],
+            'trace', parents=[options, tracer_options],
             help="Runs the program and writes out database and configuration "
             "file")
     parser_trace.add_argument(
@@ -287,13 +399,26 @@ def main():
     parser_trace.add_argument(
             '-c', '--continue', action='store_true', dest='append',
             help="add to the previous run instead of replacing it")
+    parser_trace.add_argument(
+            '--no-event-log', action='store_false', default=True,
+            dest='eventlog',
+            help="insert events in the database while tracing, instead of "
+            "writing a binary log and loading it afterwards")
+    parser_trace.add_argument(
+            '--attach', type=int, metavar='PID',
+            help="trace this running process and its descendants instead of "
+            "running a command-line, until they exit or reprozip is "
+            "interrupted, then leave them running")
+    parser_trace.add_argument(
+            '--duration', type=int, default=0, metavar='SECONDS',
+            help="with --attach, stop tracing after this many seconds")
     parser_trace.add_argument('cmdline', nargs=argparse.REMAINDER,
                               help="command-line to run under trace")
     parser_trace.set_defaults(func=trace)
 
     # testrun command
     parser_testrun = subparsers.add_parser(
-            'testrun', parents=[options],
+            'testrun', parents=[options, tracer_options],
             help="Runs the program and writes out the database contents")
     parser_testrun.add_argument(
             '-a',
@@ -319,8 +444,11 @@ def main():
     args = parser.parse_args()
     setup_logging('REPROZIP', args.verbosity)
     setup_usage_report('reprozip', reprozip_version)
-    if 'cmdline' in args and not args.cmdline:
+    attach = getattr(args, 'attach', None)
+    if 'cmdline' in args and not args.cmdline and attach is None:
         parser.error("missing command-line")
+    if getattr(args, 'duration', 0) and attach is None:
+        parser.error("--duration can only be used with --attach")
     record_usage(command=args.selected_command)
     try:
         args.func(args)
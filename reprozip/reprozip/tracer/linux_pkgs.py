@@ -24,6 +24,55 @@ from reprozip.utils import listvalues
 
 magic_dirs = ('/dev', '/proc', '/sys')
 system_dirs = ('/bin', '/etc', '/lib', '/sbin', '/usr', '/var')
+local_dirs = ('/usr/local',)
+
+
+PATH_USER = 0
+PATH_LOCAL = 1
+PATH_SYSTEM = 2
+PATH_MAGIC = 3
+
+
+class PathClassifier(object):
+    """Sorts paths between magic, system, local and user directories.
+
+    The directories are compiled into a trie of path components, so a path is
+    classified by looking at its first few components only; the deepest
+    directory that matches wins, so that ``/usr/local`` is local and not
+    system. Paths are `Path` objects or raw bytes, and should be canonical.
+    """
+    def __init__(self, magic=magic_dirs, system=system_dirs,
+                 local=local_dirs):
+        self._trie = {}
+        self._depth = 0
+        for kind, dirs in ((PATH_MAGIC, magic),
+                           (PATH_SYSTEM, system),
+                           (PATH_LOCAL, local)):
+            for directory in dirs:
+                components = Path(directory).path.split(b'/')[1:]
+                node = self._trie
+                for component in components:
+                    node = node.setdefault(component, {})
+                node[None] = kind
+                self._depth = max(self._depth, len(components))
+
+    def classify(self, path):
+        """Returns one of `PATH_MAGIC`, `PATH_SYSTEM`, `PATH_LOCAL` or
+        `PATH_USER`.
+        """
+        if isinstance(path, Path):
+            path = path.path
+        kind = PATH_USER
+        node = self._trie
+        for component in path.split(b'/', self._depth + 1)[1:self._depth + 1]:
+            node = node.get(component)
+            if node is None:
+                break
+            kind = node.get(None, kind)
+        return kind
+
+
+classify_path = PathClassifier().classify
 
 
 class DpkgManager(object):
@@ -35,22 +84,24 @@ class DpkgManager(object):
         self.package_files = {}
 
     def search_for_file(self, f):
+        kind = classify_path(f._path)
+
         # Special files
-        if any(f.path.lies_under(c) for c in magic_dirs):
+        if kind == PATH_MAGIC:
             return
 
         # If it's not in a system directory, no need to look for it
-        if (f.path.lies_under('/usr/local') or
-                not any(f.path.lies_under(c) for c in system_dirs)):
+        if kind != PATH_SYSTEM:
             self.unknown_files.add(f)
             return
 
         # Looks in our cache
-        if f.path in self.package_files:
-            pkgname = self.package_files[f.path]
+        path = f.path
+        if path in self.package_files:
+            pkgname = self.package_files[path]
         else:
-            pkgname = self._get_package_for_file(f.path)
-            self.package_files[f.path] = pkgname
+            pkgname = self._get_package_for_file(path)
+            self.package_files[path] = pkgname
 
         # Stores the file
         if pkgname is None:
@@ -11,26 +11,64 @@ generation logic for the config YAML file.
 
 from __future__ import unicode_literals
 
-import heapq
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import platform
 from rpaths import Path
 import sqlite3
+import stat
 
 from reprozip import __version__ as reprozip_version
 from reprozip import _pytracer
-from reprozip.common import File, load_config, save_config, \
+from reprozip.common import File, TracePaths, load_config, save_config, \
     FILE_READ, FILE_WRITE, FILE_WDIR
 from reprozip.orderedset import OrderedSet
-from reprozip.tracer.linux_pkgs import magic_dirs, system_dirs, \
-    identify_packages
+from reprozip.tracer.linux_pkgs import magic_dirs, PATH_USER, PATH_SYSTEM, \
+    PATH_MAGIC, classify_path, identify_packages
 from reprozip.utils import PY3, izip, itervalues, listvalues, unicode_, \
-    hsize, find_all_links
+    hsize, find_all_links, LinkResolver
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def stat_files(paths, threads=16):
+    """Calls ``lstat()`` on each path, from a pool of threads.
+
+    On network filesystems, each call waits for a round-trip to the server, so
+    this is where generating the configuration spends its time if done one
+    file at a time. Returns a dict mapping each raw path (bytes) to its
+    :class:`os.stat_result`, or None if it doesn't exist; pass it to
+    `TracedFile` and :func:`is_regular_file` instead of looking again.
+    """
+    paths = list(set(p.path if isinstance(p, Path) else p for p in paths))
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(_lstat, paths)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(izip(paths, results))
+
+
+def is_regular_file(path, stats):
+    """Checks whether a raw path is a regular file, from :func:`stat_files`.
+    """
+    st = stats.get(path)
+    return st is not None and stat.S_ISREG(st.st_mode)
 
 
 class TracedFile(File):
     """Override of `~reprozip.common.File` that reads stats from filesystem.
+
+    `stats` is the result of :func:`stat_files` for a batch of paths; if the
+    path is not in there, it gets looked at now.
     """
     #                               read
     #                              +------+
@@ -48,20 +86,27 @@ class TracedFile(File):
     ONLY_READ = 1
     WRITTEN = 2
 
-    what = None
+    __slots__ = ('what',)
 
-    def __init__(self, path):
+    def __init__(self, path, stats=None):
         path = Path(path)
-        size = None
-        if path.exists():
-            if path.is_link():
-                self.comment = "Link to %s" % path.read_link(absolute=True)
-            elif path.is_dir():
-                self.comment = "Directory"
+        if stats is not None and path.path in stats:
+            st = stats[path.path]
+        else:
+            st = _lstat(path.path)
+        size = comment = None
+        if st is not None:
+            if stat.S_ISLNK(st.st_mode):
+                if path.exists():
+                    comment = "Link to %s" % path.read_link(absolute=True)
+            elif stat.S_ISDIR(st.st_mode):
+                comment = "Directory"
             else:
-                size = path.size()
-                self.comment = hsize(size)
+                size = st.st_size
+                comment = hsize(size)
         File.__init__(self, path, size)
+        self.comment = comment
+        self.what = None
 
     def read(self):
         if self.what is None:
@@ -74,119 +119,162 @@ class TracedFile(File):
             self.what = TracedFile.READ_THEN_WRITTEN
 
 
-def get_files(conn):
+def get_files(conn, resolver=None):
     """Find all the files used by the experiment by reading the trace.
+
+    `resolver` is the `~reprozip.utils.LinkResolver` used for paths the tracer
+    didn't resolve itself.
+
+    The accesses are aggregated by the database, so that this only sees each
+    path once per run, with the time it was first used, read, written and
+    executed.
     """
-    files = {}
-    access_files = [set()]
+    paths = TracePaths(conn, Path, resolver)
 
-    # Finds run timestamps, so we can sort input/output files by run
+    # Finds runs, so we can sort input/output files by run
     proc_cursor = conn.cursor()
-    executions = proc_cursor.execute(
-            '''
-            SELECT timestamp
-            FROM processes
-            WHERE parent ISNULL
-            ORDER BY id;
-            ''')
-    run_timestamps = [r_timestamp for r_timestamp, in executions][1:]
+    if paths.version >= 2:
+        runs = proc_cursor.execute(
+                '''
+                SELECT id
+                FROM runs
+                ORDER BY id;
+                ''')
+        run_index = dict((r_id, i) for i, (r_id,) in enumerate(runs))
+        access_files = [set() for _ in run_index]
+        run_column = 'a.run_id'
+    else:
+        # Older databases don't have runs, use the timestamps of the
+        # top-level processes
+        run_index = None
+        access_files = [set()]
+        run_column = '''(
+                SELECT COUNT(*)
+                FROM processes p
+                WHERE p.parent ISNULL AND p.timestamp < a.timestamp AND
+                    p.id > (SELECT MIN(id) FROM processes WHERE parent ISNULL)
+                )'''
     proc_cursor.close()
 
     # Adds dynamic linkers
+    linkers = set()
     for libdir in (Path('/lib'), Path('/lib64')):
         if libdir.exists():
             for linker in libdir.listdir('*ld-linux*'):
-                for filename in find_all_links(linker, True):
-                    if filename not in files:
-                        f = TracedFile(filename)
-                        f.read()
-                        files[f.path] = f
-
-    # Adds executed files
-    exec_cursor = conn.cursor()
-    executed_files = exec_cursor.execute(
-            '''
-            SELECT name, timestamp
-            FROM executed_files
-            ORDER BY timestamp;
-            ''')
-    executed = set()
-    # ... and opened files
-    open_cursor = conn.cursor()
-    opened_files = open_cursor.execute(
-            '''
-            SELECT name, mode, timestamp
-            FROM opened_files
-            ORDER BY timestamp;
-            ''')
-    # Loop on both lists at once
-    rows = heapq.merge(((r[1], 'exec', r) for r in executed_files),
-                       ((r[2], 'open', r) for r in opened_files))
-    for ts, event_type, data in rows:
-        if event_type == 'exec':
-            r_name, r_timestamp = data
-            r_mode = FILE_READ
-        else:  # event_type == 'open'
-            r_name, r_mode, r_timestamp = data
-        r_name = Path(r_name)
-
-        if event_type == 'exec':
-            executed.add(r_name)
-
-        # Stays on the current run
-        while run_timestamps and r_timestamp > run_timestamps[0]:
-            del run_timestamps[0]
-            access_files.append(set())
+                linkers.update(find_all_links(linker, True, paths.resolver))
 
-        # Adds symbolic links as read files
-        for filename in find_all_links(r_name, False):
-            if filename not in files:
-                f = TracedFile(filename)
-                f.read()
-                files[f.path] = f
-        # Adds final target
-        r_name = r_name.resolve()
-        if r_name not in files:
-            f = TracedFile(r_name)
-            files[f.path] = f
+    # Gets executed and opened files, once per path and per run
+    access_cursor = conn.cursor()
+    accessed_files = access_cursor.execute(
+            '''
+            SELECT path, run, MIN(timestamp),
+                MIN(CASE WHEN mode & ? AND NOT mode & ? THEN timestamp END),
+                MIN(CASE WHEN mode & ? THEN timestamp END),
+                MIN(CASE WHEN executed THEN timestamp END)
+            FROM (
+                SELECT a.%(column)s AS path, a.timestamp AS timestamp,
+                    %(run)s AS run, ? AS mode, 1 AS executed
+                FROM %(executed_files)s a
+                UNION ALL
+                SELECT a.%(column)s, a.timestamp, %(run)s, a.mode, 0
+                FROM %(opened_files)s a
+            )
+            GROUP BY run, path;
+            ''' % {'column': paths.column, 'run': run_column,
+                   'executed_files': paths.executed_files,
+                   'opened_files': paths.opened_files},
+            (FILE_READ, FILE_WRITE, FILE_WRITE, FILE_READ))
+
+    def earliest(first, second):
+        if first is None:
+            return second
+        elif second is None:
+            return first
         else:
-            f = files[r_name]
-        if r_mode & FILE_WRITE:
-            f.write()
-        elif r_mode & FILE_READ:
+            return min(first, second)
+
+    # For each file, the first time it was used directly, read, written, and
+    # traversed as a symbolic link
+    accesses = {}
+    # For each path, the first time it was executed
+    executed = {}
+    # Run, file and time of first use for each path and run
+    run_accesses = []
+    for (r_path, r_run, r_timestamp, r_read, r_write,
+            r_exec) in accessed_files:
+        if run_index is not None:
+            r_run = run_index[r_run]
+
+        if r_exec is not None:
+            r_name = paths.path(r_path).path
+            executed[r_name] = earliest(executed.get(r_name), r_exec)
+
+        # Symbolic links are traversed every time the path is used
+        for filename in paths.links(r_path):
+            times = accesses.setdefault(filename, [None, None, None, None])
+            times[3] = earliest(times[3], r_timestamp)
+        # Adds final target
+        r_name = paths.resolve(r_path)
+        times = accesses.setdefault(r_name, [None, None, None, None])
+        times[0] = earliest(times[0], r_timestamp)
+        times[1] = earliest(times[1], r_read)
+        times[2] = earliest(times[2], r_write)
+
+        run_accesses.append((r_run, r_name.path, r_timestamp))
+    access_cursor.close()
+
+    # Gets the metadata of all the files at once
+    stats = stat_files(linkers.union(accesses))
+
+    files = {}
+    for path in linkers.union(accesses):
+        t_used, t_read, t_write, t_link = accesses.get(
+                path, (None, None, None, None))
+        f = TracedFile(path, stats)
+        # Dynamic linkers are read before anything else
+        if path in linkers:
+            f.read()
+        # Symbolic links count as read if they are seen as links first
+        if t_link is not None and (t_used is None or t_link <= t_used):
+            t_read = t_link
+        if t_read is not None and (t_write is None or t_read <= t_write):
             f.read()
+        if t_write is not None:
+            f.write()
+        files[f._path] = f
 
-        # Identifies input files
-        if r_name.is_file() and r_name not in executed:
-            access_files[-1].add(f)
-    exec_cursor.close()
-    open_cursor.close()
+    # Identifies input files: those used in a run before they got executed
+    for r_run, r_name, r_timestamp in run_accesses:
+        while r_run >= len(access_files):
+            access_files.append(set())
+        r_exec = executed.get(r_name)
+        if (is_regular_file(r_name, stats) and
+                (r_exec is None or r_timestamp < r_exec)):
+            access_files[r_run].add(files[r_name])
 
-    # Further filters input files
+    # Further filters input files, looking at the raw paths
     inputs = [[fi.path
                for fi in lst
                # Input files are regular files,
-               if fi.path.is_file() and
+               if is_regular_file(fi._path, stats) and
                # ONLY_READ,
                fi.what == TracedFile.ONLY_READ and
                # not executable,
                # FIXME : currently disabled. Maybe only remove executed files?
                # not fi.path.stat().st_mode & 0b111 and
                # not in a system directory
-               not any(fi.path.lies_under(m)
-                       for m in magic_dirs + system_dirs)]
+               classify_path(fi._path) == PATH_USER]
               for lst in access_files]
 
     # Identify output files
     outputs = [[fi.path
                 for fi in lst
                 # Output files are regular files,
-                if fi.path.is_file() and
+                if is_regular_file(fi._path, stats) and
                 # WRITTEN
                 fi.what == TracedFile.WRITTEN and
                 # not in a system directory
-                not any(fi.path.lies_under(m)
-                        for m in magic_dirs + system_dirs)]
+                classify_path(fi._path) == PATH_USER]
                for lst in access_files]
 
     # Displays a warning for READ_THEN_WRITTEN files
@@ -194,7 +282,7 @@ def get_files(conn):
             fi
             for fi in itervalues(files)
             if fi.what == TracedFile.READ_THEN_WRITTEN and
-            not any(fi.path.lies_under(m) for m in magic_dirs)]
+            classify_path(fi._path) != PATH_MAGIC]
     if read_then_written_files:
         logging.warning(
                 "Some files were read and then written. We will only pack the "
@@ -205,31 +293,36 @@ def get_files(conn):
     files = set(
             fi
             for fi in itervalues(files)
-            if fi.what != TracedFile.WRITTEN and not any(fi.path.lies_under(m)
-                                                         for m in magic_dirs))
+            if fi.what != TracedFile.WRITTEN and
+            classify_path(fi._path) != PATH_MAGIC)
     return files, inputs, outputs
 
 
-def list_directories(conn):
+def list_directories(conn, resolver=None):
     """Gets additional needed directories from the trace database.
 
     Returns the directories which are used as a process's working directory or
     in which files are created.
     """
+    paths = TracePaths(conn, Path, resolver)
     cur = conn.cursor()
     executed_files = cur.execute(
             '''
-            SELECT name, mode
-            FROM opened_files
+            SELECT %s, mode
+            FROM %s
             WHERE mode = ? OR mode = ?
-            ''',
+            ''' % (paths.column, paths.opened_files),
             (FILE_WDIR, FILE_WRITE))
-    executed_files = ((Path(n).resolve(), m) for n, m in executed_files)
+    executed_files = ((paths.resolve(n), m) for n, m in executed_files)
     # If WDIR, the name is a folder that was used as working directory
     # If WRITE, the name is a file that was written to; its directory must
     # exist
-    result = set(TracedFile(n if m == FILE_WDIR else n.parent)
-                 for n, m in executed_files)
+    directories = set(n if m == FILE_WDIR else n.parent
+                      for n, m in executed_files)
+    # Special directories are not packed
+    directories = [n for n in directories if classify_path(n) != PATH_MAGIC]
+    stats = stat_files(directories)
+    result = set(TracedFile(n, stats) for n in directories)
     cur.close()
     return result
 
@@ -240,30 +333,93 @@ def merge_files(newfiles, newpackages, oldfiles, oldpackages):
     files = set(oldfiles)
     files.update(newfiles)
 
+    # Here we build TracedFiles from the Files so that the comment (size,
+    # etc) gets set
+    stats = stat_files(fi._path for pkg in oldpackages for fi in pkg.files)
+
     packages = dict((pkg.name, pkg) for pkg in newpackages)
     for oldpkg in oldpackages:
         if oldpkg.name in packages:
             pkg = packages[oldpkg.name]
-            # Here we build TracedFiles from the Files so that the comment
-            # (size, etc) gets set
-            s = OrderedSet(TracedFile(fi.path) for fi in oldpkg.files)
+            s = OrderedSet(TracedFile(fi.path, stats) for fi in oldpkg.files)
             s.update(pkg.files)
             oldpkg.files = list(s)
             packages[oldpkg.name] = oldpkg
         else:
-            oldpkg.files = [TracedFile(fi.path) for fi in oldpkg.files]
+            oldpkg.files = [TracedFile(fi.path, stats) for fi in oldpkg.files]
             packages[oldpkg.name] = oldpkg
     packages = listvalues(packages)
 
     return files, packages
 
 
-def trace(binary, argv, directory, append, verbosity=1):
+def load_event_log(eventlog, database):
+    """Inserts the events from a binary event log in the trace database.
+
+    The log is written by the tracer if `eventlog` is passed to
+    :func:`trace`; this creates the database if it doesn't exist. Returns
+    the database writer's counters.
+    """
+    return _pytracer.load_event_log(eventlog.path, database.path)
+
+
+def write_stats(directory, stats):
+    """Adds the tracer's counters for a run to trace-stats.json.
+
+    This is where to look to find out why tracing an experiment is slow:
+    ptrace stops per syscall, time spent handling them, database latency...
+    """
+    filename = directory / 'trace-stats.json'
+    runs = []
+    if filename.exists():
+        try:
+            with filename.open('rb') as fp:
+                runs = json.loads(fp.read().decode('utf-8'))['runs']
+        except (ValueError, KeyError):
+            logging.warning("Couldn't read %s, overwriting", filename)
+    runs.append(stats)
+    # Serializes first, so that a failure doesn't truncate the file
+    data = json.dumps({'version': 1, 'runs': runs},
+                      indent=2, sort_keys=True).encode('utf-8')
+    with filename.open('wb') as fp:
+        fp.write(data)
+
+
+def trace(binary, argv, directory, append, verbosity=1, seccomp=False,
+          eventlog=True, dedup=False, profile='full', exclude=(),
+          attach=None, duration=0):
     """Main function for the trace subcommand.
+
+    If `attach` is a process id, that running process and its descendants
+    are traced instead of running `binary`, until they exit, `duration`
+    seconds have elapsed (0 for no limit), or the tracer gets SIGINT or
+    SIGTERM; the tracer then detaches from them and leaves them running.
+
+    If `seccomp` is True, the tracer installs a seccomp filter in the traced
+    program so that it only stops on the system calls it handles; that is
+    only faster if most of the program's system calls are not handled.
+
+    If `eventlog` is True, the tracer writes a compact binary log, which is
+    loaded into the database once the program exits, instead of inserting
+    into the database while tracing.
+
+    If `dedup` is True, a process accessing the same file with the same mode
+    is only recorded once, with the number of accesses in the `occurrences`
+    column.
+
+    `profile` selects which system calls the tracer handles: ``'full'``,
+    ``'files-only'`` (skips the stat family and network connections) or
+    ``'exec-only'`` (executions, and the creation of directories and
+    links). With `seccomp`, the others don't stop the program.
+
+    Accesses to files under `magic_dirs` or under the directories in
+    `exclude` (such as scratch directories) are not recorded by the tracer.
+
+    Counters about the tracer's overhead are added to trace-stats.json, see
+    :func:`write_stats`.
     """
     cwd = Path.cwd()
-    if (any(cwd.lies_under(c) for c in magic_dirs + system_dirs) and
-            not cwd.lies_under('/usr/local')):
+    if classify_path(cwd) in (PATH_MAGIC, PATH_SYSTEM):
         logging.warning(
                 "You are running this experiment from a system directory! "
                 "Autodetection of non-system files will probably not work as "
@@ -283,9 +439,56 @@ def trace(binary, argv, directory, append, verbosity=1):
 
     # Runs the trace
     database = directory / 'trace.sqlite3'
-    logging.info("Running program")
-    # Might raise _pytracer.Error
-    c = _pytracer.execute(binary, argv, database.path, verbosity)
+    exclude = [unicode_(Path(e).absolute())
+               for e in list(magic_dirs) + list(exclude)]
+    # The tracer gets bytes, the stats get text
+    tracer_exclude = [Path(e).path for e in exclude]
+
+    def run_tracer(path, eventlog):
+        # Might raise _pytracer.Error
+        if attach is not None:
+            return _pytracer.attach(attach, path, verbosity,
+                                    duration=duration, eventlog=eventlog,
+                                    dedup=dedup, stats=True,
+                                    profile=profile, exclude=tracer_exclude)
+        else:
+            return _pytracer.execute(binary, argv, path, verbosity,
+                                     seccomp=seccomp, eventlog=eventlog,
+                                     dedup=dedup, stats=True,
+                                     profile=profile,
+                                     exclude=tracer_exclude)
+
+    if attach is not None:
+        logging.info("Attaching to process %d", attach)
+    else:
+        logging.info("Running program")
+    if eventlog:
+        log = directory / 'trace.events'
+        traced = False
+        try:
+            c, stats = run_tracer(log.path, True)
+            traced = True
+        finally:
+            # Also loads what was logged if the tracer failed, without hiding
+            # the tracer's error if that fails too
+            if not traced and log.exists():
+                try:
+                    load_event_log(log, database)
+                    log.remove()
+                except Exception:
+                    logging.exception("Couldn't load event log %s", log)
+        logging.info("Loading event log into database")
+        stats['database'] = load_event_log(log, database)
+        log.remove()
+    else:
+        c, stats = run_tracer(database.path, False)
+    stats['exit_status'] = c
+    stats['profile'] = profile
+    stats['exclude'] = exclude
+    write_stats(directory, stats)
+    if c is None:
+        logging.info("Detached from program, which is still running")
+        return
     if c != 0:
         if c & 0x0100:
             logging.warning("Program appears to have been terminated by "
@@ -306,9 +509,11 @@ def write_configuration(directory, sort_packages, overwrite=False):
     else:
         conn = sqlite3.connect(database.path)
     conn.row_factory = sqlite3.Row
+    version = TracePaths(conn).version
 
     # Reads info from database
-    files, inputs, outputs = get_files(conn)
+    resolver = LinkResolver()
+    files, inputs, outputs = get_files(conn, resolver)
 
     # Identifies which file comes from which package
     if sort_packages:
@@ -319,20 +524,31 @@ def write_configuration(directory, sort_packages, overwrite=False):
     # Makes sure all the directories used as working directories are packed
     # (they already do if files from them are used, but empty directories do
     # not get packed inside a tar archive)
-    files.update(d for d in list_directories(conn) if d.path.is_dir())
+    files.update(d for d in list_directories(conn, resolver)
+                 if d.path.is_dir())
+    logging.debug("Symbolic link resolution: %d path prefixes, %d cached",
+                  resolver.hits + resolver.misses, resolver.hits)
 
     # Writes configuration file
     config = directory / 'config.yml'
     distribution = platform.linux_distribution()[0:2]
     oldconfig = not overwrite and config.exists()
     cur = conn.cursor()
-    if not oldconfig:
-        runs = []
-        # This gets all the top-level processes (p.parent ISNULL) and the first
-        # executed file for that process (sorting by ids, which are
-        # chronological)
-        executions = cur.execute(
+    # This gets all the top-level processes (p.parent ISNULL) and the first
+    # executed file for that process (sorting by ids, which are
+    # chronological)
+    if version >= 2:
+        executions_query = '''
+                SELECT e.name, e.argv, e.envp, e.workingdir, p.exitcode
+                FROM runs r
+                JOIN processes p ON p.run_id=r.id AND p.parent ISNULL
+                JOIN executed_files e ON e.id=(
+                    SELECT MIN(e2.id) FROM executions e2
+                    WHERE e2.process=p.id
+                )
                 '''
+    else:
+        executions_query = '''
                 SELECT e.name, e.argv, e.envp, e.workingdir, p.exitcode
                 FROM processes p
                 JOIN executed_files e ON e.id=(
@@ -341,8 +557,11 @@ def write_configuration(directory, sort_packages, overwrite=False):
                     ORDER BY e2.id
                     LIMIT 1
                 )
-                WHERE p.parent ISNULL;
-                ''')
+                WHERE p.parent ISNULL
+                '''
+    if not oldconfig:
+        runs = []
+        executions = cur.execute(executions_query + 'ORDER BY p.id;')
     else:
         # Loads in previous config
         runs, oldpkgs, oldfiles, patterns = load_config(config,
@@ -350,21 +569,9 @@ def write_configuration(directory, sort_packages, overwrite=False):
                                                         File=TracedFile)
         # Here, additional patterns are discarded
 
-        # Same query as previous block but only gets last process
-        executions = cur.execute(
-                '''
-                SELECT e.name, e.argv, e.envp, e.workingdir, p.exitcode
-                FROM processes p
-                JOIN executed_files e ON e.id=(
-                    SELECT id FROM executed_files e2
-                    WHERE e2.process=p.id
-                    ORDER BY e2.id
-                    LIMIT 1
-                )
-                WHERE p.parent ISNULL
-                ORDER BY p.id DESC
-                LIMIT 1;
-                ''')
+        # Only gets last process
+        executions = cur.execute(executions_query +
+                                 'ORDER BY p.id DESC LIMIT 1;')
         inputs = inputs[-1:]
         outputs = outputs[-1:]
 
@@ -441,19 +648,24 @@ def write_configuration(directory, sort_packages, overwrite=False):
         # TODO : Note that right now, we keep as output files the ones that
         # don't appear on the command-line
 
-        runs.append({'binary': r_name, 'argv': argv,
-                     'workingdir': Path(r_workingdir).path,
-                     'architecture': platform.machine().lower(),
-                     'distribution': distribution,
-                     'hostname': platform.node(),
-                     'system': [platform.system(), platform.release()],
-                     'environ': environ,
-                     'uid': os.getuid(),
-                     'gid': os.getgid(),
-                     'signal' if r_exitcode & 0x0100 else 'exitcode':
-                         r_exitcode & 0xFF,
-                     'input_files': input_files_dict,
-                     'output_files': output_files_dict})
+        run = {'binary': r_name, 'argv': argv,
+               'workingdir': Path(r_workingdir).path,
+               'architecture': platform.machine().lower(),
+               'distribution': distribution,
+               'hostname': platform.node(),
+               'system': [platform.system(), platform.release()],
+               'environ': environ,
+               'uid': os.getuid(),
+               'gid': os.getgid(),
+               'input_files': input_files_dict,
+               'output_files': output_files_dict}
+        # No exit code if the tracer detached while it was running
+        if r_exitcode is not None:
+            if r_exitcode & 0x0100:
+                run['signal'] = r_exitcode & 0xFF
+            else:
+                run['exitcode'] = r_exitcode & 0xFF
+        runs.append(run)
     cur.close()
 
     conn.close()
@@ -25,7 +25,7 @@ sources = [os.path.join('native', n) for n in sources]
 
 
 # Setup the libraries
-libraries = ['sqlite3', 'rt']
+libraries = ['sqlite3', 'rt', 'pthread']
 
 
 # Build the C module
@@ -0,0 +1,70 @@
+"""Memory benchmark for the file and package records of a configuration.
+
+Builds the File and Package records of a synthetic trace (files spread over
+packages, like after identify_packages()) with reprozip.common, and with
+records keeping their attributes and a `Path` in a ``__dict__`` like they
+used to, and reports the memory used by each with tracemalloc (Python 3).
+
+Run from the root of the repository with:
+    PYTHONPATH=reprozip python scripts/benchmarks/file_records.py [count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import gc
+from rpaths import Path
+import sys
+import tracemalloc
+
+from reprozip.common import File, Package
+
+
+class DictFile(object):
+    comment = None
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = size
+
+
+class DictPackage(object):
+    def __init__(self, name, version, files=None, packfiles=True, size=None):
+        self.name = name
+        self.version = version
+        self.files = list(files) if files is not None else []
+        self.packfiles = packfiles
+        self.size = size
+
+
+def build(count, File, Package):
+    packages = []
+    for i in range(0, count, 1000):
+        files = [File(Path('/usr/lib/x86_64-linux-gnu/pkg%d/file%d.so' % (
+                           i, j)),
+                      4096 + j)
+                 for j in range(min(1000, count - i))]
+        for f in files:
+            f.comment = "4.00 KB"
+        packages.append(Package('pkg%d' % i, '1.0', files, size=1 << 20))
+    return packages
+
+
+def measure(count, File, Package):
+    gc.collect()
+    tracemalloc.start()
+    packages = build(count, File, Package)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del packages
+    return current
+
+
+def main(count):
+    old = measure(count, DictFile, DictPackage)
+    new = measure(count, File, Package)
+    print("%d files, __dict__ records: %.1f MB" % (count, old / 1e6))
+    print("%d files, __slots__ records: %.1f MB" % (count, new / 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,63 @@
+"""Micro-benchmark for sorting paths between system and user directories.
+
+Compares the `PathClassifier` trie of reprozip.tracer.linux_pkgs with checking
+`Path.lies_under()` for each directory, over a synthetic corpus of paths
+shaped like those found in traces (mostly libraries and Python modules).
+
+Run from the root of the repository with:
+    PYTHONPATH=reprozip python scripts/benchmarks/path_classifier.py [count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import random
+from rpaths import Path
+import sys
+import time
+
+from reprozip.tracer.linux_pkgs import magic_dirs, system_dirs, \
+    PATH_USER, PATH_LOCAL, PATH_SYSTEM, PATH_MAGIC, classify_path
+
+
+PREFIXES = ['/usr/lib/x86_64-linux-gnu', '/usr/lib/python2.7/dist-packages',
+            '/usr/local/lib/python2.7/site-packages', '/usr/share/locale',
+            '/lib/x86_64-linux-gnu', '/etc', '/proc/self', '/dev',
+            '/home/user/experiment', '/home/user/experiment/data', '/tmp',
+            '/var/lib/dpkg', '/usrdata', '/opt/tool/bin']
+
+
+def lies_under(path):
+    if any(path.lies_under(c) for c in magic_dirs):
+        return PATH_MAGIC
+    elif path.lies_under('/usr/local'):
+        return PATH_LOCAL
+    elif any(path.lies_under(c) for c in system_dirs):
+        return PATH_SYSTEM
+    else:
+        return PATH_USER
+
+
+def main(count):
+    rand = random.Random(4)
+    paths = [Path('%s/f%d' % (rand.choice(PREFIXES), rand.randrange(5000)))
+             for _ in range(count)]
+
+    start = time.time()
+    expected = [lies_under(p) for p in paths]
+    print("lies_under(): %.2fs" % (time.time() - start))
+
+    start = time.time()
+    result = [classify_path(p) for p in paths]
+    print("classify_path(): %.2fs" % (time.time() - start))
+
+    raw = [p.path for p in paths]
+    start = time.time()
+    result_raw = [classify_path(p) for p in raw]
+    print("classify_path() on bytes: %.2fs" % (time.time() - start))
+
+    assert result == expected
+    assert result_raw == expected
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,159 @@
+/* Micro-benchmark for reading strings from a traced process.
+ *
+ * Compares the process_vm_readv() fast path of ptrace_utils.c with the
+ * PTRACE_PEEKDATA fallback, reporting the number of system calls and the time
+ * needed to read a long path and an environment array.
+ *
+ * Build and run from the root of the repository with:
+ *   cc -O2 -o tracee_read scripts/benchmarks/tracee_read.c \
+ *       reprozip/native/log.c && ./tracee_read
+ */
+
+#define _GNU_SOURCE
+
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/ptrace.h>
+#include <sys/types.h>
+#include <sys/uio.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+
+
+/* Counts the system calls made by ptrace_utils.c */
+static unsigned long nb_syscalls = 0;
+
+static long counted_ptrace(int request, pid_t pid, const void *addr,
+                           void *data)
+{
+    ++nb_syscalls;
+    return ptrace(request, pid, (void*)addr, data);
+}
+
+static ssize_t counted_process_vm_readv(pid_t pid,
+                                        const struct iovec *local_iov,
+                                        unsigned long liovcnt,
+                                        const struct iovec *remote_iov,
+                                        unsigned long riovcnt,
+                                        unsigned long flags)
+{
+    ++nb_syscalls;
+    return process_vm_readv(pid, local_iov, liovcnt,
+                            remote_iov, riovcnt, flags);
+}
+
+#define ptrace counted_ptrace
+#define process_vm_readv counted_process_vm_readv
+#include "../../reprozip/native/ptrace_utils.c"
+#undef ptrace
+#undef process_vm_readv
+
+
+int trace_verbosity = 1;
+
+#define NB_ENV      200
+#define ITERATIONS  200
+
+
+static double now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1.0e-9;
+}
+
+static void run(pid_t child, const char *path, char **envp, int fast)
+{
+    double start;
+    unsigned long path_syscalls, env_syscalls;
+    int i;
+
+    tracee_use_vm_readv = fast;
+
+    nb_syscalls = 0;
+    start = now();
+    for(i = 0; i < ITERATIONS; ++i)
+    {
+        char *copy = tracee_strdup(child, path);
+        if(strcmp(copy, path) != 0)
+        {
+            fprintf(stderr, "path read incorrectly\n");
+            exit(1);
+        }
+        free(copy);
+    }
+    path_syscalls = nb_syscalls;
+    printf("%-16s path (%u bytes): %7.1f syscalls/read, %8.1f us/read\n",
+           fast?"process_vm_readv":"PTRACE_PEEKDATA",
+           (unsigned int)strlen(path),
+           (double)path_syscalls / ITERATIONS,
+           (now() - start) * 1.0e6 / ITERATIONS);
+
+    nb_syscalls = 0;
+    start = now();
+    for(i = 0; i < ITERATIONS; ++i)
+    {
+        char **copy = tracee_strarraydup(MODE_X86_64, child,
+                                         (const char *const*)envp);
+        size_t j;
+        for(j = 0; envp[j] != NULL; ++j)
+            if(copy[j] == NULL || strcmp(copy[j], envp[j]) != 0)
+            {
+                fprintf(stderr, "environment read incorrectly\n");
+                exit(1);
+            }
+        free_strarray(copy);
+    }
+    env_syscalls = nb_syscalls;
+    printf("%-16s envp (%d vars):   %7.1f syscalls/read, %8.1f us/read\n",
+           fast?"process_vm_readv":"PTRACE_PEEKDATA",
+           NB_ENV,
+           (double)env_syscalls / ITERATIONS,
+           (now() - start) * 1.0e6 / ITERATIONS);
+}
+
+int main(void)
+{
+    char path[4096];
+    char *envp[NB_ENV + 1];
+    pid_t child;
+    int status;
+    size_t i;
+
+    /* Builds the data before forking, so it is at the same addresses in the
+     * child */
+    for(i = 0; i + 1 < sizeof(path); ++i)
+        path[i] = (i % 16 == 0)?'/':'a' + i % 26;
+    path[i] = '\0';
+    for(i = 0; i < NB_ENV; ++i)
+    {
+        envp[i] = malloc(64);
+        snprintf(envp[i], 64, "VARIABLE_%d=/some/value/for/variable/%d",
+                 (int)i, (int)i);
+    }
+    envp[NB_ENV] = NULL;
+
+#if !defined(X86_64)
+    fprintf(stderr, "this benchmark only runs on x86_64\n");
+    return 1;
+#endif
+
+    child = fork();
+    if(child == 0)
+    {
+        ptrace(PTRACE_TRACEME, 0, NULL, NULL);
+        kill(getpid(), SIGSTOP);
+        _exit(0);
+    }
+    waitpid(child, &status, 0);
+
+    run(child, path, envp, 0);
+    run(child, path, envp, 1);
+
+    kill(child, SIGKILL);
+    waitpid(child, &status, 0);
+    return 0;
+}
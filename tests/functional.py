@@ -5,6 +5,7 @@
 # See file LICENSE for full license details.
 
 import functools
+import json
 import os
 import re
 from rpaths import Path, unicode
@@ -137,10 +138,42 @@ def functional_tests(raise_warnings, interactive, run_vagrant, run_docker):
                       'cat ../../../../../etc/passwd;'
                       'cd /var/lib;'
                       'cat ../../etc/group'])
+    check_call(rpz + ['testrun', '--dedup', 'bash', '-c',
+                      'cat /etc/passwd; cat /etc/passwd'])
+    check_call(rpz + ['testrun', '--profile', 'files-only', 'bash', '-c',
+                      'cat /etc/passwd; ls /etc'])
+    check_call(rpz + ['testrun', '--exclude', '/etc', 'bash', '-c',
+                      'cat /etc/passwd; ls /etc'])
     check_call(rpz + ['trace',
                       'bash', '-c', 'cat /etc/passwd;echo'])
     check_call(rpz + ['trace', '--continue',
                       'sh', '-c', 'cat /etc/group;/usr/bin/id'])
+    check_call(rpz + ['trace', '--continue', '--no-event-log',
+                      'bash', '-c', 'cat /etc/hostname'])
+    with Path('.reprozip-trace/trace-stats.json').open(encoding='utf-8') as fp:
+        stats = json.load(fp)
+    assert len(stats['runs']) == 3
+    assert all(run['database']['events'] > 0 for run in stats['runs'])
+    assert all(run['syscall_info_reads'] + run['register_reads'] > 0
+               for run in stats['runs'])
+    check_call(rpz + ['trace', '-d', 'rpz-exclude', '--exclude', '/etc',
+                      'cat', '/etc/hostname'])
+    with Path('rpz-exclude/trace-stats.json').open(encoding='utf-8') as fp:
+        stats = json.load(fp)
+    assert '/etc' in stats['runs'][0]['exclude']
+    with Path('rpz-exclude/config.yml').open(encoding='utf-8') as fp:
+        conf = yaml.safe_load(fp)
+    assert '/etc/hostname' not in conf['other_files']
+    # --duration only applies to --attach
+    assert call(rpz + ['trace', '-d', 'rpz-duration', '--duration', '1',
+                       'true']) != 0
+    sleeper = subprocess.Popen(['sleep', '30'])
+    try:
+        check_call(rpz + ['trace', '-d', 'rpz-attach',
+                          '--attach', '%d' % sleeper.pid, '--duration', '1'])
+    finally:
+        sleeper.kill()
+        sleeper.wait()
     check_call(rpz + ['pack'])
     if not bug13676:
         check_call(rpuz + ['graph', 'graph.dot'])
@@ -1,8 +1,21 @@
 import os
-from rpaths import Path
+from rpaths import Path, PosixPath
+import sqlite3
+import subprocess
+import sys
+import time
 import unittest
 
-from reprozip.utils import make_dir_writable
+from reprozip.common import File, Package, TracePaths
+from reprozip.tracer.linux_pkgs import PathClassifier, PATH_USER, \
+    PATH_LOCAL, PATH_SYSTEM, PATH_MAGIC
+from reprozip.utils import CommonEqualityMixin, LinkResolver, find_all_links, \
+    make_dir_writable
+
+try:
+    from reprozip import _pytracer
+except ImportError:
+    _pytracer = None
 
 
 class TestReprozip(unittest.TestCase):
@@ -52,3 +65,506 @@ class TestReprozip(unittest.TestCase):
             (tmp / 'some' / 'complete').chmod(0o755)
             (tmp / 'some' / 'complete' / 'path').chmod(0o755)
             tmp.rmtree()
+
+    def test_trace_paths(self):
+        """Tests reading paths from old and new trace databases."""
+        old = sqlite3.connect(':memory:')
+        old.execute('CREATE TABLE opened_files(name TEXT, mode INTEGER)')
+        old.execute("INSERT INTO opened_files VALUES('/etc/passwd', 1)")
+        new = sqlite3.connect(':memory:')
+        new.execute('PRAGMA user_version=2')
+        new.execute('CREATE TABLE paths(id INTEGER PRIMARY KEY, path TEXT, '
+                    'canonical INTEGER)')
+        new.execute("INSERT INTO paths VALUES(4, '/etc/passwd', 4)")
+        new.execute("INSERT INTO paths VALUES(5, '/lnk/passwd', 4)")
+        new.execute("INSERT INTO paths VALUES(6, '/lnk', NULL)")
+        new.execute('CREATE TABLE path_links(path INTEGER, link INTEGER)')
+        new.execute('INSERT INTO path_links VALUES(5, 6)')
+        new.execute('CREATE TABLE file_accesses(path INTEGER, mode INTEGER)')
+        new.execute('INSERT INTO file_accesses VALUES(4, 1)')
+        for conn in (old, new):
+            paths = TracePaths(conn)
+            rows = list(conn.execute('SELECT %s FROM %s' % (
+                paths.column, paths.opened_files)))
+            self.assertEqual(len(rows), 1)
+            path = paths.path(rows[0][0])
+            self.assertEqual(path.unicodename, 'passwd')
+            self.assertIs(paths.path(rows[0][0]), path)
+
+        # Symbolic links were resolved by the tracer
+        paths = TracePaths(new)
+        self.assertEqual(paths.resolve(5), Path('/etc/passwd'))
+        self.assertEqual(paths.links(5), [Path('/lnk')])
+        self.assertEqual(paths.links(4), [])
+
+    def test_file_records(self):
+        """Tests the slotted File and Package records."""
+        a = File(PosixPath('/etc/passwd'))
+        b = File(Path('/etc/passwd'), 42)
+        self.assertIs(type(a.path), PosixPath)
+        self.assertIs(type(b.path), Path)
+        self.assertEqual(a.path, Path('/etc/passwd'))
+        self.assertEqual((a.size, a.comment), (None, None))
+        self.assertEqual(a, b)
+        self.assertEqual(len(set([a, b])), 1)
+        self.assertNotEqual(a, File(Path('/etc/group')))
+        self.assertFalse(hasattr(a, '__dict__'))
+
+        pkg = Package('libc', '2.19', [a], size=1024)
+        self.assertEqual(pkg, Package('libc', '2.19', [b], size=1024))
+        self.assertNotEqual(pkg, Package('libc', '2.20', [a], size=1024))
+        self.assertNotEqual(pkg, Package('libc', '2.19', [a], False, 1024))
+        pkg.add_file(File(Path('/etc/group')))
+        self.assertEqual(len(pkg.files), 2)
+        self.assertFalse(hasattr(pkg, '__dict__'))
+
+    def test_equality_mixin(self):
+        """Tests comparing objects with and without slots."""
+        class Base(CommonEqualityMixin):
+            __slots__ = ('a',)
+
+            def __init__(self, a, b=None):
+                self.a = a
+                if b is not None:
+                    self.b = b
+
+        class Slotted(Base):
+            __slots__ = 'b'
+
+        class Unslotted(Base):
+            pass
+
+        self.assertEqual(Slotted(1, 2), Slotted(1, 2))
+        self.assertNotEqual(Slotted(1, 2), Slotted(1, 3))
+        self.assertNotEqual(Slotted(1, 2), Slotted(0, 2))
+        self.assertEqual(Slotted(1), Slotted(1))
+        self.assertEqual(Unslotted(1, 2), Unslotted(1, 2))
+        self.assertNotEqual(Unslotted(1, 2), Unslotted(1, 3))
+        self.assertNotEqual(Unslotted(1, 2), Unslotted(0, 2))
+        self.assertNotEqual(Slotted(1, 2), Unslotted(1, 2))
+
+    def test_classify_path(self):
+        """Tests sorting paths between system and user directories."""
+        classifier = PathClassifier()
+        for path, kind in [('/usr/lib/libc.so', PATH_SYSTEM),
+                           ('/usr', PATH_SYSTEM),
+                           ('/usr/local/bin/python', PATH_LOCAL),
+                           ('/usr/localfile', PATH_SYSTEM),
+                           ('/usrlocal', PATH_USER),
+                           ('/proc/self/maps', PATH_MAGIC),
+                           ('/home/user/data.txt', PATH_USER),
+                           ('/', PATH_USER)]:
+            self.assertEqual(classifier.classify(Path(path)), kind)
+            self.assertEqual(classifier.classify(Path(path).path), kind)
+        classifier = PathClassifier(magic=['/a'], system=['/a/b/c'],
+                                    local=['/a/b'])
+        self.assertEqual(classifier.classify(b'/a/b/c/d'), PATH_SYSTEM)
+        self.assertEqual(classifier.classify(b'/a/b/d'), PATH_LOCAL)
+        self.assertEqual(classifier.classify(b'/a/d'), PATH_MAGIC)
+
+    def test_find_all_links(self):
+        """Tests resolving symbolic links with a shared cache."""
+        tmp = Path.tempdir()
+        try:
+            tmp = tmp.resolve()
+            (tmp / 'b' / 'd').mkdir(parents=True)
+            (tmp / 'f').open('w').close()
+            (tmp / 'a').symlink('b')
+            (tmp / 'b' / 'g').symlink('c')
+            (tmp / 'b' / 'c').symlink('../a/d')
+            (tmp / 'b' / 'd' / 'e').symlink(tmp / 'f')
+            (tmp / 'loop').symlink('loop')
+
+            self.assertEqual(find_all_links(tmp / 'a' / 'g' / 'e', True),
+                             [tmp / 'a', tmp / 'b' / 'g', tmp / 'b' / 'c',
+                              tmp / 'b' / 'd' / 'e', tmp / 'f'])
+
+            resolver = LinkResolver()
+            self.assertEqual(resolver.resolve(tmp / 'a' / 'g' / 'e'),
+                             tmp / 'f')
+            hits, misses = resolver.hits, resolver.misses
+            # Only the last component is new
+            self.assertEqual(resolver.resolve(tmp / 'a' / 'g' / 'x'),
+                             tmp / 'b' / 'd' / 'x')
+            self.assertEqual(resolver.links(tmp / 'a' / 'g' / 'x'),
+                             [tmp / 'a', tmp / 'b' / 'g', tmp / 'b' / 'c'])
+            self.assertEqual((resolver.hits, resolver.misses),
+                             (hits + 2, misses + 1))
+            self.assertEqual(find_all_links(tmp / 'b' / 'd', True, resolver),
+                             [tmp / 'b' / 'd'])
+            self.assertEqual(resolver.links(tmp / 'loop'), [tmp / 'loop'])
+        finally:
+            tmp.rmtree()
+
+
+@unittest.skipUnless(_pytracer is not None and
+                     sys.platform.startswith('linux'),
+                     "Tracer is not available")
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='reprozip_tests_')
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def trace(self, argv, **kwargs):
+        """Traces a command, returns the database and the counters."""
+        database = self.tmp / 'trace.sqlite3'
+        if database.exists():
+            database.remove()
+        kwargs['stats'] = True
+        status, stats = _pytracer.execute(argv[0], argv, str(database), 0,
+                                          **kwargs)
+        self.assertEqual(status, 0)
+        return sqlite3.connect(database.path), stats
+
+    def opened(self, conn):
+        return set(r for r, in conn.execute('SELECT name FROM opened_files'))
+
+    def test_dedup(self):
+        """Tests recording repeated accesses once, with their count."""
+        path = str(self.tmp / 'f')
+        with (self.tmp / 'f').open('w') as fp:
+            fp.write('line\n')
+        argv = ['/bin/bash', '-c', 'read < %s; read < %s; read < %s' % (
+                (path,) * 3)]
+        query = 'SELECT mode, occurrences FROM opened_files WHERE name = ?'
+
+        conn, stats = self.trace(argv)
+        self.assertEqual(list(conn.execute(query, (path,))),
+                         [(1, 1), (1, 1), (1, 1)])
+
+        conn, stats = self.trace(argv, dedup=True)
+        self.assertEqual(list(conn.execute(query, (path,))), [(1, 3)])
+
+        # The counts go through the event log
+        log = self.tmp / 'trace.events'
+        database = self.tmp / 'log.sqlite3'
+        _pytracer.execute(argv[0], argv, str(log), 0,
+                          eventlog=True, dedup=True)
+        _pytracer.load_event_log(str(log), str(database))
+        conn = sqlite3.connect(str(database))
+        self.assertEqual(list(conn.execute(query, (path,))), [(1, 3)])
+
+        # The counts land on the right rows when appending to a database
+        _pytracer.load_event_log(str(log), str(database))
+        _pytracer.execute(argv[0], argv, str(database), 0, dedup=True)
+        conn = sqlite3.connect(str(database))
+        self.assertEqual(list(conn.execute(query, (path,))),
+                         [(1, 3), (1, 3), (1, 3)])
+
+    def test_paths_table(self):
+        """Tests that paths are stored once, behind the old views."""
+        path = str(self.tmp / 'f')
+        (self.tmp / 'f').open('w').close()
+        conn, stats = self.trace(
+            ['/bin/bash', '-c',
+             '/bin/cat %s; /bin/cat %s; /bin/true' % (path, path)])
+
+        self.assertEqual(
+            list(conn.execute('SELECT path FROM paths '
+                              'GROUP BY path HAVING COUNT(*) > 1')),
+            [])
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM paths WHERE path = ?',
+                         (path,)).fetchone()[0],
+            1)
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM opened_files WHERE name = ?',
+                         (path,)).fetchone()[0],
+            2)
+
+        # The views have the columns of the old tables
+        self.assertEqual(
+            [r[1] for r in conn.execute('PRAGMA table_info(opened_files)')],
+            ['id', 'name', 'timestamp', 'mode', 'is_directory', 'process',
+             'occurrences', 'run_id'])
+        self.assertEqual(
+            [r[1] for r in conn.execute('PRAGMA table_info(executed_files)')],
+            ['id', 'name', 'timestamp', 'process', 'argv', 'envp',
+             'workingdir', 'run_id'])
+        self.assertEqual(
+            list(conn.execute('SELECT name, argv, workingdir '
+                              'FROM executed_files ORDER BY id')),
+            [('/bin/bash',
+              '/bin/bash\0-c\0/bin/cat %s; /bin/cat %s; /bin/true\0' % (
+                  path, path),
+              os.getcwd()),
+             ('/bin/cat', '/bin/cat\0%s\0' % path, os.getcwd()),
+             ('/bin/cat', '/bin/cat\0%s\0' % path, os.getcwd()),
+             ('/bin/true', '/bin/true\0', os.getcwd())])
+
+    def test_migrate_v1(self):
+        """Tests appending a run to a database from reprozip 0.6."""
+        database = self.tmp / 'trace.sqlite3'
+        conn = sqlite3.connect(str(database))
+        conn.executescript(
+            '''
+            CREATE TABLE processes(
+                id INTEGER NOT NULL PRIMARY KEY,
+                parent INTEGER,
+                timestamp INTEGER NOT NULL,
+                exitcode INTEGER
+                );
+            CREATE INDEX proc_parent_idx ON processes(parent);
+            CREATE TABLE opened_files(
+                id INTEGER NOT NULL PRIMARY KEY,
+                name TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                mode INTEGER NOT NULL,
+                is_directory BOOLEAN NOT NULL,
+                process INTEGER NOT NULL
+                );
+            CREATE INDEX open_proc_idx ON opened_files(process);
+            CREATE TABLE executed_files(
+                id INTEGER NOT NULL PRIMARY KEY,
+                name TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                process INTEGER NOT NULL,
+                argv TEXT NOT NULL,
+                envp TEXT NOT NULL,
+                workingdir TEXT NOT NULL
+                );
+            CREATE INDEX exec_proc_idx ON executed_files(process);
+
+            INSERT INTO processes VALUES(1, NULL, 100, 0);
+            INSERT INTO processes VALUES(2, 1, 110, 0);
+            INSERT INTO processes VALUES(3, NULL, 200, 1);
+            INSERT INTO opened_files VALUES(1, '/etc/passwd', 101, 1, 0, 1);
+            INSERT INTO opened_files VALUES(2, '/tmp', 111, 4, 1, 2);
+            INSERT INTO opened_files VALUES(3, '/etc/passwd', 201, 1, 0, 3);
+            INSERT INTO executed_files VALUES(1, '/bin/cat', 112, 2,
+                                              'cat' || x'00', 'A=1' || x'00',
+                                              '/tmp');
+            ''')
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(
+            _pytracer.execute('/bin/true', ['/bin/true'], str(database), 0),
+            0)
+
+        conn = sqlite3.connect(str(database))
+        self.assertEqual(
+            conn.execute('PRAGMA user_version').fetchone()[0], 3)
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0], 3)
+        self.assertEqual(
+            list(conn.execute('SELECT id, run_id FROM processes '
+                              'WHERE id <= 3 ORDER BY id')),
+            [(1, 1), (2, 1), (3, 2)])
+        self.assertEqual(
+            set(conn.execute('SELECT run_id FROM processes WHERE id > 3')),
+            set([(3,)]))
+        self.assertEqual(
+            list(conn.execute('SELECT id, name, timestamp, mode, '
+                              'is_directory, process, occurrences, run_id '
+                              'FROM opened_files WHERE id <= 3 ORDER BY id')),
+            [(1, '/etc/passwd', 101, 1, 0, 1, 1, 1),
+             (2, '/tmp', 111, 4, 1, 2, 1, 1),
+             (3, '/etc/passwd', 201, 1, 0, 3, 1, 2)])
+        self.assertEqual(
+            list(conn.execute('SELECT id, name, timestamp, process, argv, '
+                              'envp, workingdir, run_id '
+                              'FROM executed_files WHERE id = 1')),
+            [(1, '/bin/cat', 112, 2, 'cat\0', 'A=1\0', '/tmp', 1)])
+        self.assertEqual(
+            list(conn.execute('SELECT name, process, workingdir, run_id '
+                              'FROM executed_files WHERE id > 1')),
+            [('/bin/true', 4, os.getcwd(), 3)])
+
+    def test_usage(self):
+        """Tests recording the resources used by each process."""
+        path = str(self.tmp / 'f')
+        with (self.tmp / 'f').open('wb') as fp:
+            fp.write(b'x' * 100000)
+        conn, stats = self.trace(
+            ['/bin/bash', '-c',
+             '/bin/cat %s > /dev/null; '
+             'i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done' % path])
+        rows = dict((r[0], r[1:]) for r in conn.execute(
+            'SELECT parent, user_time + system_time, max_rss, io_read '
+            'FROM processes'))
+        cpu, max_rss, io_read = rows[None]
+        self.assertGreater(cpu, 0)
+        self.assertGreater(max_rss, 0)
+        cpu, max_rss, io_read = rows[1]
+        self.assertGreaterEqual(io_read, 100000)
+
+        # Databases from the previous schema version get the new columns
+        conn.executescript(
+            """
+            ALTER TABLE processes RENAME TO new_processes;
+            CREATE TABLE processes(
+                id INTEGER NOT NULL PRIMARY KEY,
+                run_id INTEGER NOT NULL,
+                parent INTEGER,
+                timestamp INTEGER NOT NULL,
+                exitcode INTEGER
+                );
+            INSERT INTO processes
+                SELECT id, run_id, parent, timestamp, exitcode
+                FROM new_processes;
+            DROP TABLE new_processes;
+            PRAGMA user_version=2;
+            """)
+        conn.close()
+        database = self.tmp / 'trace.sqlite3'
+        _pytracer.execute('/bin/true', ['/bin/true'], str(database), 0)
+        conn = sqlite3.connect(str(database))
+        self.assertEqual(
+            conn.execute('PRAGMA user_version').fetchone()[0], 3)
+        self.assertEqual(
+            list(conn.execute('SELECT id, max_rss IS NULL FROM processes')),
+            [(1, 1), (2, 1), (3, 0)])
+
+    def test_truncated_event_log(self):
+        """Tests loading an event log that ends in the middle of a record."""
+        log = self.tmp / 'trace.events'
+        database = self.tmp / 'trace.sqlite3'
+        path = str(self.tmp / 'f')
+        (self.tmp / 'f').open('w').close()
+        self.assertEqual(
+            _pytracer.execute('/bin/cat', ['/bin/cat', path], str(log), 0,
+                              eventlog=True),
+            0)
+        size = log.size()
+        with log.open('r+b') as fp:
+            fp.truncate(size - 3)
+        _pytracer.load_event_log(str(log), str(database))
+
+        # What was logged before the last record is there
+        conn = sqlite3.connect(str(database))
+        self.assertEqual(
+            list(conn.execute('SELECT mode FROM opened_files WHERE name = ?',
+                              (path,))),
+            [(1,)])
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM processes').fetchone()[0], 1)
+
+    def test_path_cache_link(self):
+        """Tests that replacing a link evicts the cached paths under it."""
+        (self.tmp / 'd').mkdir()
+        (self.tmp / 'd' / 'f').open('w').close()
+        (self.tmp / 'l').symlink('d')
+        link = str(self.tmp / 'l')
+        conn, stats = self.trace(
+            ['/bin/bash', '-c',
+             'cat %s/f; rm %s; mkdir %s %s/f; ls %s/f' % ((link,) * 5)])
+        self.assertEqual(
+            list(conn.execute(
+                '''
+                SELECT is_directory FROM opened_files
+                WHERE name = ? AND mode = 1
+                ORDER BY timestamp;
+                ''',
+                (link + '/f',))),
+            [(0,), (1,)])
+
+    def test_link_replaced(self):
+        """Tests that paths are resolved again when a link is replaced."""
+        for d in ('d1', 'd2'):
+            (self.tmp / d).mkdir()
+            (self.tmp / d / 'f').open('w').close()
+        (self.tmp / 'l').symlink('d1')
+        link = str(self.tmp / 'l')
+        conn, stats = self.trace(
+            ['/bin/bash', '-c',
+             'cat %s/f; rm %s; ln -s d2 %s; cat %s/f' % ((link,) * 4)])
+        self.assertEqual(
+            list(conn.execute(
+                '''
+                SELECT c.path FROM paths p, paths c
+                WHERE p.path = ? AND c.id = p.canonical;
+                ''',
+                (link + '/f',))),
+            [(str(self.tmp / 'd2' / 'f'),)])
+
+    def test_exclude(self):
+        """Tests excluding path prefixes from the trace."""
+        (self.tmp / 'x').mkdir()
+        (self.tmp / 'x' / 'y').open('w').close()
+        (self.tmp / 'xy').open('w').close()
+        x, y, xy = [str(self.tmp / p) for p in ('x', 'x/y', 'xy')]
+        argv = ['/bin/cat', y, xy]
+
+        conn, stats = self.trace(argv)
+        self.assertTrue(set([y, xy]).issubset(self.opened(conn)))
+        self.assertEqual(stats['excluded_paths'], 0)
+
+        # Paths under the prefix are excluded, not the ones that just start
+        # with the same characters
+        for prefix in (x, x + '/', x + '//'):
+            conn, stats = self.trace(argv, exclude=['/proc', prefix])
+            opened = self.opened(conn)
+            self.assertNotIn(y, opened)
+            self.assertIn(xy, opened)
+            self.assertEqual(stats['excluded_paths'], 1)
+
+        # The prefix itself is excluded
+        conn, stats = self.trace(['/bin/ls', x], exclude=[x])
+        self.assertNotIn(x, self.opened(conn))
+
+        # Excluding a file (the prefix ends in a leaf)
+        conn, stats = self.trace(argv, exclude=[y])
+        opened = self.opened(conn)
+        self.assertNotIn(y, opened)
+        self.assertIn(xy, opened)
+
+        # Results are memoized per path; they don't carry over to a trace
+        # with different exclusions
+        conn, stats = self.trace(argv, exclude=[xy])
+        opened = self.opened(conn)
+        self.assertIn(y, opened)
+        self.assertNotIn(xy, opened)
+
+        with self.assertRaises(TypeError):
+            _pytracer.execute('/bin/true', ['true'],
+                              str(self.tmp / 'bad.sqlite3'), 0,
+                              exclude=[1])
+
+    def test_attach(self):
+        """Tests attaching to a running process and detaching from it."""
+        path = str(self.tmp / 'f')
+        with (self.tmp / 'f').open('w') as fp:
+            fp.write('line\n')
+        proc = subprocess.Popen(
+            ['/bin/bash', '-c',
+             'while true; do /bin/cat %s > /dev/null; sleep 0.1; done' %
+             path])
+        try:
+            time.sleep(0.2)
+            database = self.tmp / 'trace.sqlite3'
+            status = _pytracer.attach(proc.pid, str(database), 0, duration=1)
+            # Still running, and not stopped
+            self.assertIsNone(status)
+            time.sleep(0.3)
+            self.assertIsNone(proc.poll())
+            with open('/proc/%d/stat' % proc.pid) as fp:
+                self.assertEqual(fp.read().rsplit(')', 1)[1].split()[0], 'S')
+        finally:
+            proc.kill()
+            proc.wait()
+
+        conn = sqlite3.connect(database.path)
+        # The process we attached to makes a run
+        self.assertEqual(
+            list(conn.execute(
+                'SELECT e.name, p.exitcode FROM processes p, '
+                'executed_files e WHERE p.parent IS NULL '
+                'AND e.process = p.id')),
+            [(os.path.realpath('/bin/bash'), None)])
+        self.assertIn(path, self.opened(conn))
+        self.assertIn('/bin/cat',
+                      set(r for r, in conn.execute(
+                          'SELECT name FROM executed_files')))
+
+        # A process exiting while traced
+        proc = subprocess.Popen(['/bin/bash', '-c', 'sleep 0.5; exit 3'])
+        try:
+            time.sleep(0.1)
+            database.remove()
+            self.assertEqual(
+                _pytracer.attach(proc.pid, str(database), 0, duration=5), 3)
+        finally:
+            proc.wait()